@@ -0,0 +1,198 @@
+"""
+admission control: concurrency limits and rate limit of requests
+
+```
+    admission = AdmissionControl(read_limit=64, write_limit=8, rate=50)
+    app.middleware('http')(admission)
+```
+"""
+import asyncio
+import math
+import time
+from collections import OrderedDict, deque
+from typing import Callable, Deque, Dict, Iterable, Optional, Tuple
+
+import config
+from fastapi import Request
+from fastapi.responses import JSONResponse
+from utils.metrics import metrics
+
+READ_METHODS = frozenset(('GET', 'HEAD', 'OPTIONS'))
+
+
+class Overloaded(Exception):
+    """no slot and the queue is full, or waited too long"""
+
+
+class ConcurrencyLimiter:
+    """
+    at most `limit` running requests and `queue` waiting ones,
+    waiters are served first in, first out
+
+    Only used in one event loop, so it needs no lock.
+    """
+
+    def __init__(self, limit: int, queue: int, timeout: Optional[float] = None):
+        self.limit = limit
+        self.queue = queue
+        self.timeout = timeout
+        self.active = 0
+        self._waiters: Deque[asyncio.Future] = deque()
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    async def acquire(self):
+        """
+        Raises:
+            Overloaded
+        """
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            return
+        if len(self._waiters) >= self.queue:
+            raise Overloaded()
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            # release() hands its slot over, active is not changed
+            await asyncio.wait_for(waiter, self.timeout)
+        except asyncio.TimeoutError:
+            self._abandon(waiter)
+            raise Overloaded() from None
+        except BaseException:
+            self._abandon(waiter)
+            raise
+
+    def _abandon(self, waiter: asyncio.Future):
+        if waiter.done() and not waiter.cancelled():
+            # the slot was handed over while giving up
+            self.release()
+        elif waiter in self._waiters:
+            self._waiters.remove(waiter)
+
+    def release(self):
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+
+class TokenBucket:
+    """
+    `rate` requests per second with bursts of `burst` for each key,
+    the least recently seen keys are dropped beyond `maxsize`
+    """
+
+    def __init__(self, rate: float, burst: float, maxsize: int = 100000):
+        self.rate = rate
+        self.burst = burst
+        self.maxsize = maxsize
+        self._buckets: 'OrderedDict[str, Tuple[float, float]]' = OrderedDict()
+
+    def take(self, key: str, now: Optional[float] = None) -> float:
+        """take one token, return 0 or seconds to wait for the next one"""
+        now = time.monotonic() if now is None else now
+        tokens, updated = self._buckets.pop(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        wait = 0.0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            wait = (1 - tokens) / self.rate
+        self._buckets[key] = (tokens, now)
+        if len(self._buckets) > self.maxsize:
+            self._buckets.popitem(last=False)
+        return wait
+
+
+def client_key(request: Request) -> str:
+    """authenticated user, else client address"""
+    user = request.scope.get('user')
+    if user is not None and user.is_authenticated:
+        return f'user:{user.identity}'
+    return f'ip:{request.client.host if request.client else ""}'
+
+
+def _retry_after(seconds: float) -> Dict[str, str]:
+    return {'Retry-After': str(max(1, math.ceil(seconds)))}
+
+
+class AdmissionControl:
+    """
+    http middleware limiting running requests of reads (GET / HEAD) and
+    writes (others) separately, so slow writes can not take every slot.
+
+    A request waits in a bounded queue for a slot, a full queue or waiting
+    more than `queue_timeout` seconds gets 503 at once, so clients back off
+    instead of timing out. With `rate`, each client key gets a token bucket
+    and requests over it get 429.
+    """
+
+    def __init__(
+            self,
+            read_limit: int = 64,
+            read_queue: int = 128,
+            write_limit: int = 16,
+            write_queue: int = 32,
+            queue_timeout: Optional[float] = 1.0,
+            rate: float = 0,
+            burst: float = 0,
+            key_func: Callable[[Request], str] = client_key,
+            exempt_paths: Iterable[str] = ('/metrics',),
+    ):
+        self.groups = {
+            'read': ConcurrencyLimiter(read_limit, read_queue, queue_timeout),
+            'write': ConcurrencyLimiter(write_limit, write_queue, queue_timeout),
+        }
+        # a bucket smaller than one token never allows a request
+        self.bucket = TokenBucket(rate, max(1.0, burst or rate)) if rate > 0 else None
+        self.key_func = key_func
+        self.exempt_paths = frozenset(exempt_paths)
+        self.retry_after = queue_timeout or 1
+
+    async def __call__(self, request: Request, call_next):
+        if request.url.path in self.exempt_paths:
+            return await call_next(request)
+        if self.bucket is not None:
+            wait = self.bucket.take(self.key_func(request))
+            if wait:
+                metrics.counter('http_requests_rejected_total', reason='rate').inc()
+                return JSONResponse(
+                    {'detail': 'Too many requests'},
+                    status_code=429,
+                    headers=_retry_after(wait),
+                )
+        group = 'read' if request.method in READ_METHODS else 'write'
+        limiter = self.groups[group]
+        try:
+            await limiter.acquire()
+        except Overloaded:
+            metrics.counter('http_requests_rejected_total', reason=group).inc()
+            return JSONResponse(
+                {'detail': 'Server is busy'},
+                status_code=503,
+                headers=_retry_after(self.retry_after),
+            )
+        try:
+            return await call_next(request)
+        finally:
+            limiter.release()
+
+
+def get_admission_control() -> Optional[AdmissionControl]:
+    """admission control of config, None if ADMISSION_CONTROL is false"""
+    if not config.ADMISSION_CONTROL:
+        return None
+    return AdmissionControl(
+        read_limit=config.ADMISSION_READ_LIMIT,
+        read_queue=config.ADMISSION_READ_QUEUE,
+        write_limit=config.ADMISSION_WRITE_LIMIT,
+        write_queue=config.ADMISSION_WRITE_QUEUE,
+        queue_timeout=config.ADMISSION_QUEUE_TIMEOUT or None,
+        rate=config.RATE_LIMIT,
+        burst=config.RATE_LIMIT_BURST,
+    )
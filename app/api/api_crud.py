@@ -1,17 +1,74 @@
 """API CRUD method for quickly to build"""
+import asyncio
 import typing
 
-from api.deps import Pagination, get_pagination_schema
+import config
+from api.deps import CursorPagination, Pagination
+from api.etag import etag_matches, make_etag
+from api.export import MEDIA_TYPES, ExportFormat, csv_stream, ndjson_stream
+from api.importer import ErrorPolicy, Importer, ImportFormat
+from api.response_cache import ResponseCache
+from crud.aggregate import parse_group_by, parse_metrics
 from crud.base import CRUDBase
-from fastapi import APIRouter, Depends
-from pydantic import BaseModel
+from crud.changes import ACTIONS, ChangeHub, make_predicate
+from crud.version import version_stamps
+from db.executor import DBExecutor, get_db_executor
+from db.group_commit import WriteCoordinator, get_write_coordinator
+from fastapi import (APIRouter, Body, Depends, HTTPException, Query, Request,
+                     Response, WebSocket, WebSocketDisconnect)
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
+from log import logger
+from pydantic import BaseModel, create_model
+from utils.metrics import track_db, track_serialize
+from utils.pony_filter import FilterError, parse_filters, parse_sort
+from utils.pony_pydantic import (get_projectable_fields, get_serializer,
+                                 serialize, to_json)
+
+
+class BulkItemResult(BaseModel):
+    """result of each item of bulk api"""
+    index: int
+    id: typing.Any = None
+    status: str
+    detail: typing.Optional[str] = None
 
 
 class RouterAbstract:
     """Router Absctact for quickly to build"""
 
-    def __init__(self, crud_api: CRUDBase):
+    def __init__(
+            self,
+            crud_api: CRUDBase,
+            db_executor: typing.Optional[DBExecutor] = None,
+            write_coordinator: typing.Optional[WriteCoordinator] = None,
+    ):
         self._crud = crud_api
+        self._db_executor = db_executor
+        self._write_coordinator = write_coordinator
+
+    def _tracked(self, func: typing.Callable, *args, **kwargs) -> typing.Callable:
+        """func which adds its db time to metrics of request"""
+        database = self._crud.model._database_  # pylint:disable=protected-access
+
+        def _func():
+            with track_db(database):
+                return func(*args, **kwargs)
+
+        return _func
+
+    async def _run(self, func: typing.Callable, *args, **kwargs):
+        """run crud work in db_executor if there is one"""
+        if self._db_executor is None:
+            return self._tracked(func, *args, **kwargs)()
+        return await self._db_executor.run(self._tracked(func, *args, **kwargs))
+
+    async def _write(self, func: typing.Callable, *args, **kwargs):
+        """run single write by write_coordinator (group commit) if there is one"""
+        if self._write_coordinator is None:
+            return await self._run(func, *args, **kwargs)
+        return await self._write_coordinator.submit(
+            self._tracked(func, *args, **kwargs))
 
     async def get_one(self, *args, **kwargs):
         pass
@@ -37,6 +94,18 @@ class RouterAbstract:
     async def delete_one(self, *args, **kwargs):
         pass
 
+    async def post_bulk(self, *args, **kwargs):
+        pass
+
+    async def put_bulk(self, *args, **kwargs):
+        pass
+
+    async def delete_bulk(self, *args, **kwargs):
+        pass
+
+    async def export(self, *args, **kwargs):
+        pass
+
 
 def add_crud_route_factory(
         router: APIRouter,
@@ -46,12 +115,30 @@ def add_crud_route_factory(
         response_model: typing.Optional[typing.Type[typing.Any]] = None,
         path_suffix: str = '/',
         router_method_class: typing.Optional[RouterAbstract] = None,
+        pagination_class: typing.Type[Pagination] = Pagination,
         # id_field_name: str = 'item_id',
         get_one_route: bool = True,
         get_all_route: bool = True,
         put_one_route: bool = True,
         post_one_route: bool = True,
         delete_one_route: bool = True,
+        bulk_routes: bool = False,
+        bulk_chunk_size: typing.Optional[int] = None,
+        db_executor: typing.Optional[DBExecutor] = None,
+        export_route: bool = False,
+        export_batch_size: int = 1000,
+        import_route: bool = False,
+        import_batch_size: int = 1000,
+        etag: bool = False,
+        write_coordinator: typing.Optional[WriteCoordinator] = None,
+        response_cache: typing.Optional[ResponseCache] = None,
+        filterable: bool = False,
+        strict_filters: bool = True,
+        searchable: bool = False,
+        change_feed: bool = False,
+        change_feed_keepalive: float = 15,
+        aggregate_route: bool = False,
+        aggregate_cache_ttl: typing.Optional[float] = None,
 ):
     """
     主要功能寫在 crud
@@ -63,45 +150,564 @@ def add_crud_route_factory(
     delete_one_route
     判斷是否需要開啟 該 CRUD
     schema 也可以客製
+    pagination_class 可換成 CursorPagination 使用 cursor 分頁
+    bulk_routes 開啟 POST / PUT / DELETE `/bulk`，每 bulk_chunk_size 筆 flush 一次
+    db_executor 讓 crud 在 thread pool 執行，預設依照 config.DB_EXECUTION_MODE
+    回傳前會在 db_session 內轉成 response_model
+    export_route 開啟 GET `/export`，每次讀 export_batch_size 筆串流輸出
+    import_route 加上 `/import`，上傳 NDJSON / CSV，
+    每 batch_size 筆（預設 import_batch_size）用 create_schema 驗證並在一個 transaction 新增，
+    on_error: skip 略過、abort 停止、collect 略過並回報錯誤
+    etag 讓 Get One / Get All 回傳 ETag，If-None-Match 相同時直接回 304
+    多個 worker 時需共用 version stamp（config.VERSION_STAMP_PATH，server.py 未設定時自動建立）
+    write_coordinator 讓 Post / Put / Delete One 合併在同一個 transaction commit，
+    預設依照 config.DB_GROUP_COMMIT
+    response_cache 快取 Get All 的 response，CRUDBase 寫入後自動失效
+    response_model 由 pony_orm_to_pydantic 產生時，
+    使用 compiled serializer 直接輸出 json，不再經過 response_model 驗證
+    並可用 `?fields=id,name` 只 select 需要的欄位
+    filterable 讓 Get All 可用 `?name__startswith=a&sort=-id` 篩選、排序，
+    欄位在 entity 的 `_filterable_` 宣告並建立 index，
+    沒有 index 的欄位 strict_filters 時回 400，否則只記 warning
+    searchable 加上 `/search?q=` 全文搜尋，欄位在 entity 的 `_searchable_` 宣告，
+    已有資料用 `python -m crud.search` 重建 index
+    change_feed 加上 `/changes` SSE 與 WebSocket，推送 crud.change_hub 的寫入事件，
+    可用 `actions=`、`ids=`、`_filterable_` 欄位篩選，用 Last-Event-ID 或 `since=` 接續
+    aggregate_route 加上 `/aggregate?group_by=user&metrics=count,max:id`，在 SQL GROUP BY 計算，
+    結果快取 aggregate_cache_ttl 秒（預設依照 config.AGGREGATE_CACHE_TTL），
+    CRUDBase 寫入後只重算被寫入的 group
     """
+    db_executor = db_executor or get_db_executor()
+    write_coordinator = write_coordinator or get_write_coordinator()
+    fast_serializer = (
+        response_model is not None
+        and isinstance(response_model, type)
+        and issubclass(response_model, BaseModel)
+        and get_serializer(crud.model, response_model) is not None
+    )
+    projectable_fields = (
+        get_projectable_fields(crud.model, response_model)
+        if fast_serializer else ()
+    )
+    fields_query = Query(
+        None,
+        description=(
+            '逗號分隔，只回傳這些欄位：' + ', '.join(projectable_fields)
+        ),
+    )
+    filter_description = (
+        '篩選：`欄位=值`、`欄位__in=a,b`、`欄位__gt|gte|lt|lte=值`、'
+        '`欄位__startswith=值`；排序：`sort=-欄位,欄位`'
+        if filterable else None
+    )
+    if searchable and crud.search_index is None:
+        raise ValueError(f'{crud.model.__name__} has no _searchable_ attributes')
+    if aggregate_cache_ttl is None:
+        aggregate_cache_ttl = config.AGGREGATE_CACHE_TTL
+    if change_feed and crud.change_hub is None:
+        raise ValueError('change_feed needs CRUDBase(change_hub=...)')
+    cached_models = (
+        ResponseCache.related_models(crud.model, response_model)
+        if response_cache is not None and fast_serializer else (crud.model,)
+    )
+    # nested entities of response_model change the body too
+    etag_models = ResponseCache.related_models(crud.model, response_model)
+    bulk_update_schema = create_model(
+        f'{update_schema.__name__}Bulk',
+        __base__=update_schema,
+        id=(typing.Any, ...),
+    )
 
     class RouterMethod(RouterAbstract):
         """Custom Router Method for quickly to build"""
 
-        async def get_one(self, item_id: typing.Any):
-            return self._crud.get(item_id)
+        @staticmethod
+        def _serialize(db_obj):
+            """serialize in db_session, relations may be lazy loaded"""
+            if response_model is None or db_obj is None:
+                return db_obj
+            with track_serialize():
+                if fast_serializer:
+                    return serialize(db_obj, response_model)
+                return response_model.from_orm(db_obj)
+
+        @staticmethod
+        def _parse_fields(
+                fields: typing.Optional[str]
+        ) -> typing.Optional[typing.Tuple[str, ...]]:
+            """check `?fields=` with columns of response_model"""
+            if not fields:
+                return None
+            columns = tuple(dict.fromkeys(
+                x.strip() for x in fields.split(',') if x.strip()
+            ))
+            invalid = [x for x in columns if x not in projectable_fields]
+            if invalid:
+                raise HTTPException(
+                    status_code=400,
+                    detail=f'Invalid fields: {", ".join(invalid)}, '
+                           f'available: {", ".join(projectable_fields)}'
+                )
+            return columns or None
+
+        def _parse_filters(self, request: Request):
+            """filters and sort from query params, 400 if invalid"""
+            if not filterable:
+                return None, None
+            model = self._crud.model
+            try:
+                filters, warnings = parse_filters(
+                    model, request.query_params.multi_items(), strict_filters)
+                sort, sort_warnings = parse_sort(
+                    model, request.query_params.get('sort'), strict_filters)
+            except FilterError as e:
+                raise HTTPException(status_code=400, detail=str(e)) from e
+            for warning in warnings + sort_warnings:
+                logger.warning(warning)
+            if sort and issubclass(pagination_class, CursorPagination):
+                raise HTTPException(
+                    status_code=400,
+                    detail='sort is not supported by cursor pagination'
+                )
+            return filters, sort
+
+        @staticmethod
+        def _respond(
+                data: typing.Any,
+                response: typing.Optional[Response] = None,
+                headers: typing.Optional[dict] = None,
+                raw: bool = False,
+        ):
+            """
+            json bytes of compiled serializer skip response_model,
+            raw data (e.g. sparse fields) is always returned as json bytes
+            """
+            headers = headers or {}
+            if fast_serializer or raw:
+                with track_serialize():
+                    content = to_json(data)
+                return Response(
+                    content,
+                    media_type='application/json',
+                    headers=headers,
+                )
+            if response is not None:
+                response.headers.update(headers)
+            return data
+
+        async def get_one(
+                self,
+                item_id: typing.Any,
+                request: Request,
+                response: Response,
+                fields: typing.Optional[str] = fields_query,
+        ):
+            columns = self._parse_fields(fields)
+            headers = {}
+            if etag:
+                # stamp before reading, a write in between changes it again
+                etag_value = make_etag(
+                    version_stamps.entity(self._crud.model, item_id),
+                    *(version_stamps.table(model) for model in etag_models[1:]),
+                    response_model.__name__ if response_model else '',
+                    columns,
+                )
+                if etag_matches(request, etag_value):
+                    return Response(
+                        status_code=304, headers={'ETag': etag_value})
+                headers['ETag'] = etag_value
+            if columns:
+                row = await self._run(
+                    self._crud.get, item_id, fields=columns)
+                keys = Pagination.projected_keys(columns, response_model)
+                data = {key: row[name] for name, key in zip(columns, keys)}
+                return self._respond(data, response, headers, raw=True)
+            data = await self._run(
+                self._crud.get, item_id, schema=response_model)
+            return self._respond(data, response, headers)
 
         async def get_all(
                 self,
-                pagination: Pagination = Depends()
+                request: Request,
+                response: Response,
+                pagination: pagination_class = Depends(),
+                fields: typing.Optional[str] = fields_query,
+        ):
+            columns = self._parse_fields(fields)
+            filters, sort = self._parse_filters(request)
+            headers = {}
+            if etag:
+                etag_value = make_etag(
+                    *(version_stamps.table(model) for model in etag_models),
+                    request.url.path,
+                    request.url.query,
+                )
+                if etag_matches(request, etag_value):
+                    return Response(
+                        status_code=304, headers={'ETag': etag_value})
+                headers['ETag'] = etag_value
+
+            def _get_all():
+                if columns:
+                    return pagination.page(
+                        self._crud.read_query(filters=filters, sort=sort),
+                        response_model, fields=columns
+                    )
+                # relations of response_model are prefetched by page
+                page = pagination.page(
+                    self._crud.read_query(filters=filters, sort=sort),
+                    response_model
+                )
+                page['data'] = [self._serialize(x) for x in page['data']]
+                return page
+
+            if response_cache is not None:
+                async def _get_all_json():
+                    page = await self._run(_get_all)
+                    with track_serialize():
+                        if not (fast_serializer or columns):
+                            page = jsonable_encoder(page)
+                        return to_json(page)
+
+                content, hit = await response_cache.get_or_set(
+                    response_cache.make_key(request, cached_models),
+                    _get_all_json,
+                )
+                headers['X-Cache'] = 'HIT' if hit else 'MISS'
+                return Response(
+                    content, media_type='application/json', headers=headers)
+
+            return self._respond(
+                await self._run(_get_all), response, headers,
+                raw=columns is not None
+            )
+
+        async def search(
+                self,
+                response: Response,
+                q: str = Query(..., min_length=1, description='搜尋的文字'),
+                pagination: Pagination = Depends(),
+        ):
+            def _search():
+                rows, pagination.count = self._crud.search(
+                    q, pagination.offset, pagination.limit,
+                    schema=response_model,
+                )
+                return pagination.result([self._serialize(x) for x in rows])
+
+            return self._respond(await self._run(_search), response)
+
+        async def aggregate(
+                self,
+                request: Request,
+                group_by: typing.Optional[str] = Query(
+                    None, description='逗號分隔，`_filterable_` 的欄位'),
+                metrics: str = Query(
+                    'count',
+                    description='逗號分隔：`count`、`min|max|sum|avg:欄位`'),
+                limit: int = Query(1000, ge=1, le=10000),
         ):
-            query = self._crud.query()
-            return await pagination.paginate(query)
+            model = self._crud.model
+            try:
+                group_by = parse_group_by(model, group_by)
+                metrics = parse_metrics(model, metrics)
+                filters, warnings = parse_filters(
+                    model, request.query_params.multi_items(), strict_filters
+                ) if filterable else ([], [])
+            except FilterError as e:
+                raise HTTPException(status_code=400, detail=str(e)) from e
+            for warning in warnings:
+                logger.warning(warning)
+
+            def _aggregate():
+                return self._crud.aggregate(
+                    group_by, metrics, filters,
+                    ttl=aggregate_cache_ttl or None,
+                )
+
+            rows, hit = await self._run(_aggregate)
+            data = {
+                'group_by': list(group_by),
+                'metrics': [metric.key for metric in metrics],
+                'data': rows[:limit],
+                'truncated': len(rows) > limit,
+            }
+            return self._respond(
+                data, headers={'X-Cache': 'HIT' if hit else 'MISS'}, raw=True)
+
+        def _subscribe(
+                self,
+                params: typing.Mapping[str, str],
+                last_event_id: typing.Optional[str],
+        ):
+            """subscription of `/changes`, filters are checked like Get All"""
+            model = self._crud.model
+            actions = [x for x in (params.get('actions') or '').split(',') if x]
+            ids = [x for x in (params.get('ids') or '').split(',') if x]
+            if any(action not in ACTIONS for action in actions):
+                raise HTTPException(
+                    status_code=400,
+                    detail=f'actions should be in {", ".join(ACTIONS)}')
+            filterable = getattr(model, '_filterable_', ())
+            data = {
+                name: value for name, value in params.items()
+                if name not in ('actions', 'ids', 'since')
+            }
+            unknown = [name for name in data if name not in filterable]
+            if unknown:
+                raise HTTPException(
+                    status_code=400,
+                    detail=f'cannot filter changes by {", ".join(unknown)}')
+            return self._crud.change_hub.subscribe(
+                last_event_id or params.get('since'),
+                make_predicate(model.__name__, actions, ids, data),
+            )
+
+        async def changes(self, request: Request):
+            hub: ChangeHub = self._crud.change_hub
+            subscription, backlog, reset = self._subscribe(
+                request.query_params, request.headers.get('Last-Event-ID'))
+
+            def _message(event):
+                return (
+                    f'id: {hub.event_id(event)}\nevent: {event.action}\n'
+                    f'data: {to_json(event.to_dict()).decode()}\n\n'
+                )
+
+            async def _stream():
+                try:
+                    if reset:
+                        yield 'event: reset\ndata: {}\n\n'
+                    for event in backlog:
+                        yield _message(event)
+                    while True:
+                        try:
+                            event = await asyncio.wait_for(
+                                subscription.get(), change_feed_keepalive)
+                        except asyncio.TimeoutError:
+                            yield ': keepalive\n\n'
+                            continue
+                        if event is None:
+                            # too slow, resume by Last-Event-ID
+                            yield 'event: dropped\ndata: {}\n\n'
+                            return
+                        yield _message(event)
+                finally:
+                    subscription.close()
+
+            return StreamingResponse(
+                _stream(),
+                media_type='text/event-stream',
+                headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+            )
+
+        async def changes_websocket(self, websocket: WebSocket):
+            hub: ChangeHub = self._crud.change_hub
+            try:
+                subscription, backlog, reset = self._subscribe(
+                    websocket.query_params, None)
+            except HTTPException as e:
+                await websocket.close(code=1008, reason=e.detail)
+                return
+            await websocket.accept()
+
+            def _payload(event):
+                return to_json(
+                    {'event_id': hub.event_id(event), **event.to_dict()}
+                ).decode()
+
+            async def _wait_disconnect():
+                try:
+                    while (await websocket.receive())['type'] != 'websocket.disconnect':
+                        pass
+                except RuntimeError:
+                    # closed by the server
+                    pass
+
+            disconnected = asyncio.ensure_future(_wait_disconnect())
+            try:
+                if reset:
+                    await websocket.send_json({'action': 'reset'})
+                for event in backlog:
+                    await websocket.send_text(_payload(event))
+                while True:
+                    getter = asyncio.ensure_future(subscription.get())
+                    await asyncio.wait(
+                        (getter, disconnected),
+                        return_when=asyncio.FIRST_COMPLETED,
+                    )
+                    if disconnected.done():
+                        getter.cancel()
+                        return
+                    event = getter.result()
+                    if event is None:
+                        # too slow, resume by `since=`
+                        await websocket.close(code=1013)
+                        return
+                    await websocket.send_text(_payload(event))
+            except WebSocketDisconnect:
+                pass
+            finally:
+                disconnected.cancel()
+                subscription.close()
+
+        async def import_file(
+                self,
+                request: Request,
+                file_format: typing.Optional[ImportFormat] = Query(
+                    None, alias='format',
+                    description='預設依照 Content-Type，text/csv 為 csv'),
+                on_error: ErrorPolicy = ErrorPolicy.collect,
+                batch_size: int = Query(import_batch_size, ge=1, le=10000),
+        ):
+            if file_format is None:
+                content_type = request.headers.get('content-type', '')
+                file_format = (
+                    ImportFormat.csv if content_type.startswith('text/csv')
+                    else ImportFormat.ndjson
+                )
+            importer = Importer(self._crud, create_schema, batch_size, on_error)
+            return await importer.run_request(request, file_format)
 
         async def put_one(
                 self,
                 item_id: typing.Any,
                 _update_schema: update_schema
         ):
-            return self._crud.update_by_id(item_id, _update_schema)
+            def _put_one():
+                return self._serialize(
+                    self._crud.update_by_id(item_id, _update_schema))
+
+            return self._respond(await self._write(_put_one))
 
         async def post_one(
                 self,
                 _create_schema: create_schema
         ):
-            return self._crud.create(_create_schema)
+            def _post_one():
+                return self._serialize(self._crud.create(_create_schema))
+
+            return self._respond(await self._write(_post_one))
 
         async def delete_one(self, item_id: typing.Any):
-            return self._crud.remove_by_id(item_id)
+            return await self._write(self._crud.remove_by_id, item_id)
+
+        async def post_bulk(
+                self,
+                items: typing.List[create_schema]
+        ):
+            return await self._run(
+                self._crud.bulk_create, items, bulk_chunk_size)
+
+        async def put_bulk(
+                self,
+                items: typing.List[bulk_update_schema]
+        ):
+            return await self._run(
+                self._crud.bulk_update, items, bulk_chunk_size)
+
+        async def delete_bulk(
+                self,
+                ids: typing.List[typing.Any] = Body(...)
+        ):
+            return await self._run(
+                self._crud.bulk_delete, ids, bulk_chunk_size)
+
+        async def export(
+                self,
+                file_format: ExportFormat = Query(
+                    ExportFormat.ndjson, alias='format')
+        ):
+            stream = csv_stream if file_format == ExportFormat.csv else ndjson_stream
+            filename = f'{self._crud.model.__name__}.{file_format.value}'
+            return StreamingResponse(
+                stream(self._crud, response_model, export_batch_size),
+                media_type=MEDIA_TYPES[file_format],
+                headers={
+                    'Content-Disposition': f'attachment; filename="{filename}"'
+                },
+            )
 
     _RouterMethodClass = router_method_class or RouterMethod
-    router_method_instance = _RouterMethodClass(crud)
+    router_method_instance = _RouterMethodClass(
+        crud, db_executor, write_coordinator)
     if get_all_route:
         router.add_api_route(
             f'{path_suffix}',
             router_method_instance.get_all,
             name='Get All',
-            response_model=get_pagination_schema(response_model),
+            description=filter_description,
+            response_model=pagination_class.get_page_schema(response_model),
+            methods=['GET']
+        )
+    if bulk_routes:
+        # before `/{item_id}` routes, or `bulk` will be matched as item_id
+        router.add_api_route(
+            f'/bulk{path_suffix}',
+            router_method_instance.post_bulk,
+            name='Post Bulk',
+            response_model=typing.List[BulkItemResult],
+            methods=['POST']
+        )
+        router.add_api_route(
+            f'/bulk{path_suffix}',
+            router_method_instance.put_bulk,
+            name='Put Bulk',
+            response_model=typing.List[BulkItemResult],
+            methods=['PUT']
+        )
+        router.add_api_route(
+            f'/bulk{path_suffix}',
+            router_method_instance.delete_bulk,
+            name='Delete Bulk',
+            response_model=typing.List[BulkItemResult],
+            methods=['DELETE']
+        )
+    if import_route:
+        router.add_api_route(
+            f'/import{path_suffix}',
+            router_method_instance.import_file,
+            name='Import',
+            methods=['POST'],
+            openapi_extra={'requestBody': {'content': {
+                media_type: {'schema': {'type': 'string', 'format': 'binary'}}
+                for media_type in MEDIA_TYPES.values()
+            }}},
+        )
+    if export_route:
+        router.add_api_route(
+            f'/export{path_suffix}',
+            router_method_instance.export,
+            name='Export',
+            methods=['GET']
+        )
+    if change_feed:
+        router.add_api_route(
+            f'/changes{path_suffix}',
+            router_method_instance.changes,
+            name='Changes',
+            description='Server-Sent Events，同路徑也可用 WebSocket',
+            methods=['GET']
+        )
+        router.add_api_websocket_route(
+            f'/changes{path_suffix}',
+            router_method_instance.changes_websocket,
+            name='Changes WebSocket',
+        )
+    if searchable:
+        router.add_api_route(
+            f'/search{path_suffix}',
+            router_method_instance.search,
+            name='Search',
+            response_model=Pagination.get_page_schema(response_model),
+            methods=['GET']
+        )
+    if aggregate_route:
+        router.add_api_route(
+            f'/aggregate{path_suffix}',
+            router_method_instance.aggregate,
+            name='Aggregate',
+            description=filter_description,
             methods=['GET']
         )
     if get_one_route:
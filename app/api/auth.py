@@ -0,0 +1,230 @@
+"""
+authentication of bearer token
+
+```
+    app.add_middleware(
+        AuthenticationMiddleware,
+        backend=get_auth_backend(),
+        on_error=auth_error,
+    )
+```
+"""
+import hashlib
+import time
+import uuid
+from functools import lru_cache
+from typing import Any, FrozenSet, Iterable, Optional, Tuple
+
+import config
+from crud.version import version_stamps
+from db import models
+from db.executor import get_db_executor
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse
+from pony.orm import db_session
+from starlette.authentication import (AuthCredentials, AuthenticationBackend,
+                                      AuthenticationError, BaseUser)
+from starlette.requests import HTTPConnection
+from utils import jwt
+from utils.cache import CacheBackend, SQLiteBackend, TTLCache
+
+SUPER_ADMIN_SCOPE = 'super_admin'
+
+
+class AuthUser(BaseUser):
+    """user of a verified token, `scope` claim is the permission set"""
+
+    def __init__(self, user_id: Any, name: str, permissions: FrozenSet[str]):
+        self.id = user_id  # pylint:disable=invalid-name
+        self.name = name
+        self.permissions = permissions
+
+    @property
+    def is_authenticated(self) -> bool:
+        return True
+
+    @property
+    def display_name(self) -> str:
+        return self.name
+
+    @property
+    def identity(self) -> str:
+        return str(self.id)
+
+    @property
+    def is_super_admin(self) -> bool:
+        return SUPER_ADMIN_SCOPE in self.permissions
+
+
+class TokenAuthBackend(AuthenticationBackend):
+    """
+    HS256 bearer token backend with caches
+
+    Verified claims are cached by token, users by id and the version stamp
+    of the user, so a write of the user through CRUDBase reloads it.
+    Revocations are checked on every request, they are kept in process
+    unless a shared backend is given. The backend must not evict (maxsize
+    None), a revoked token is dropped only once it expires.
+
+    ```
+        backend = TokenAuthBackend(secret)
+        token = backend.create_token(user.id, scopes=['super_admin'])
+        backend.revoke(token)
+        backend.revoke_user(user.id)  # every token issued before now
+    ```
+    """
+
+    def __init__(
+            self,
+            secret: str,
+            token_ttl: float = 3600,
+            cache_ttl: float = 60,
+            cache_size: int = 10000,
+            revocations: Optional[CacheBackend] = None,
+    ):
+        if not secret:
+            raise ValueError('secret of token is required')
+        self.secret = secret
+        self.token_ttl = token_ttl
+        self.cache_ttl = cache_ttl
+        self.tokens = TTLCache(maxsize=cache_size, ttl=cache_ttl)
+        self.users = TTLCache(maxsize=cache_size, ttl=cache_ttl)
+        self.revocations = revocations or TTLCache(maxsize=None)
+
+    @staticmethod
+    def _digest(token: str) -> str:
+        return hashlib.blake2b(token.encode(), digest_size=16).hexdigest()
+
+    def create_token(
+            self,
+            user_id: Any,
+            scopes: Iterable[str] = (),
+            ttl: Optional[float] = None,
+    ) -> str:
+        """token of user, expired after ttl (default token_ttl) seconds"""
+        now = time.time()
+        return jwt.encode({
+            'sub': user_id,
+            'scope': ' '.join(scopes),
+            'iat': now,
+            'exp': now + (self.token_ttl if ttl is None else ttl),
+            'jti': uuid.uuid4().hex,
+        }, self.secret)
+
+    def _check_revoked(self, claims: dict, digest: str):
+        if self.revocations.get(f'token:{claims.get("jti") or digest}'):
+            raise jwt.TokenError('token revoked')
+        revoked_before = self.revocations.get(f'user:{claims.get("sub")}')
+        if revoked_before is not None and claims.get('iat', 0) <= revoked_before:
+            raise jwt.TokenError('token revoked')
+
+    def verify(self, token: str) -> dict:
+        """
+        claims of token, decoded once per cache_ttl
+
+        Raises:
+            TokenError
+        """
+        digest = self._digest(token)
+        claims = self.tokens.get(digest)
+        if claims is None:
+            claims = jwt.decode(token, self.secret)
+            ttl = self.cache_ttl
+            if 'exp' in claims:
+                ttl = min(ttl, claims['exp'] - time.time())
+            self.tokens.set(digest, claims, ttl=ttl)
+        elif 'exp' in claims and time.time() > claims['exp']:
+            raise jwt.TokenError('token expired')
+        self._check_revoked(claims, digest)
+        return claims
+
+    def revoke(self, token: str):
+        """reject token until it expires"""
+        digest = self._digest(token)
+        try:
+            claims = jwt.decode(token, self.secret)
+        except jwt.TokenError:
+            # invalid or expired, never accepted anyway
+            return
+        ttl = max(claims['exp'] - time.time(), 1) if 'exp' in claims else None
+        self.revocations.set(
+            f'token:{claims.get("jti") or digest}', True, ttl=ttl)
+        self.tokens.delete(digest)
+
+    def revoke_user(self, user_id: Any):
+        """reject tokens of user issued until now"""
+        self.revocations.set(f'user:{user_id}', time.time())
+        self.users.delete(self._user_key(user_id))
+
+    @staticmethod
+    def _user_key(user_id: Any) -> Tuple[Any, str]:
+        return user_id, version_stamps.entity(models.User, user_id)
+
+    @staticmethod
+    def _load_user(user_id: Any) -> Optional[Tuple[Any, str]]:
+        user = models.User.get(id=user_id)
+        return (user.id, user.name) if user is not None else None
+
+    async def get_user(self, claims: dict) -> Optional[AuthUser]:
+        """user of claims, None if deleted"""
+        user_id = claims.get('sub')
+        key = self._user_key(user_id)
+        row = self.users.get(key)
+        if row is None:
+            db_executor = get_db_executor()
+            if db_executor is not None:
+                row = await db_executor.run(self._load_user, user_id)
+            else:
+                row = await run_in_threadpool(
+                    db_session(self._load_user), user_id)
+            # a deleted user is cached too, deleting bumps the stamp
+            row = row or ()
+            self.users.set(key, row)
+        if not row:
+            return None
+        return AuthUser(
+            row[0], row[1], frozenset(claims.get('scope', '').split()))
+
+    async def authenticate(
+            self, conn: HTTPConnection
+    ) -> Optional[Tuple[AuthCredentials, BaseUser]]:
+        authorization = conn.headers.get('Authorization')
+        if not authorization:
+            return None
+        scheme, _, token = authorization.partition(' ')
+        if scheme.lower() != 'bearer':
+            return None
+        try:
+            claims = self.verify(token.strip())
+        except jwt.TokenError as e:
+            raise AuthenticationError(str(e)) from e
+        user = await self.get_user(claims)
+        if user is None:
+            raise AuthenticationError('user not found')
+        return AuthCredentials(['authenticated', *user.permissions]), user
+
+
+def auth_error(_: HTTPConnection, exc: Exception) -> JSONResponse:
+    """401 of invalid token"""
+    return JSONResponse(
+        {'detail': str(exc)},
+        status_code=401,
+        headers={'WWW-Authenticate': 'Bearer'},
+    )
+
+
+@lru_cache()
+def get_auth_backend() -> Optional[TokenAuthBackend]:
+    """backend of config, None if AUTH_SECRET is not set"""
+    if not config.AUTH_SECRET:
+        return None
+    revocations = None
+    if config.AUTH_REVOCATION_PATH:
+        revocations = SQLiteBackend(config.AUTH_REVOCATION_PATH, maxsize=None)
+    return TokenAuthBackend(
+        config.AUTH_SECRET,
+        token_ttl=config.AUTH_TOKEN_TTL,
+        cache_ttl=config.AUTH_CACHE_TTL,
+        cache_size=config.AUTH_CACHE_SIZE,
+        revocations=revocations,
+    )
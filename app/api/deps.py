@@ -1,10 +1,21 @@
 """deps module"""
+import base64
+import binascii
+import functools
+import inspect
+import json
 import typing
 from typing import List, Optional
-from fastapi import Query, Request
+from crud.count import count_cache, query_entity
+from crud.projection import project, to_dicts
+from fastapi import HTTPException, Query, Request
+from pony.orm import desc
 from pydantic import BaseModel, Field
+from utils.pony_filter import parse_value
+from utils.pony_pydantic import get_prefetch, get_projected_schema
 
 
+@functools.lru_cache(maxsize=None)
 def get_pagination_schema(
         schema: Optional[typing.Type[typing.Any]] = None
 ) -> typing.Union[type, BaseModel]:
@@ -21,6 +32,8 @@ def get_pagination_schema(
     class PageModel(BaseModel):
         """page model"""
         count: int = Field(..., description='filter後的資料總數目')
+        count_estimated: bool = Field(
+            False, description='count 是否為統計資訊的估計值')
         next: Optional[str] = Field(None, description='下一頁的網址，如果不是最後一頁的話')
         previous: Optional[str] = Field(None, description='下一頁的網址，如果不是最後一頁的話')
         data: List[schema] = Field(...,
@@ -31,6 +44,36 @@ def get_pagination_schema(
     return class_
 
 
+@functools.lru_cache(maxsize=None)
+def get_cursor_pagination_schema(
+        schema: Optional[typing.Type[typing.Any]] = None
+) -> typing.Union[type, BaseModel]:
+    """
+
+    Args:
+        schema:
+
+    Returns:
+        Cursor Pagination Schmea
+
+    """
+
+    class CursorPageModel(BaseModel):
+        """cursor page model"""
+        count: Optional[int] = Field(
+            None, description='filter後的資料總數目，with_count=true 才會計算')
+        count_estimated: bool = Field(
+            False, description='count 是否為統計資訊的估計值')
+        next: Optional[str] = Field(None, description='下一頁的 cursor，如果不是最後一頁的話')
+        previous: Optional[str] = Field(None, description='上一頁的 cursor，如果不是第一頁的話')
+        data: List[schema] = Field(...,
+                                   description=f'{schema.__name__} 的List 結果')
+
+    class_ = type(f'{schema.__name__}CursorPage', (CursorPageModel,), {})
+
+    return class_
+
+
 class Pagination:
     """
     from fastapi conrtib to get it
@@ -67,6 +110,14 @@ class Pagination:
             max_offset = 100`
             max_limit = 2000
 
+    The total count can be cached or estimated:
+
+    .. code-block:: python
+
+        class BigTablePagination(Pagination):
+            count_cache_ttl = 30  # seconds, invalidated by CRUDBase writes
+            estimate_count = True  # unfiltered count from table statistics
+
     :param request: starlette Request object
     :param offset: query param of how many records to skip
     :param limit: query param of how many records to show
@@ -76,6 +127,8 @@ class Pagination:
     default_limit = 10
     max_offset = None
     max_limit = 100
+    count_cache_ttl = None
+    estimate_count = False
 
     def __init__(
             self,
@@ -88,8 +141,51 @@ class Pagination:
         self.limit = limit
         self.model = None
         self.count = None
+        self.count_estimated = False
         self.list = []
 
+    def __init_subclass__(cls, **kwargs):
+        """
+        defaults of `Query()` are evaluated once with the class body,
+        FastAPI reads the signature, so rebuild it from the subclass values
+        """
+        super().__init_subclass__(**kwargs)
+        queries = {
+            'offset': Query(
+                default=cls.default_offset, ge=0, le=cls.max_offset),
+            'limit': Query(
+                default=cls.default_limit, ge=1, le=cls.max_limit),
+        }
+        params = list(inspect.signature(cls.__init__).parameters.values())[1:]
+        cls.__signature__ = inspect.Signature([
+            param.replace(default=queries[param.name])
+            if param.name in queries else param
+            for param in params
+        ])
+
+    @classmethod
+    def get_page_schema(
+            cls,
+            schema: typing.Type[typing.Any]
+    ) -> typing.Union[type, BaseModel]:
+        """response schema of `paginate`"""
+        return get_pagination_schema(schema)
+
+    def get_query_count(self, query: Query) -> int:
+        """
+        Retrieves counts for query,
+        cached by `count_cache_ttl` and estimated by `estimate_count`.
+
+        :param query: pony query
+        :return: number of found records
+        """
+        self.count, self.count_estimated = count_cache.count(
+            query,
+            ttl=self.count_cache_ttl,
+            estimate=self.estimate_count,
+        )
+        return self.count
+
     async def get_count(self, **kwargs) -> int:
         """
         Retrieves counts for query list, filtered by kwargs.
@@ -100,6 +196,28 @@ class Pagination:
         self.count = await self.model.count(**kwargs)
         return self.count
 
+    @staticmethod
+    def prefetch(
+            query: Query,
+            schema: Optional[typing.Type[BaseModel]] = None
+    ) -> Query:
+        """prefetch relations of `include=` in schema"""
+        if schema is None:
+            return query
+        attrs = get_prefetch(query_entity(query), schema)
+        return query.prefetch(*attrs) if attrs else query
+
+    @staticmethod
+    def projected_keys(
+            fields: typing.Tuple[str, ...],
+            schema: Optional[typing.Type[BaseModel]] = None,
+    ) -> typing.List[str]:
+        """keys of projected rows, aliases of projected schema"""
+        if schema is None:
+            return list(fields)
+        projected = get_projected_schema(schema, fields)
+        return [projected.__fields__[name].alias for name in fields]
+
     def get_next_url(self) -> typing.Optional[str]:
         """
         Constructs `next` parameter in resulting JSON,
@@ -136,23 +254,259 @@ class Pagination:
 
     async def paginate(
             self,
-            query: Query
+            query: Query,
+            schema: Optional[typing.Type[BaseModel]] = None,
+            fields: Optional[typing.Tuple[str, ...]] = None,
+    ) -> dict:
+        """
+        Actual pagination function, see `page`
+
+        :param query:
+        :param schema: response schema, relations of it are prefetched
+        :param fields: only select these columns, data will be dicts
+        :return: dict that should be returned as a response
+        """
+        return self.page(query, schema, fields)
+
+    def page(
+            self,
+            query: Query,
+            schema: Optional[typing.Type[BaseModel]] = None,
+            fields: Optional[typing.Tuple[str, ...]] = None,
     ) -> dict:
         """
         Actual pagination function, takes serializer class,
         filter options as kwargs and returns dict with the following fields:
             * count - counts for query list, filtered by kwargs
+            * count_estimated - whether count is estimated
             * next - URL for next "page" of paginated results
             * previous - URL for previous "page" of paginated results
             * result - actual list of records (dicts)
 
         :param query:
+        :param schema: response schema, relations of it are prefetched
+        :param fields: only select these columns, data will be dicts
         :return: dict that should be returned as a response
         """
-        self.count = query.count()
+        self.get_query_count(query)
+        if fields:
+            data = to_dicts(
+                project(query, fields).limit(self.limit, offset=self.offset),
+                self.projected_keys(fields, schema)
+            )
+        else:
+            data = self.prefetch(query, schema).limit(
+                self.limit, offset=self.offset)[:]
+        return self.result(data)
+
+    def result(self, data: list) -> dict:
+        """page of data, `count` is set already"""
         return {
             'count': self.count,
+            'count_estimated': self.count_estimated,
             'next': self.get_next_url(),
             'previous': self.get_previous_url(),
-            'data': query.limit(self.limit, offset=self.offset)[:],
+            'data': data,
+        }
+
+
+class CursorPagination(Pagination):
+    """
+    Keyset (cursor) pagination.
+
+    Instead of `LIMIT ... OFFSET ...` the page is fetched by
+    `WHERE cursor_field > :last ORDER BY cursor_field`,
+    so page 10,000 costs the same as page 1.
+    `next` / `previous` are opaque cursors, pass them back as `cursor`.
+    The total count is skipped unless `with_count=true`.
+
+    Subclass this pagination to page by another indexed field:
+
+    .. code-block:: python
+
+        class NamePagination(CursorPagination):
+            cursor_field = 'name'
+            default_limit = 20
+
+    `id` is always used as tie breaker so `cursor_field` need not be unique.
+
+    :param request: starlette Request object
+    :param cursor: opaque cursor from `next` / `previous` of previous page
+    :param limit: query param of how many records to show
+    :param with_count: query param of whether to count the total records
+    """
+
+    cursor_field = 'id'
+
+    def __init__(
+            self,
+            request: Request,
+            cursor: Optional[str] = Query(default=None),
+            limit: int = Query(
+                default=Pagination.default_limit,
+                ge=1, le=Pagination.max_limit
+            ),
+            with_count: bool = Query(default=False),
+    ):
+        # pylint: disable=super-init-not-called
+        self.request = request
+        self.cursor = cursor
+        self.limit = limit
+        self.with_count = with_count
+        self.model = None
+        self.count = None
+        self.count_estimated = False
+        self.list = []
+
+    @classmethod
+    def get_page_schema(
+            cls,
+            schema: typing.Type[typing.Any]
+    ) -> typing.Union[type, BaseModel]:
+        """response schema of `paginate`"""
+        return get_cursor_pagination_schema(schema)
+
+    @staticmethod
+    def encode_cursor(direction: str, value: typing.Any, _id: typing.Any) -> str:
+        """encode cursor to opaque string"""
+        raw = json.dumps([direction, value, _id], default=str)
+        return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+    @staticmethod
+    def decode_cursor(cursor: str) -> typing.Tuple[str, typing.Any, typing.Any]:
+        """decode opaque cursor, raise 400 if it is invalid"""
+        try:
+            raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+            direction, value, _id = json.loads(raw)
+        except (binascii.Error, ValueError, TypeError) as e:
+            raise HTTPException(status_code=400, detail='Invalid cursor') from e
+        if direction not in ('n', 'p'):
+            raise HTTPException(status_code=400, detail='Invalid cursor')
+        return direction, value, _id
+
+    def parse_cursor(
+            self,
+            query: Query,
+            cursor: str
+    ) -> typing.Tuple[str, typing.Any, typing.Any]:
+        """
+        decode cursor, value and id are converted to types of
+        `cursor_field` and primary key, raise 400 if they can not be
+        """
+        direction, value, _id = self.decode_cursor(cursor)
+        entity = query_entity(query)
+        # pylint:disable=protected-access
+        try:
+            if self.cursor_field != 'id':
+                value = parse_value(
+                    entity._adict_[self.cursor_field].py_type, value)
+            _id = parse_value(entity._pk_attrs_[0].py_type, _id)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail='Invalid cursor') from e
+        return direction, value, _id
+
+    def _make_cursor(self, direction: str, row) -> str:
+        if isinstance(row, dict):
+            return self.encode_cursor(
+                direction, row[self.cursor_field], row['id'])
+        return self.encode_cursor(
+            direction, getattr(row, self.cursor_field), row.id)
+
+    def _seek(self, query: Query, direction: str, value, last_id) -> Query:
+        key = self.cursor_field
+        if key == 'id':
+            if direction == 'n':
+                return query.filter(lambda o: o.id > last_id)
+            return query.filter(lambda o: o.id < last_id)
+        if direction == 'n':
+            return query.filter(
+                lambda o: getattr(o, key) > value or (
+                    getattr(o, key) == value and o.id > last_id)
+            )
+        return query.filter(
+            lambda o: getattr(o, key) < value or (
+                getattr(o, key) == value and o.id < last_id)
+        )
+
+    def _order(
+            self,
+            query: Query,
+            direction: str,
+            projected: bool = False
+    ) -> Query:
+        key = self.cursor_field
+        if projected:
+            # projected columns start with id, cursor_field
+            positions = (1,) if key == 'id' else (2, 1)
+            if direction == 'p':
+                positions = tuple(-x for x in positions)
+            return query.order_by(*positions)
+        if key == 'id':
+            if direction == 'n':
+                return query.order_by(lambda o: o.id)
+            return query.order_by(lambda o: desc(o.id))
+        if direction == 'n':
+            return query.order_by(lambda o: (getattr(o, key), o.id))
+        return query.order_by(lambda o: (desc(getattr(o, key)), desc(o.id)))
+
+    def page(
+            self,
+            query: Query,
+            schema: Optional[typing.Type[BaseModel]] = None,
+            fields: Optional[typing.Tuple[str, ...]] = None,
+    ) -> dict:
+        """
+        Keyset pagination function, returns dict with the following fields:
+            * count - counts for query list, None if `with_count` is false
+            * count_estimated - whether count is estimated
+            * next - cursor for next "page" of paginated results
+            * previous - cursor for previous "page" of paginated results
+            * data - actual list of records
+
+        :param query:
+        :param schema: response schema, relations of it are prefetched
+        :param fields: only select these columns, data will be dicts
+        :return: dict that should be returned as a response
+        """
+        if self.with_count:
+            self.get_query_count(query)
+        direction = 'n'
+        if self.cursor:
+            direction, value, last_id = self.parse_cursor(query, self.cursor)
+            query = self._seek(query, direction, value, last_id)
+        columns = None
+        if fields:
+            columns = tuple(dict.fromkeys(('id', self.cursor_field) + tuple(fields)))
+            query = project(query, columns)
+        else:
+            query = self.prefetch(query, schema)
+        rows = self._order(query, direction, columns is not None).limit(
+            self.limit + 1)[:]
+        if columns:
+            rows = to_dicts(rows, columns)
+        has_more = len(rows) > self.limit
+        rows = rows[:self.limit]
+        if direction == 'p':
+            rows.reverse()
+
+        next_cursor = previous_cursor = None
+        if rows:
+            if direction == 'n':
+                next_cursor = self._make_cursor('n', rows[-1]) if has_more else None
+                previous_cursor = self._make_cursor('p', rows[0]) if self.cursor else None
+            else:
+                next_cursor = self._make_cursor('n', rows[-1])
+                previous_cursor = self._make_cursor('p', rows[0]) if has_more else None
+        if columns:
+            keys = self.projected_keys(fields, schema)
+            rows = [
+                {key: row[name] for name, key in zip(fields, keys)}
+                for row in rows
+            ]
+        return {
+            'count': self.count,
+            'count_estimated': self.count_estimated,
+            'next': next_cursor,
+            'previous': previous_cursor,
+            'data': rows,
         }
@@ -0,0 +1,30 @@
+"""ETag helpers"""
+import hashlib
+import typing
+
+from fastapi import Request
+
+
+def make_etag(*parts: typing.Any) -> str:
+    """weak etag from parts"""
+    digest = hashlib.blake2b(
+        ':'.join(str(x) for x in parts).encode(), digest_size=12
+    ).hexdigest()
+    return f'W/"{digest}"'
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """check If-None-Match header, weak comparison"""
+    header = request.headers.get('if-none-match')
+    if not header:
+        return False
+    if header.strip() == '*':
+        return True
+    weak = etag[2:] if etag.startswith('W/') else etag
+    for candidate in header.split(','):
+        candidate = candidate.strip()
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate == weak:
+            return True
+    return False
@@ -0,0 +1,62 @@
+"""stream whole table as NDJSON or CSV"""
+import csv
+import enum
+import io
+import typing
+
+from crud.base import CRUDBase
+from pydantic import BaseModel
+from utils.pony_pydantic import serialize, to_json
+
+
+class ExportFormat(str, enum.Enum):
+    """export file format"""
+    ndjson = 'ndjson'
+    csv = 'csv'
+
+
+MEDIA_TYPES = {
+    ExportFormat.ndjson: 'application/x-ndjson',
+    ExportFormat.csv: 'text/csv',
+}
+
+
+def _row_to_dict(
+        schema: typing.Optional[typing.Type[BaseModel]]
+) -> typing.Callable[[typing.Any], dict]:
+    if schema is None:
+        return lambda db_obj: db_obj.to_dict()
+    return lambda db_obj: serialize(db_obj, schema)
+
+
+def ndjson_stream(
+        crud: CRUDBase,
+        schema: typing.Optional[typing.Type[BaseModel]] = None,
+        batch_size: int = 1000,
+) -> typing.Iterator[bytes]:
+    """one json object per line, one chunk per batch"""
+    for rows in crud.iter_batches(batch_size, _row_to_dict(schema)):
+        yield b''.join(to_json(row) + b'\n' for row in rows)
+
+
+def csv_stream(
+        crud: CRUDBase,
+        schema: typing.Optional[typing.Type[BaseModel]] = None,
+        batch_size: int = 1000,
+) -> typing.Iterator[bytes]:
+    """csv with header, nested values are dumped as json"""
+    buffer = io.StringIO()
+    writer = None
+    for rows in crud.iter_batches(batch_size, _row_to_dict(schema)):
+        for row in rows:
+            if writer is None:
+                writer = csv.DictWriter(buffer, fieldnames=list(row))
+                writer.writeheader()
+            writer.writerow({
+                key: to_json(value).decode()
+                if isinstance(value, (dict, list)) else value
+                for key, value in row.items()
+            })
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
@@ -0,0 +1,264 @@
+"""import NDJSON or CSV uploads in batches"""
+import asyncio
+import csv
+import enum
+import io
+import json
+import queue
+import threading
+import typing
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from api.export import ExportFormat
+from crud.base import CRUDBase
+from db.session import commit_session
+from fastapi import Request
+from pony.orm import DBException, TransactionError
+from pydantic import BaseModel, ValidationError
+
+# same file formats as export
+ImportFormat = ExportFormat
+
+
+class ErrorPolicy(str, enum.Enum):
+    """what to do with invalid rows"""
+    # skip invalid rows, only count them
+    skip = 'skip'
+    # stop at the first invalid row, committed batches are kept
+    abort = 'abort'
+    # skip invalid rows and report them, up to max_errors
+    collect = 'collect'
+
+
+class _Rollback(Exception):
+    """raised in the db_session of a batch to roll it back"""
+
+
+class _QueueReader(io.RawIOBase):
+    """file of chunks put in a queue, None is the end"""
+
+    def __init__(self, chunks: queue.Queue):
+        super().__init__()
+        self._chunks = chunks
+        self._buffer = b''
+        self._cancelled = threading.Event()
+
+    def readable(self) -> bool:
+        return True
+
+    def cancel(self):
+        """the body will not be complete, the next read raises"""
+        self._cancelled.set()
+        try:
+            # wake up the reader waiting for an empty queue
+            self._chunks.put_nowait(None)
+        except queue.Full:
+            pass
+
+    def readinto(self, buffer) -> int:
+        while not self._buffer:
+            chunk = self._chunks.get()
+            if self._cancelled.is_set():
+                raise ConnectionAbortedError('request body is incomplete')
+            if chunk is None:
+                return 0
+            self._buffer = chunk
+        size = min(len(buffer), len(self._buffer))
+        buffer[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
+
+def iter_ndjson(text: typing.TextIO) -> Iterator[Tuple[int, Any]]:
+    """(line number, object) of each non empty line"""
+    for line_no, line in enumerate(text, 1):
+        if not line.strip():
+            continue
+        try:
+            yield line_no, json.loads(line)
+        except ValueError as e:
+            yield line_no, e
+
+
+def iter_csv(text: typing.TextIO) -> Iterator[Tuple[int, Any]]:
+    """(line number, dict) of each row, empty values are left out"""
+    reader = csv.DictReader(text)
+    for row in reader:
+        yield reader.line_num, {
+            key: value for key, value in row.items()
+            if key is not None and value not in ('', None)
+        }
+
+
+class Importer:
+    """
+    validate rows by schema and create them by `CRUDBase.bulk_create`,
+    each batch in its own db_session, so a batch is one transaction.
+    Only one batch of rows is in memory.
+    """
+
+    def __init__(
+            self,
+            crud: CRUDBase,
+            schema: typing.Type[BaseModel],
+            batch_size: int = 1000,
+            policy: ErrorPolicy = ErrorPolicy.collect,
+            max_errors: int = 1000,
+    ):
+        self.crud = crud
+        self.schema = schema
+        self.batch_size = batch_size
+        self.policy = policy
+        self.max_errors = max_errors
+        self.report: Dict[str, Any] = {
+            'rows': 0,
+            'created': 0,
+            'invalid': 0,
+            'aborted': False,
+            'batches': [],
+            'errors': [],
+        }
+
+    def _error(self, line_no: Optional[int], detail: Any):
+        self.report['invalid'] += 1
+        if (self.policy == ErrorPolicy.collect
+                and len(self.report['errors']) < self.max_errors):
+            self.report['errors'].append({'line': line_no, 'detail': detail})
+
+    def _validate(
+            self, rows: List[Tuple[int, Any]]
+    ) -> Tuple[List[Tuple[int, BaseModel]], Optional[Tuple[int, Any]]]:
+        """valid rows, and the first error if policy is abort"""
+        valid = []
+        for line_no, row in rows:
+            if isinstance(row, Exception):
+                detail = f'invalid row: {row}'
+            elif not isinstance(row, dict):
+                detail = 'row should be an object'
+            else:
+                try:
+                    valid.append((line_no, self.schema.parse_obj(row)))
+                    continue
+                except ValidationError as e:
+                    detail = e.errors()
+            if self.policy == ErrorPolicy.abort:
+                return valid, (line_no, detail)
+            self._error(line_no, detail)
+        return valid, None
+
+    def _insert(self, batch_no: int, rows: List[Tuple[int, Any]]):
+        valid, abort = self._validate(rows)
+        summary = {
+            'batch': batch_no,
+            'first_line': rows[0][0],
+            'last_line': rows[-1][0],
+            'rows': len(rows),
+            'created': 0,
+            'invalid': len(rows) - len(valid),
+        }
+        self.report['rows'] += len(rows)
+        self.report['batches'].append(summary)
+        if abort is not None:
+            # rows after the invalid one are not validated
+            summary['invalid'] = 1
+            self._error(*abort)
+            self.report['aborted'] = True
+            return
+        try:
+            with commit_session():
+                results = self.crud.bulk_create(
+                    [data for _, data in valid], self.batch_size)
+                failed = [x for x in results if x['status'] != 'created']
+                if failed and self.policy == ErrorPolicy.abort:
+                    # the whole batch, like an invalid row,
+                    # its cache invalidation and events are dropped too
+                    raise _Rollback()
+        except _Rollback:
+            pass
+        except (DBException, TransactionError) as e:
+            # e.g. a unique constraint at flush or commit,
+            # the batch is rolled back, all of its rows failed
+            results = failed = [
+                {'index': index, 'id': None, 'status': 'error',
+                 'detail': f'database error: {e}'}
+                for index in range(len(valid))
+            ]
+        summary['invalid'] += len(failed)
+        for result in failed:
+            self._error(valid[result['index']][0], result['detail'])
+            if self.policy == ErrorPolicy.abort:
+                self.report['aborted'] = True
+                return
+        summary['created'] = len(results) - len(failed)
+        self.report['created'] += summary['created']
+
+    def run(self, rows: Iterator[Tuple[int, Any]]) -> Dict[str, Any]:
+        """import rows of `iter_ndjson` / `iter_csv`"""
+        batch = []
+        batch_no = 0
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= self.batch_size:
+                batch_no += 1
+                self._insert(batch_no, batch)
+                batch = []
+                if self.report['aborted']:
+                    return self.report
+        if batch:
+            self._insert(batch_no + 1, batch)
+        return self.report
+
+    def run_file(
+            self, file: typing.BinaryIO, file_format: ImportFormat
+    ) -> Dict[str, Any]:
+        """import a binary file, utf-8 with or without BOM"""
+        text = io.TextIOWrapper(file, encoding='utf-8-sig', newline='')
+        parse = iter_csv if file_format == ImportFormat.csv else iter_ndjson
+        try:
+            return self.run(parse(text))
+        except (UnicodeDecodeError, csv.Error) as e:
+            self.report['aborted'] = True
+            self._error(None, f'invalid file: {e}')
+            return self.report
+
+    async def run_request(
+            self,
+            request: Request,
+            file_format: ImportFormat,
+            max_chunks: int = 16,
+    ) -> Dict[str, Any]:
+        """
+        import request body while it is received, at most max_chunks
+        received chunks wait for the import thread
+        """
+        chunks: queue.Queue = queue.Queue(max_chunks)
+        reader = _QueueReader(chunks)
+        worker = asyncio.get_running_loop().run_in_executor(
+            None, self.run_file, io.BufferedReader(reader), file_format,
+        )
+        try:
+            async for chunk in request.stream():
+                if not chunk:
+                    continue
+                if not await self._put(chunks, chunk, worker):
+                    break
+        except BaseException:
+            # e.g. client disconnected, stop the import thread,
+            # committed batches are kept
+            reader.cancel()
+            worker.add_done_callback(
+                lambda future: future.cancelled() or future.exception())
+            raise
+        await self._put(chunks, None, worker)
+        return await worker
+
+    @staticmethod
+    async def _put(chunks: queue.Queue, chunk, worker: asyncio.Future) -> bool:
+        """wait for space in queue, False if the import is done (aborted)"""
+        while not worker.done():
+            try:
+                chunks.put_nowait(chunk)
+                return True
+            except queue.Full:
+                await asyncio.wait((worker,), timeout=0.005)
+        return False
@@ -0,0 +1,43 @@
+"""metrics api and middleware"""
+import time
+
+from fastapi import APIRouter, Request
+from fastapi.responses import PlainTextResponse
+from utils.metrics import metrics, observe_request, start_request
+
+router = APIRouter()
+
+# charset is added by PlainTextResponse
+CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+
+async def metrics_middleware(request: Request, call_next):
+    """
+    record latency, count and in flight requests of each route,
+    route is the path template so `/todo/1` and `/todo/2` share one label
+    """
+    timings = start_request()
+    in_flight = metrics.gauge('http_requests_in_flight')
+    in_flight.inc()
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        in_flight.dec()
+        route = request.scope.get('route')
+        observe_request(
+            getattr(route, 'path', 'unmatched'),
+            request.method,
+            status,
+            time.perf_counter() - start,
+            timings,
+        )
+
+
+@router.get('/metrics', include_in_schema=False)
+async def get_metrics():
+    """metrics in prometheus text format"""
+    return PlainTextResponse(metrics.render(), media_type=CONTENT_TYPE)
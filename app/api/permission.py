@@ -1,9 +1,37 @@
 """permission module"""
+from functools import lru_cache
+
 from fastapi import Depends, Request, status
 from fastapi_contrib.auth.permissions import BasePermission
 from fastapi_contrib.permissions import PermissionsDependency
 
 
+def get_user(request: Request):
+    """user of AuthenticationMiddleware, None if not authenticated"""
+    user = request.scope.get('user')
+    if user is None or not user.is_authenticated:
+        return None
+    return user
+
+
+class CachedPermissionsDependency(PermissionsDependency):
+    """check each permission class once per request"""
+
+    def __call__(self, request: Request):
+        checked = request.scope.setdefault('checked_permissions', set())
+        for permission_class in self.permissions_classes:
+            if permission_class in checked:
+                continue
+            permission_class(request=request)
+            checked.add(permission_class)
+
+
+@lru_cache(maxsize=None)
+def _permissions_dependency(permissions: tuple) -> CachedPermissionsDependency:
+    # the same instance, so FastAPI runs it once per request
+    return CachedPermissionsDependency(list(permissions))
+
+
 def set_permissions(*args):
     """
     set permission
@@ -18,10 +46,7 @@ def set_permissions(*args):
         )
     ```
     """
-    permissions = []
-    for el in args:
-        permissions.append(el)
-    return [Depends(PermissionsDependency(permissions))]
+    return [Depends(_permissions_dependency(args))]
 
 
 class JWTRequiredPermission(BasePermission):
@@ -30,9 +55,9 @@ class JWTRequiredPermission(BasePermission):
     status_code = status.HTTP_401_UNAUTHORIZED
     error_code = status.HTTP_401_UNAUTHORIZED
 
-    def has_required_permisions(self, request: Request) -> bool:
+    def has_required_permissions(self, request: Request) -> bool:
         """check permission"""
-        return request.user is not None
+        return get_user(request) is not None
 
 
 class SuperAdminPermission(BasePermission):
@@ -41,17 +66,18 @@ class SuperAdminPermission(BasePermission):
     status_code = status.HTTP_403_FORBIDDEN
     error_code = status.HTTP_403_FORBIDDEN
 
-    def has_required_permisions(self, request: Request) -> bool:
+    def has_required_permissions(self, request: Request) -> bool:
         """check permission"""
-        user = request.user
-        return user and user.is_super_admin
+        user = get_user(request)
+        return bool(user and user.is_super_admin)
 
 
 class HighestPermission(BasePermission):
     """最高權限"""
 
-    def has_required_permisions(self, request: Request) -> bool:
+    def has_required_permissions(self, request: Request) -> bool:
         """權限判斷"""
-        if not request.user:
+        user = get_user(request)
+        if not user:
             return True
-        return request.user.is_super_admin
+        return user.is_super_admin
@@ -0,0 +1,162 @@
+"""response cache of list routes"""
+import asyncio
+import hashlib
+import typing
+from functools import lru_cache
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+from urllib.parse import urlencode
+
+import config
+from crud.version import version_stamps
+from fastapi import Request
+from pony.orm.core import EntityMeta
+from pydantic import BaseModel
+from utils.cache import CacheBackend, SQLiteBackend, TTLCache
+from utils.pony_pydantic import get_prefetch
+
+
+class ResponseCache:
+    """
+    cache of response bodies of Get All
+
+    The key is scheme and host (`next` / `previous` links of the body
+    are absolute URLs of them), route, version stamps of the entity (and
+    the entities included by response_model), sorted query string and,
+    with per_user, the user. CRUDBase writes bump the stamps, so a write
+    makes the next request miss and old entries are evicted by LRU / ttl.
+    Concurrent misses of one key in a process are computed once.
+
+    ```
+        add_crud_route_factory(
+            ...,
+            response_cache=ResponseCache(maxsize=1000, ttl=30),
+            # or on disk, shared by workers on the same machine
+            # response_cache=ResponseCache(
+            #     backend=SQLiteBackend('/tmp/todo-pages.db', maxsize=10000)),
+        )
+    ```
+    """
+
+    def __init__(
+            self,
+            maxsize: int = 1024,
+            ttl: Optional[float] = 30,
+            backend: Optional[CacheBackend] = None,
+            per_user: bool = False,
+    ):
+        self.backend = backend or TTLCache(maxsize=maxsize, ttl=ttl)
+        self.ttl = ttl
+        self.per_user = per_user
+        self._pending: Dict[str, asyncio.Future] = {}
+
+    @staticmethod
+    def related_models(
+            model: EntityMeta,
+            schema: Optional[typing.Type[BaseModel]] = None,
+    ) -> Tuple[EntityMeta, ...]:
+        """model and the models nested in schema by `include=`"""
+        models = [model]
+        if schema is not None:
+            for attr in get_prefetch(model, schema):
+                if attr.py_type not in models:
+                    models.append(attr.py_type)
+        return tuple(models)
+
+    @staticmethod
+    def user_key(request: Request) -> str:
+        """identity of authenticated user, else hash of Authorization header"""
+        user = request.scope.get('user')
+        identity = getattr(user, 'identity', None)
+        if identity:
+            return str(identity)
+        authorization = request.headers.get('Authorization', '')
+        if not authorization:
+            return ''
+        return hashlib.blake2b(authorization.encode(), digest_size=12).hexdigest()
+
+    def make_key(
+            self,
+            request: Request,
+            models: typing.Sequence[EntityMeta],
+    ) -> str:
+        """key of request, changed by writes of models"""
+        route = request.scope.get('route')
+        query = urlencode(sorted(
+            (key, value)
+            for key, value in request.query_params.multi_items() if value != ''
+        ))
+        parts = [
+            f'{request.url.scheme}://{request.url.netloc}',
+            getattr(route, 'path', request.url.path),
+            ','.join(version_stamps.table(model) for model in models),
+            query,
+        ]
+        if self.per_user:
+            parts.append(self.user_key(request))
+        return '|'.join(parts)
+
+    async def get_or_set(
+            self,
+            key: str,
+            compute: Callable[[], Awaitable[Any]],
+    ) -> Tuple[Any, bool]:
+        """
+        cached value of key, or compute and cache it
+
+        Returns:
+            (value, hit)
+        """
+        value = self.backend.get(key)
+        if value is not None:
+            return value, True
+        pending = self._pending.get(key)
+        if pending is not None:
+            # another request is computing it, errors are not shared
+            try:
+                return await asyncio.shield(pending), True
+            except asyncio.CancelledError:
+                if not pending.cancelled():
+                    raise
+            except Exception:  # pylint:disable=broad-except
+                pass
+        future = asyncio.get_running_loop().create_future()
+        self._pending[key] = future
+        try:
+            value = await compute()
+        except Exception as e:
+            future.set_exception(e)
+            # mark it retrieved, nobody may wait for it
+            future.exception()
+            raise
+        except BaseException:
+            future.cancel()
+            raise
+        finally:
+            if self._pending.get(key) is future:
+                del self._pending[key]
+        self.backend.set(key, value, ttl=self.ttl)
+        future.set_result(value)
+        return value, False
+
+    def stats(self) -> Dict[str, int]:
+        """hit / miss / eviction counters of backend"""
+        return self.backend.stats()
+
+
+@lru_cache()
+def get_response_cache() -> Optional[ResponseCache]:
+    """response cache of config, None when RESPONSE_CACHE_TTL is 0"""
+    if config.RESPONSE_CACHE_TTL <= 0:
+        return None
+    backend = None
+    if config.RESPONSE_CACHE_PATH:
+        backend = SQLiteBackend(
+            config.RESPONSE_CACHE_PATH,
+            maxsize=config.RESPONSE_CACHE_SIZE,
+            ttl=config.RESPONSE_CACHE_TTL,
+        )
+    return ResponseCache(
+        maxsize=config.RESPONSE_CACHE_SIZE,
+        ttl=config.RESPONSE_CACHE_TTL,
+        backend=backend,
+    )
@@ -3,8 +3,12 @@ from fastapi import APIRouter
 from db import schemas, models
 from crud import base
 from api.api_crud import add_crud_route_factory
+from api.response_cache import get_response_cache
+from crud.changes import get_change_hub
+from db.routing import get_db_router
 
-crud = base.CRUDBase(models.Todo)
+crud = base.CRUDBase(
+    models.Todo, db_router=get_db_router(), change_hub=get_change_hub())
 router = APIRouter(
     prefix='/todo',
     tags=['todo']
@@ -16,5 +20,11 @@ add_crud_route_factory(
     create_schema=schemas.TodoCreate,
     update_schema=schemas.TodoUpdate,
     response_model=schemas.Todo,
-    path_suffix=''
+    path_suffix='',
+    import_route=True,
+    filterable=True,
+    searchable=True,
+    change_feed=crud.change_hub is not None,
+    response_cache=get_response_cache(),
+    aggregate_route=True,
 )
@@ -1,7 +1,16 @@
 """api router"""
-from api.v1.endpoints import user, todo
 from fastapi import APIRouter
 
-api_router = APIRouter()
-api_router.include_router(user.router)
-api_router.include_router(todo.router)
+
+def get_api_router() -> APIRouter:
+    """
+    api router of v1, call it after `models.init_db()`,
+    endpoints build their routes from mapped entities when imported
+    """
+    # pylint:disable=import-outside-toplevel
+    from api.v1.endpoints import todo, user
+
+    api_router = APIRouter()
+    api_router.include_router(user.router)
+    api_router.include_router(todo.router)
+    return api_router
@@ -0,0 +1,105 @@
+"""app config, read from environment variables"""
+import os
+
+# sqlite file of models.db, empty for app/db/demo.db
+DB_FILENAME = os.environ.get('DB_FILENAME', '')
+# create missing tables in models.init_db
+DB_CREATE_TABLES = os.environ.get('DB_CREATE_TABLES', 'true').lower() == 'true'
+
+# inline: run crud in event loop with the db_session of middleware
+# threadpool: run crud in DBExecutor, each call has its own db_session,
+#     hand-written routes still get the db_session of middleware
+DB_EXECUTION_MODE = os.environ.get('DB_EXECUTION_MODE', 'inline')
+DB_THREAD_POOL_SIZE = int(os.environ.get('DB_THREAD_POOL_SIZE', '8'))
+# calls waiting for a thread, more calls will get 503
+DB_THREAD_QUEUE_SIZE = int(os.environ.get('DB_THREAD_QUEUE_SIZE', '64'))
+
+# apply concurrent writes of routes in one transaction, see WriteCoordinator
+DB_GROUP_COMMIT = os.environ.get('DB_GROUP_COMMIT', 'false').lower() == 'true'
+# wait at most n ms, or n writes, for more writes of a batch
+DB_GROUP_COMMIT_WINDOW_MS = float(os.environ.get('DB_GROUP_COMMIT_WINDOW_MS', '2'))
+DB_GROUP_COMMIT_MAX_BATCH = int(os.environ.get('DB_GROUP_COMMIT_MAX_BATCH', '64'))
+
+# sqlite: read by read only connections of another pony Database,
+# empty: read and write by models.db
+DB_READER = os.environ.get('DB_READER', '')
+# seconds to read a table from primary after writing it
+DB_READ_YOUR_WRITES = float(os.environ.get('DB_READ_YOUR_WRITES', '1'))
+DB_SQLITE_WAL = os.environ.get('DB_SQLITE_WAL', 'true').lower() == 'true'
+
+# sqlite file to share version stamps (ETag) between workers,
+# empty to keep them in process (server.py with more than one worker
+# uses a new file in the temp directory)
+VERSION_STAMP_PATH = os.environ.get('VERSION_STAMP_PATH', '')
+
+# seconds to cache Get All responses, 0 to disable
+RESPONSE_CACHE_TTL = float(os.environ.get('RESPONSE_CACHE_TTL', '0'))
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', '1024'))
+# sqlite file to share cached responses between workers (with
+# VERSION_STAMP_PATH), empty to keep them in process
+RESPONSE_CACHE_PATH = os.environ.get('RESPONSE_CACHE_PATH', '')
+
+# secret of HS256 bearer tokens, empty to disable authentication
+AUTH_SECRET = os.environ.get('AUTH_SECRET', '')
+AUTH_TOKEN_TTL = float(os.environ.get('AUTH_TOKEN_TTL', '3600'))
+# seconds to keep verified tokens and loaded users
+AUTH_CACHE_TTL = float(os.environ.get('AUTH_CACHE_TTL', '60'))
+AUTH_CACHE_SIZE = int(os.environ.get('AUTH_CACHE_SIZE', '10000'))
+# sqlite file to share revoked tokens between workers,
+# empty to keep them in process
+AUTH_REVOCATION_PATH = os.environ.get('AUTH_REVOCATION_PATH', '')
+
+# limit running requests, reads (GET / HEAD) and writes separately,
+# requests waiting more than ADMISSION_QUEUE_TIMEOUT seconds
+# or over a full queue get 503
+ADMISSION_CONTROL = os.environ.get('ADMISSION_CONTROL', 'false').lower() == 'true'
+ADMISSION_READ_LIMIT = int(os.environ.get('ADMISSION_READ_LIMIT', '64'))
+ADMISSION_READ_QUEUE = int(os.environ.get('ADMISSION_READ_QUEUE', '128'))
+ADMISSION_WRITE_LIMIT = int(os.environ.get('ADMISSION_WRITE_LIMIT', '16'))
+ADMISSION_WRITE_QUEUE = int(os.environ.get('ADMISSION_WRITE_QUEUE', '32'))
+ADMISSION_QUEUE_TIMEOUT = float(os.environ.get('ADMISSION_QUEUE_TIMEOUT', '1'))
+# requests per second of each user or ip, 0 to disable, 429 over it
+RATE_LIMIT = float(os.environ.get('RATE_LIMIT', '0'))
+RATE_LIMIT_BURST = float(os.environ.get('RATE_LIMIT_BURST', '0'))
+
+# publish writes of routes to `/changes` (SSE / WebSocket)
+CHANGE_FEED = os.environ.get('CHANGE_FEED', 'false').lower() == 'true'
+# events kept to resume from, and events queued for each subscriber
+CHANGE_FEED_BUFFER = int(os.environ.get('CHANGE_FEED_BUFFER', '1000'))
+CHANGE_FEED_QUEUE_SIZE = int(os.environ.get('CHANGE_FEED_QUEUE_SIZE', '100'))
+# directory of unix sockets to send events between workers,
+# empty to keep them in process
+CHANGE_FEED_SOCKET_DIR = os.environ.get('CHANGE_FEED_SOCKET_DIR', '')
+
+# seconds to cache results of `/aggregate`, 0 to disable,
+# written groups are recomputed on the next read
+AGGREGATE_CACHE_TTL = float(os.environ.get('AGGREGATE_CACHE_TTL', '300'))
+
+# pre-fork server of `python server.py`, 0 workers is the CPU count
+SERVER_HOST = os.environ.get('SERVER_HOST', '0.0.0.0')
+SERVER_PORT = int(os.environ.get('SERVER_PORT', '5000'))
+SERVER_WORKERS = int(os.environ.get('SERVER_WORKERS', '0'))
+# restart a worker after n requests (plus random 0 ~ jitter),
+# or when its RSS is over n MB, 0 to disable
+SERVER_MAX_REQUESTS = int(os.environ.get('SERVER_MAX_REQUESTS', '0'))
+SERVER_MAX_REQUESTS_JITTER = int(os.environ.get('SERVER_MAX_REQUESTS_JITTER', '0'))
+SERVER_MAX_RSS_MB = float(os.environ.get('SERVER_MAX_RSS_MB', '0'))
+# seconds for workers to finish running requests when stopping
+SERVER_GRACEFUL_TIMEOUT = int(os.environ.get('SERVER_GRACEFUL_TIMEOUT', '30'))
+
+# record request metrics, served at /metrics
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower() == 'true'
+
+# sync: loguru writes the log file in the calling thread
+# async: records are queued and written by a background thread
+LOG_MODE = os.environ.get('LOG_MODE', 'sync')
+LOG_DIR = os.environ.get('LOG_DIR', './logs')
+# text or json (one object per line)
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text')
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', '10000'))
+# drop: drop records when the queue is full, block: wait for the writer
+LOG_QUEUE_POLICY = os.environ.get('LOG_QUEUE_POLICY', 'drop')
+# find the caller frame of stdlib records, costs a frame walk per record
+LOG_CALLER = os.environ.get('LOG_CALLER', 'true').lower() == 'true'
+# ratio of access logs (uvicorn.access) to keep, 0 ~ 1
+LOG_ACCESS_SAMPLE_RATE = float(os.environ.get('LOG_ACCESS_SAMPLE_RATE', '1'))
@@ -0,0 +1,308 @@
+"""
+group by aggregation in SQL, cached and refreshed by groups
+
+```
+    crud.aggregate(group_by=['user'], metrics=['count', 'max:id'])
+    # [{'user': 1, 'count': 2, 'max_id': 5}, {'user': None, ...}]
+```
+
+Writes of CRUDBase mark the groups of written values dirty after they
+commit, the next read recomputes only those groups by `WHERE attr IN (...)`
+on the index of the `_filterable_` attribute, writes of unknown rows
+recompute all.
+
+The cache is in one process. With a shared `version_stamps` backend
+(VERSION_STAMP_PATH) each result keeps the table stamp it was computed at,
+and is recomputed fully once the stamp changed, as writes of other workers
+are not marked here. The in-process stamps only change by writes of this
+process, which mark their groups.
+"""
+import decimal
+import threading
+import time
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence, Set, Tuple
+
+from pony import orm
+from crud.version import version_stamps
+from pony.orm.core import Attribute, EntityMeta, Query
+from utils.pony_filter import Filter, FilterError, apply_filters
+
+FUNCTIONS = ('count', 'min', 'max', 'sum', 'avg')
+NUMBERS = (int, float, decimal.Decimal)
+# aggregate functions of pony for the query text
+_GLOBALS = {name: getattr(orm, name) for name in FUNCTIONS}
+# recompute everything when more group values than this are dirty
+MAX_DIRTY_VALUES = 100
+
+
+class Metric(NamedTuple):
+    """aggregate function of an attribute, `count` has no attribute"""
+    function: str
+    attr: Optional[str]
+
+    @property
+    def key(self) -> str:
+        return self.function if self.attr is None else f'{self.function}_{self.attr}'
+
+
+def _attr(entity: EntityMeta, name: str) -> Attribute:
+    attr = entity._adict_.get(name)  # pylint:disable=protected-access
+    if attr is None or attr.is_collection:
+        raise FilterError(f'unknown attribute: {name}')
+    return attr
+
+
+def _is_relation(attr: Attribute) -> bool:
+    return isinstance(attr.py_type, (EntityMeta, str))
+
+
+def parse_group_by(entity: EntityMeta, raw: Optional[str]) -> Tuple[str, ...]:
+    """`user,name` to attribute names, only `_filterable_` ones (indexed)"""
+    names = tuple(x.strip() for x in (raw or '').split(',') if x.strip())
+    filterable = getattr(entity, '_filterable_', ())
+    for name in names:
+        _attr(entity, name)
+        if name not in filterable:
+            raise FilterError(f'cannot group by {name}')
+    if len(set(names)) != len(names):
+        raise FilterError('duplicated group by attribute')
+    return names
+
+
+def parse_metrics(entity: EntityMeta, raw: Optional[str]) -> Tuple[Metric, ...]:
+    """`count,max:id,avg:score` to metrics, default count"""
+    metrics = []
+    for item in (raw or 'count').split(','):
+        item = item.strip()
+        if not item:
+            continue
+        function, _, name = item.partition(':')
+        if function not in FUNCTIONS:
+            raise FilterError(
+                f'unknown function: {function}, should be in {", ".join(FUNCTIONS)}')
+        if function == 'count':
+            if name:
+                raise FilterError('count has no attribute')
+            metrics.append(Metric('count', None))
+            continue
+        if not name:
+            raise FilterError(f'{function} needs an attribute, e.g. {function}:id')
+        attr = _attr(entity, name)
+        if _is_relation(attr):
+            raise FilterError(f'cannot aggregate relation: {name}')
+        if function in ('sum', 'avg') and attr.py_type not in NUMBERS:
+            raise FilterError(f'{function} of {name} is not a number')
+        metrics.append(Metric(function, name))
+    if not metrics:
+        raise FilterError('no metrics')
+    return tuple(dict.fromkeys(metrics))
+
+
+def _expression(entity: EntityMeta, name: str) -> str:
+    # names are checked attributes, safe to be in the query text
+    attr = _attr(entity, name)
+    return f'o.{name}.id' if _is_relation(attr) else f'o.{name}'
+
+
+def run_aggregate(
+        query: Query,
+        group_by: Sequence[str],
+        metrics: Sequence[Metric],
+        dirty: Optional[Dict[str, Set[Any]]] = None,
+) -> List[Dict[str, Any]]:
+    """
+    aggregate rows of query in one SQL,
+    dirty limits it to groups having any of these values
+    """
+    entity = query._translator.expr_type  # pylint:disable=protected-access
+    columns = [_expression(entity, name) for name in group_by] + [
+        'count(o)' if metric.function == 'count'
+        else f'{metric.function}({_expression(entity, metric.attr)})'
+        for metric in metrics
+    ]
+    condition = ''
+    values = {}
+    if dirty:
+        parts = []
+        for i, (name, group_values) in enumerate(dirty.items()):
+            expression = _expression(entity, name)
+            if None in group_values:
+                # NULL is never IN a list
+                parts.append(f'o.{name} is None')
+            values[f'v{i}'] = [x for x in group_values if x is not None]
+            if values[f'v{i}']:
+                parts.append(f'{expression} in v{i}')
+        condition = ' if ' + ' or '.join(parts)
+    text = f'({", ".join(columns)}) for o in q{condition}'
+    rows = orm.select(text, _GLOBALS, {'q': query, **values})[:]
+    keys = list(group_by) + [metric.key for metric in metrics]
+    if len(keys) == 1:
+        rows = [(row,) for row in rows]
+    return [dict(zip(keys, row)) for row in rows]
+
+
+class _Entry:
+    """cached result of one aggregation"""
+
+    def __init__(self, expires: float, stamp: Optional[str]):
+        # None while the first computation is running
+        self.rows: Optional[List[Dict[str, Any]]] = None
+        self.expires = expires
+        self.stamp = stamp
+        self.dirty: Dict[str, Set[Any]] = {}
+        self.stale = False
+
+
+class AggregateCache:
+    """
+    aggregations of each entity by group by, metrics and filters
+
+    ```
+        rows, cached = aggregate_cache.get(
+            query, ('user',), metrics, filters_key, ttl=60)
+        aggregate_cache.touch(models.Todo, [{'user': 1}])  # after writing
+    ```
+    """
+
+    def __init__(self, maxsize: int = 256):
+        self.maxsize = maxsize
+        self._entries: Dict[str, Dict[tuple, _Entry]] = {}
+        self._lock = threading.Lock()
+        self.partial_refreshes = 0
+
+    def group_attrs(self, entity: EntityMeta) -> Optional[Set[str]]:
+        """
+        attributes grouped by cached aggregations, their values are touched,
+        None if no aggregation of entity is cached
+        """
+        entries = self._entries.get(entity.__name__)
+        if not entries:
+            return None
+        with self._lock:
+            return {name for key in entries for name in key[0]}
+
+    def get(
+            self,
+            query: Query,
+            group_by: Tuple[str, ...],
+            metrics: Tuple[Metric, ...],
+            filters: Sequence[Filter] = (),
+            ttl: Optional[float] = None,
+    ) -> Tuple[List[Dict[str, Any]], bool]:
+        """
+        aggregation of query filtered by filters
+
+        Args:
+            ttl: seconds to cache the result, None will not cache
+
+        Returns:
+            (rows sorted by group, is from cache without recomputing)
+        """
+        entity = query._translator.expr_type  # pylint:disable=protected-access
+        query = apply_filters(query, filters) if filters else query
+        if ttl is None:
+            rows = run_aggregate(query, group_by, metrics)
+            rows.sort(key=lambda row: _sort_key(row, group_by))
+            return rows, False
+        key = (group_by, metrics, tuple(
+            (name, op, tuple(value) if isinstance(value, list) else value)
+            for name, op, value in filters
+        ))
+        # read before computing, a write while computing changes it again
+        stamp = version_stamps.table(entity) if version_stamps.shared else None
+        now = time.monotonic()
+        dirty = None
+        with self._lock:
+            entries = self._entries.setdefault(entity.__name__, {})
+            entry = entries.get(key)
+            if (entry is None or entry.rows is None or entry.expires <= now
+                    or entry.stamp != stamp):
+                if entry is None and len(entries) >= self.maxsize:
+                    entries.pop(next(iter(entries)))
+                # registered before computing, so writes while computing
+                # mark it and the next read refreshes their groups
+                entry = _Entry(now + ttl, stamp)
+                entries[key] = entry
+            else:
+                if not entry.stale and not entry.dirty:
+                    return entry.rows, True
+                if not entry.stale and group_by:
+                    dirty = entry.dirty
+                # writes while computing mark the entry again
+                entry.dirty = {}
+                entry.stale = False
+        try:
+            if dirty:
+                rows = self._merge(
+                    entry.rows, run_aggregate(query, group_by, metrics, dirty),
+                    group_by, dirty,
+                )
+                self.partial_refreshes += 1
+            else:
+                rows = run_aggregate(query, group_by, metrics)
+                rows.sort(key=lambda row: _sort_key(row, group_by))
+        except BaseException:
+            # marks of dirty groups are gone
+            entry.stale = True
+            raise
+        with self._lock:
+            # else replaced by a newer computation
+            if self._entries.get(entity.__name__, {}).get(key) is entry:
+                entry.rows = rows
+        return rows, False
+
+    @staticmethod
+    def _merge(
+            rows: List[Dict[str, Any]],
+            fresh: List[Dict[str, Any]],
+            group_by: Sequence[str],
+            dirty: Dict[str, Set[Any]],
+    ) -> List[Dict[str, Any]]:
+        kept = [
+            row for row in rows
+            if not any(row[name] in dirty.get(name, ()) for name in group_by)
+        ]
+        merged = kept + fresh
+        merged.sort(key=lambda row: _sort_key(row, group_by))
+        return merged
+
+    def touch(self, entity: EntityMeta, values: Sequence[Dict[str, Any]]):
+        """
+        mark groups of written values dirty
+
+        Args:
+            values: values of group attributes of each written row,
+                before and after writing
+        """
+        with self._lock:
+            for key, entry in self._entries.get(entity.__name__, {}).items():
+                group_by = key[0]
+                if not group_by:
+                    entry.stale = True
+                    continue
+                if any(name not in row for row in values for name in group_by):
+                    # cached after the values were read
+                    entry.dirty = {}
+                    entry.stale = True
+                    continue
+                for row in values:
+                    for name in group_by:
+                        entry.dirty.setdefault(name, set()).add(row[name])
+                if sum(len(x) for x in entry.dirty.values()) > MAX_DIRTY_VALUES:
+                    entry.dirty = {}
+                    entry.stale = True
+
+    def invalidate(self, entity: EntityMeta):
+        """recompute every aggregation of entity"""
+        with self._lock:
+            for entry in self._entries.get(entity.__name__, {}).values():
+                entry.dirty = {}
+                entry.stale = True
+
+
+def _sort_key(row: Dict[str, Any], group_by: Sequence[str]) -> tuple:
+    # None first, then values of the same type
+    return tuple((row[name] is not None, row[name]) for name in group_by)
+
+
+aggregate_cache = AggregateCache()
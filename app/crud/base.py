@@ -1,22 +1,48 @@
 """Base crud"""
+import functools
 import typing
 from typing import Any, Dict, Generic, List, Optional, Type, TypeVar, Union
 
+from crud.aggregate import Metric, aggregate_cache
+from crud.cache import EntityCache
+from crud.changes import ChangeHub
+from crud.count import count_cache
+from crud.projection import project, to_dicts
+from crud.search import get_search_index
+from crud.version import version_stamps
 from db import models
+from db.routing import DBRouter
+from db.session import after_commit
 from fastapi import HTTPException
-from pony.orm import flush
-from pony.orm.core import Query
+from pony.orm import db_session, flush, select
+from pony.orm.core import Entity, OrmError, Query
 from pydantic import BaseModel
+from utils.metrics import track_serialize
+from utils.pony_filter import Filter, apply_filters, apply_sort, parse_pk
+from utils.pony_pydantic import get_prefetch, serialize
 
 ModelType = TypeVar('ModelType', bound=models.db.Entity)
 CreateSchemaType = TypeVar('CreateSchemaType', bound=BaseModel)
 UpdateSchemaType = TypeVar('UpdateSchemaType', bound=BaseModel)
 
 
+def _plain(value: Any) -> Any:
+    return value.id if isinstance(value, Entity) else value
+
+
 class CRUDBase(Generic[ModelType, CreateSchemaType, UpdateSchemaType]):
     """CRUD base class"""
 
-    def __init__(self, model: Type[ModelType]):
+    # rows of each flush / SELECT ... IN / DELETE ... IN in bulk methods
+    bulk_chunk_size = 500
+
+    def __init__(
+            self,
+            model: Type[ModelType],
+            cache: Optional[EntityCache] = None,
+            db_router: Optional[DBRouter] = None,
+            change_hub: Optional[ChangeHub] = None,
+    ):
         """
         CRUD object with default methods to Create, Read, Update, Delete (CRUD).
 
@@ -24,12 +50,175 @@ class CRUDBase(Generic[ModelType, CreateSchemaType, UpdateSchemaType]):
 
         * `model`: A SQLAlchemy model class
         * `schema`: A Pydantic model (schema) class
+        * `cache`: cache of serialized entities used by `get(schema=...)`
+        * `db_router`: reads of `read_query` / `get(schema=...)` go to its readers
+        * `change_hub`: writes are published to it, see `crud.changes`
+
+        Attributes in `_searchable_` of model are kept in a full text index,
+        see `crud.search`.
         """
         self.model = model
+        self.cache = cache
+        self.db_router = db_router
+        self.change_hub = change_hub
+        self.search_index = get_search_index(model)
+
+    @property
+    def read_model(self) -> Type[ModelType]:
+        """entity to read, from a reader database of db_router if there is one"""
+        if self.db_router is None:
+            return self.model
+        return self.db_router.read_model(self.model)
+
+    def query(
+            self,
+            *args,
+            schema: Optional[Type[BaseModel]] = None,
+            fields: Optional[typing.Sequence[str]] = None,
+            filters: Optional[typing.Iterable[Filter]] = None,
+            sort: Optional[typing.Sequence[typing.Tuple[str, bool]]] = None,
+            **kwargs
+    ) -> Query:
+        """
+        query data of primary, entities can be written (e.g. `update_by_query`)
+
+        relations of `include=` in schema are prefetched,
+        one query for each relation instead of one for each row,
+        leave schema out for `Pagination.page`, which prefetches them.
+        If fields is given, only these columns are selected
+        and rows are tuples in order of fields, see `crud.projection`.
+        filters and sort are parsed by `utils.pony_filter`.
+        """
+        return self._select(
+            self.model, *args, schema=schema, fields=fields,
+            filters=filters, sort=sort, **kwargs)
+
+    def read_query(
+            self,
+            *args,
+            schema: Optional[Type[BaseModel]] = None,
+            fields: Optional[typing.Sequence[str]] = None,
+            filters: Optional[typing.Iterable[Filter]] = None,
+            sort: Optional[typing.Sequence[typing.Tuple[str, bool]]] = None,
+            **kwargs
+    ) -> Query:
+        """
+        `query` of `read_model` for responses,
+        entities may be of a reader database, do not write them
+        """
+        return self._select(
+            self.read_model, *args, schema=schema, fields=fields,
+            filters=filters, sort=sort, **kwargs)
+
+    @staticmethod
+    def _select(
+            model: Type[ModelType],
+            *args,
+            schema: Optional[Type[BaseModel]] = None,
+            fields: Optional[typing.Sequence[str]] = None,
+            filters: Optional[typing.Iterable[Filter]] = None,
+            sort: Optional[typing.Sequence[typing.Tuple[str, bool]]] = None,
+            **kwargs
+    ) -> Query:
+        if fields:
+            # pony can not select from a query filtered by keyword arguments
+            query = model.select(*args)
+            for name, value in kwargs.items():
+                query = query.filter(lambda o: getattr(o, name) == value)
+        else:
+            query = model.select(*args, **kwargs)
+        if filters:
+            query = apply_filters(query, filters)
+        query = apply_sort(query, model, sort)
+        if fields:
+            return project(query, fields)
+        if schema is not None:
+            prefetch = get_prefetch(model, schema)
+            if prefetch:
+                query = query.prefetch(*prefetch)
+        return query
+
+    def search(
+            self,
+            text: str,
+            offset: int = 0,
+            limit: int = 10,
+            schema: Optional[Type[BaseModel]] = None,
+    ) -> typing.Tuple[List[ModelType], int]:
+        """
+        entities matching words of text in `_searchable_` attributes,
+        ranked by relevance, and the total count of matches.
+        Entities are read from `read_model` like `read_query`.
+        """
+        if self.search_index is None or not self.search_index.available:
+            raise HTTPException(
+                status_code=501, detail='Full text search is not available')
+        model = self.read_model
+        ids, count = self.search_index.search(
+            text, offset, limit,
+            database=model._database_,  # pylint:disable=protected-access
+        )
+        if not ids:
+            return [], count
+        query = model.select(lambda o: o.id in ids)
+        if schema is not None:
+            prefetch = get_prefetch(model, schema)
+            if prefetch:
+                query = query.prefetch(*prefetch)
+        rows = {db_obj.id: db_obj for db_obj in query}
+        return [rows[_id] for _id in ids if _id in rows], count
+
+    def aggregate(
+            self,
+            group_by: typing.Sequence[str],
+            metrics: typing.Sequence[Metric],
+            filters: Optional[typing.Iterable[Filter]] = None,
+            ttl: Optional[float] = None,
+    ) -> typing.Tuple[List[Dict[str, Any]], bool]:
+        """
+        rows of group values and metrics, computed by one GROUP BY query
+        of `read_model`, see `crud.aggregate`
+
+        Args:
+            group_by: attributes in `_filterable_`
+            metrics: parsed by `crud.aggregate.parse_metrics`
+            filters: parsed by `utils.pony_filter`
+            ttl: seconds to cache the result, groups written by this
+                CRUDBase are recomputed on the next read
+
+        Returns:
+            (rows, is from cache)
+        """
+        return aggregate_cache.get(
+            self.read_model.select(), tuple(group_by), tuple(metrics),
+            list(filters or ()), ttl=ttl,
+        )
+
+    def _group_values(
+            self, db_objs: typing.Iterable[ModelType]
+    ) -> List[Dict[str, Any]]:
+        """values of attributes grouped by cached aggregations"""
+        names = aggregate_cache.group_attrs(self.model)
+        if names is None:
+            return []
+        return [
+            {name: _plain(getattr(db_obj, name)) for name in names}
+            for db_obj in db_objs
+        ]
+
+    def _touch(self, db_objs: typing.Iterable[ModelType]):
+        """
+        mark aggregated groups of written entities dirty after commit,
+        values are read now (before and after writing)
+        """
+        values = self._group_values(db_objs)
+        if values:
+            after_commit(functools.partial(
+                aggregate_cache.touch, self.model, values))
 
-    def query(self, *args, **kwargs) -> Query:
-        """query data"""
-        return self.model.select(*args, **kwargs)
+    def _invalidate_aggregates(self):
+        """recompute aggregations after commit, written rows are unknown"""
+        after_commit(functools.partial(aggregate_cache.invalidate, self.model))
 
     def update_by_query(
             self,
@@ -38,20 +227,57 @@ class CRUDBase(Generic[ModelType, CreateSchemaType, UpdateSchemaType]):
             exclude: Optional[typing.List] = None,
             extra_data: Optional[dict] = None,
     ):
+        db_objs = []
         for db_obj in query:
             self.update_obj(db_obj, data, exclude, extra_data)
+            db_objs.append(db_obj)
         flush()
+        self.invalidate([db_obj.id for db_obj in db_objs])
+        self.publish('update', db_objs)
 
     def get(
             self, _id: Any,
-            extra_query: Optional[dict] = None
-    ) -> Optional[ModelType]:
-        """get data by id"""
+            extra_query: Optional[dict] = None,
+            schema: Optional[Type[BaseModel]] = None,
+            fields: Optional[typing.Sequence[str]] = None,
+    ) -> Optional[Union[ModelType, Dict[str, Any]]]:
+        """
+        get data by id
+
+        return serialized dict of `schema` if schema is given,
+        which is read through `self.cache` and `read_model`.
+        return dict of fields if fields is given, only these columns are selected.
+        Without both, the entity of primary is returned for writing.
+        """
+        if fields:
+            rows = self.read_query(
+                lambda o: o.id == _id, fields=fields, **(extra_query or {})
+            )[:1]
+            if not rows:
+                raise HTTPException(status_code=404, detail='Not found')
+            return to_dicts(rows, fields)[0]
+        use_cache = (
+            schema is not None and self.cache is not None and not extra_query
+        )
+        version = None
+        if use_cache:
+            # before reading, a write committed meanwhile changes it
+            version = self.cache.version(self.model, _id)
+            cached = self.cache.get(self.model, schema, _id, version)
+            if cached is not None:
+                return cached
         extra_query = extra_query or {}
-        ret = self.model.get(id=_id, **extra_query)
+        model = self.model if schema is None else self.read_model
+        ret = model.get(id=_id, **extra_query)
         if not ret:
             raise HTTPException(status_code=404, detail='Not found')
-        return ret
+        if schema is None:
+            return ret
+        with track_serialize():
+            data = serialize(ret, schema)
+        if use_cache:
+            self.cache.set(self.model, schema, _id, data, version)
+        return data
 
     def get_query_list(
             self,
@@ -59,19 +285,52 @@ class CRUDBase(Generic[ModelType, CreateSchemaType, UpdateSchemaType]):
         """get list data by query"""
         return list(self.query())
 
+    def iter_batches(
+            self,
+            batch_size: int = 1000,
+            transform: Optional[typing.Callable[[ModelType], Any]] = None,
+    ) -> typing.Iterator[List[Any]]:
+        """
+        iterate whole `read_query()` by id in batches,
+        each batch is fetched by `WHERE id > :last_id ORDER BY id LIMIT n`
+        in its own db_session, so memory will not grow with the table
+
+        Args:
+            batch_size: rows of each batch
+            transform: called in db_session for each row, e.g. serializer
+        """
+        last_id = None
+        while True:
+            with db_session:
+                query = self.read_query()
+                if last_id is not None:
+                    query = query.filter(lambda o: o.id > last_id)
+                rows = query.order_by(lambda o: o.id).limit(batch_size)[:]
+                if not rows:
+                    return
+                last_id = rows[-1].id
+                batch = [transform(x) for x in rows] if transform else rows
+            yield batch
+            if len(rows) < batch_size:
+                return
+
     def create(self,
                data: Union[CreateSchemaType, Dict[str, Any]],
                exclude: Optional[typing.List] = None,
                extra_data: Optional[dict] = None) -> ModelType:
         """Create data"""
+        exclude = exclude or []
         if isinstance(data, BaseModel):
             data = data.dict()
-        data.update(extra_data)
+        data.update(extra_data or {})
         for key in exclude:
             if key in data:
                 del data[key]
         db_obj = self.model(**data)
         flush()
+        self._touch([db_obj])
+        self.invalidate([db_obj.id])
+        self.publish('create', [db_obj])
         return db_obj
 
     def update_by_id(
@@ -98,6 +357,8 @@ class CRUDBase(Generic[ModelType, CreateSchemaType, UpdateSchemaType]):
         # check if data is not dict
         if isinstance(data, BaseModel):
             data = data.dict()
+        # groups of old values lose this row
+        self._touch([db_obj])
         # udpate by data
         for field, value in data.items():
             if field in exclude:
@@ -107,6 +368,7 @@ class CRUDBase(Generic[ModelType, CreateSchemaType, UpdateSchemaType]):
             if field in exclude:
                 continue
             setattr(db_obj, field, value)
+        self._touch([db_obj])
         return db_obj
 
     def update_by_db_object(
@@ -119,17 +381,272 @@ class CRUDBase(Generic[ModelType, CreateSchemaType, UpdateSchemaType]):
         """db data by db object"""
         db_obj = self.update_obj(db_obj, data, exclude, extra_data)
         flush()
+        self.invalidate([db_obj.id])
+        self.publish('update', [db_obj])
         return db_obj
 
     def remove_by_id(self, _id: Any):
         """remove data by id"""
         db_obj = self.get(_id)
+        _id = db_obj.id
+        self._touch([db_obj])
         db_obj.delete()
         flush()
+        self.invalidate([_id])
+        self.publish('delete', ids=[_id])
 
-    @staticmethod
     def remove_by_query(
+            self,
             query: Query
     ):
+        """
+        delete rows of query, cached data of them are dropped after commit
+        and `delete` of their ids is published
+
+        It was a staticmethod, it is a method of the instance now,
+        which owns the cache, search index and change hub to invalidate:
+        call `crud.remove_by_query(query)`, not `CRUDBase.remove_by_query(query)`.
+        """
+        ids = (
+            select(o.id for o in query)[:]
+            if self.cache or self.change_hub else None
+        )
         query.delete()
         flush()
+        self._invalidate_aggregates()
+        self.invalidate(ids)
+        self.publish('delete', ids=ids)
+
+    @staticmethod
+    def _chunks(items: typing.Sequence, chunk_size: int):
+        for start in range(0, len(items), chunk_size):
+            yield start, items[start:start + chunk_size]
+
+    def _parse_ids(
+            self,
+            ids: typing.Sequence[Any],
+            loc: typing.Sequence[str] = (),
+    ) -> List[Any]:
+        """
+        ids of request body converted to type of primary key,
+        e.g. `"1"` is 1, 422 if any of them can not be converted
+        """
+        pk_attrs = self.model._pk_attrs_  # pylint:disable=protected-access
+        py_type = pk_attrs[0].py_type if len(pk_attrs) == 1 else None
+        parsed = []
+        errors = []
+        for index, _id in enumerate(ids):
+            _id = parse_pk(self.model, _id)
+            if py_type is not None and (
+                    not isinstance(_id, py_type)
+                    or (isinstance(_id, bool) and py_type is not bool)):
+                errors.append({
+                    'loc': ['body', index, *loc],
+                    'msg': f'invalid id: {_id!r}',
+                    'type': 'type_error',
+                })
+            parsed.append(_id)
+        if errors:
+            raise HTTPException(status_code=422, detail=errors)
+        return parsed
+
+    def _can_bulk_delete(self) -> bool:
+        """no other table references this one by foreign key"""
+        return not any(
+            attr.reverse is not None and attr.reverse.columns
+            for attr in self.model._attrs_  # pylint:disable=protected-access
+        )
+
+    def bulk_create(
+            self,
+            items: typing.Sequence[Union[CreateSchemaType, Dict[str, Any]]],
+            chunk_size: Optional[int] = None,
+    ) -> List[Dict[str, Any]]:
+        """
+        create many data, flush once per chunk
+
+        Returns:
+            per item result: index, id, status(created / error), detail
+        """
+        chunk_size = chunk_size or self.bulk_chunk_size
+        results = []
+        db_objs = []
+        for start, chunk in self._chunks(items, chunk_size):
+            created = []
+            for index, data in enumerate(chunk, start):
+                if isinstance(data, BaseModel):
+                    data = data.dict()
+                try:
+                    created.append((index, self.model(**data)))
+                except (TypeError, ValueError, OrmError) as e:
+                    results.append({
+                        'index': index, 'id': None,
+                        'status': 'error', 'detail': str(e)
+                    })
+            flush()
+            self._touch(db_obj for _, db_obj in created)
+            for index, db_obj in created:
+                db_objs.append(db_obj)
+                results.append({
+                    'index': index, 'id': db_obj.id,
+                    'status': 'created', 'detail': None
+                })
+        self.invalidate([db_obj.id for db_obj in db_objs])
+        self.publish('create', db_objs)
+        results.sort(key=lambda x: x['index'])
+        return results
+
+    def bulk_update(
+            self,
+            items: typing.Sequence[Union[UpdateSchemaType, Dict[str, Any]]],
+            chunk_size: Optional[int] = None,
+    ) -> List[Dict[str, Any]]:
+        """
+        update many data by `id` of each item,
+        rows are loaded by one SELECT ... IN and flushed once per chunk
+
+        Returns:
+            per item result: index, id, status(updated / not_found / error), detail
+        """
+        chunk_size = chunk_size or self.bulk_chunk_size
+        items = [
+            data.dict() if isinstance(data, BaseModel) else dict(data)
+            for data in items
+        ]
+        for data, _id in zip(items, self._parse_ids(
+                [data.get('id') for data in items], ('id',))):
+            data['id'] = _id
+        results = []
+        updated = []
+        for start, chunk in self._chunks(items, chunk_size):
+            chunk_ids = [data['id'] for data in chunk]
+            db_objs = {
+                db_obj.id: db_obj
+                for db_obj in self.model.select(lambda o: o.id in chunk_ids)
+            }
+            for index, data in enumerate(chunk, start):
+                _id = data.pop('id', None)
+                db_obj = db_objs.get(_id)
+                if db_obj is None:
+                    results.append({
+                        'index': index, 'id': _id,
+                        'status': 'not_found', 'detail': None
+                    })
+                    continue
+                try:
+                    self.update_obj(db_obj, data)
+                except (TypeError, ValueError, OrmError) as e:
+                    results.append({
+                        'index': index, 'id': _id,
+                        'status': 'error', 'detail': str(e)
+                    })
+                    continue
+                updated.append(db_obj)
+                results.append({
+                    'index': index, 'id': _id,
+                    'status': 'updated', 'detail': None
+                })
+            flush()
+        self.invalidate([db_obj.id for db_obj in updated])
+        self.publish('update', updated)
+        return results
+
+    def bulk_delete(
+            self,
+            ids: typing.Sequence[Any],
+            chunk_size: Optional[int] = None,
+    ) -> List[Dict[str, Any]]:
+        """
+        delete many data by id,
+        one DELETE ... IN per chunk if no foreign key references this table,
+        else load by one SELECT ... IN and delete with relations
+
+        Returns:
+            per item result: index, id, status(deleted / not_found), detail
+        """
+        chunk_size = chunk_size or self.bulk_chunk_size
+        ids = self._parse_ids(ids)
+        bulk = self._can_bulk_delete()
+        results = []
+        deleted_ids = []
+        for start, chunk_ids in self._chunks(ids, chunk_size):
+            query = self.model.select(lambda o: o.id in chunk_ids)
+            if bulk:
+                found = set(select(o.id for o in query)[:])
+                query.delete(bulk=True)
+                if found:
+                    self._invalidate_aggregates()
+            else:
+                found = set()
+                for db_obj in query:
+                    found.add(db_obj.id)
+                    self._touch([db_obj])
+                    db_obj.delete()
+            flush()
+            for index, _id in enumerate(chunk_ids, start):
+                status = 'deleted' if _id in found else 'not_found'
+                results.append({
+                    'index': index, 'id': _id, 'status': status, 'detail': None
+                })
+            deleted_ids.extend(found)
+        self.invalidate(deleted_ids)
+        self.publish('delete', ids=deleted_ids)
+        return results
+
+    def publish(
+            self,
+            action: str,
+            db_objs: Optional[typing.Sequence[ModelType]] = None,
+            ids: Optional[typing.Sequence[Any]] = None,
+    ):
+        """
+        send written entities to change_hub after the transaction commits,
+        with values of `_filterable_` attributes (relations as ids) now
+
+        Args:
+            action: create / update / delete
+            db_objs: written entities
+            ids: ids of deleted entities
+        """
+        if self.change_hub is None:
+            return
+        data = None
+        if db_objs is not None:
+            fields = getattr(self.model, '_filterable_', ())
+            ids = [db_obj.id for db_obj in db_objs]
+            data = [
+                {name: _plain(getattr(db_obj, name)) for name in fields}
+                for db_obj in db_objs
+            ]
+        if ids:
+            after_commit(functools.partial(
+                self.change_hub.publish,
+                self.model.__name__, action, list(ids), data))
+
+    def invalidate(self, ids: Optional[typing.Iterable[Any]] = None):
+        """
+        update search index of model in the transaction after writing,
+        drop its cached data after the transaction commits (`db.session`),
+        so no request caches old rows under the new version stamps
+
+        Args:
+            ids: written ids, None if unknown
+        """
+        if self.search_index is not None:
+            self.search_index.sync(ids)
+        if ids is not None:
+            ids = list(ids)
+        after_commit(functools.partial(self._drop_cached, ids))
+
+    def _drop_cached(self, ids: Optional[List[Any]]):
+        count_cache.invalidate(self.model)
+        if ids is None:
+            aggregate_cache.invalidate(self.model)
+        version_stamps.bump(self.model, ids)
+        if self.db_router is not None:
+            self.db_router.written(self.model)
+        if self.cache is not None:
+            if ids is None:
+                self.cache.clear(self.model)
+            else:
+                self.cache.invalidate(self.model, ids)
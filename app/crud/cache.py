@@ -0,0 +1,137 @@
+"""entity cache of CRUDBase.get"""
+import typing
+import uuid
+from typing import Any, Dict, Iterable, Optional
+
+from pony.orm.core import EntityMeta
+from pydantic import BaseModel
+from utils.cache import CacheBackend, TTLCache
+from utils.pony_filter import parse_pk
+
+
+class EntityCache:
+    """
+    read-through cache of serialized entities
+
+    ```
+        crud = CRUDBase(models.Todo, cache=EntityCache(maxsize=10000, ttl=60))
+        # share it between workers
+        crud = CRUDBase(
+            models.Todo,
+            cache=EntityCache(backend=SQLiteBackend('/tmp/todo-cache.db'))
+        )
+    ```
+
+    Only columns of the entity itself are invalidated,
+    nested relations (`include=`) are refreshed by ttl.
+    Each entity has a version changed by `invalidate`, read it before
+    reading the row, so a row read before a write is not cached after it.
+    Keys of a model are in its generation, `clear` starts a new one,
+    so models sharing a backend do not drop entities of each other.
+    """
+
+    def __init__(
+            self,
+            maxsize: int = 1024,
+            ttl: Optional[float] = 60,
+            backend: Optional[CacheBackend] = None,
+    ):
+        self.backend = backend or TTLCache(maxsize=maxsize, ttl=ttl)
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def generation(self, model: EntityMeta) -> str:
+        """
+        generation of model keys, a missing one (evicted) is new,
+        which only drops cached entities of model early
+        """
+        key = f'{model.__name__}:generation'
+        generation = self.backend.get(key)
+        if generation is None:
+            generation = uuid.uuid4().hex[:8]
+            self.backend.set(key, generation)
+        return generation
+
+    def make_key(
+            self,
+            model: EntityMeta,
+            _id: Any,
+            generation: Optional[str] = None,
+    ) -> str:
+        """cache key of entity, id from path is converted to type of primary key"""
+        generation = generation or self.generation(model)
+        return f'{model.__name__}:{generation}:{parse_pk(model, _id)}'
+
+    def version(self, model: EntityMeta, _id: Any) -> str:
+        """version of entity, a missing one (evicted) is new"""
+        key = f'{self.make_key(model, _id)}:version'
+        version = self.backend.get(key)
+        if version is None:
+            version = uuid.uuid4().hex[:8]
+            self.backend.set(key, version)
+        return version
+
+    def _data_key(
+            self,
+            model: EntityMeta,
+            _id: Any,
+            version: Optional[str] = None,
+    ) -> str:
+        version = version or self.version(model, _id)
+        return f'{self.make_key(model, _id)}:{version}'
+
+    def get(
+            self,
+            model: EntityMeta,
+            schema: typing.Type[BaseModel],
+            _id: Any,
+            version: Optional[str] = None,
+    ) -> Optional[Dict[str, Any]]:
+        """get serialized entity of version"""
+        cached = self.backend.get(self._data_key(model, _id, version)) or {}
+        data = cached.get(schema.__name__)
+        if data is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return data
+
+    def set(
+            self,
+            model: EntityMeta,
+            schema: typing.Type[BaseModel],
+            _id: Any,
+            data: Dict[str, Any],
+            version: Optional[str] = None,
+    ):
+        """
+        set serialized entity of version (read before reading the row),
+        all schemas of an entity share one key so it is deleted at once
+        """
+        key = self._data_key(model, _id, version)
+        cached = dict(self.backend.get(key) or {})
+        cached[schema.__name__] = data
+        self.backend.set(key, cached, ttl=self.ttl)
+
+    def invalidate(self, model: EntityMeta, ids: Iterable[Any]):
+        """delete cached entities and change their versions"""
+        generation = self.generation(model)
+        for _id in ids:
+            key = self.make_key(model, _id, generation)
+            version = self.backend.get(f'{key}:version')
+            if version is not None:
+                self.backend.delete(f'{key}:{version}')
+            self.backend.set(f'{key}:version', uuid.uuid4().hex[:8])
+
+    def clear(self, model: EntityMeta):
+        """drop every cached entity of model by a new generation"""
+        self.backend.set(f'{model.__name__}:generation', uuid.uuid4().hex[:8])
+
+    def stats(self) -> Dict[str, int]:
+        """hit / miss / eviction counters"""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.backend.evictions,
+        }
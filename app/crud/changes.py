@@ -0,0 +1,423 @@
+"""
+change feed of CRUDBase writes
+
+CRUDBase with a `change_hub` publishes create / update / delete events
+after committing, subscribers get them in order of a sequence number:
+
+```
+    hub = ChangeHub()
+    crud = CRUDBase(models.Todo, change_hub=hub)
+    subscription, backlog, reset = hub.subscribe(last_event_id)
+    event = await subscription.get()
+```
+
+Events are published once the `commit_session` of the write commits
+(`db.session`), a rolled back transaction sends nothing. `data` is read
+when writing, a later write may have changed it before the event arrives,
+so clients should read the entity by id when it matters.
+"""
+import asyncio
+import itertools
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+from collections import deque
+from functools import lru_cache
+from typing import (Any, Callable, Deque, Dict, Iterable, Iterator, List,
+                    NamedTuple, Optional, Set, Tuple)
+
+import config
+from log import logger
+
+ACTIONS = ('create', 'update', 'delete')
+# bytes received of one datagram, larger messages are split by ChangeHub
+MAX_DATAGRAM = 65536
+
+
+class ChangeEvent(NamedTuple):
+    """one written entity, data has the `_filterable_` attributes"""
+    seq: int
+    model: str
+    action: str
+    id: Any
+    data: Optional[Dict[str, Any]]
+
+    def to_dict(self) -> dict:
+        return {
+            'seq': self.seq,
+            'model': self.model,
+            'action': self.action,
+            'id': self.id,
+            'data': self.data,
+        }
+
+
+Predicate = Callable[[ChangeEvent], bool]
+
+
+class Subscription:
+    """
+    bounded queue of one subscriber in its event loop,
+    a subscriber too slow to keep up is dropped instead of
+    making the hub or other subscribers wait
+    """
+
+    def __init__(
+            self,
+            hub: 'ChangeHub',
+            maxsize: int,
+            predicate: Optional[Predicate] = None,
+    ):
+        self.hub = hub
+        self.predicate = predicate
+        self.dropped = False
+        self._loop = asyncio.get_running_loop()
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize)
+
+    def offer(self, event: ChangeEvent):
+        """called in any thread"""
+        try:
+            self._loop.call_soon_threadsafe(self._put, event)
+        except RuntimeError:
+            # loop is closed
+            self.hub.unsubscribe(self)
+
+    def _put(self, event: ChangeEvent):
+        if self.dropped:
+            return
+        if self.predicate is not None and not self.predicate(event):
+            return
+        try:
+            self._queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.dropped = True
+            self.hub.unsubscribe(self)
+            while not self._queue.empty():
+                self._queue.get_nowait()
+            # wake the consumer up
+            self._queue.put_nowait(None)
+
+    async def get(self) -> Optional[ChangeEvent]:
+        """next event, None if dropped"""
+        return await self._queue.get()
+
+    def close(self):
+        self.hub.unsubscribe(self)
+
+
+class UnixDatagramTransport:
+    """
+    fan out events to other workers on the same machine,
+    each worker binds `<directory>/<pid>.sock` and sends every event
+    to the other sockets of the directory.
+    Datagrams to a full socket are dropped like a slow subscriber.
+    """
+
+    # bytes of one message, datagrams are not split by the socket
+    max_payload = MAX_DATAGRAM
+
+    # seconds to list peers of the directory again
+    peers_ttl = 1.0
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.path = None
+        self.dropped = 0
+        self._receiver = None
+        self._sender = None
+        self._peers: List[str] = []
+        self._peers_at = 0.0
+
+    def start(self, deliver: Callable[[dict], None]):
+        """bind socket of this process, deliver messages of others"""
+        os.makedirs(self.directory, exist_ok=True)
+        self.path = os.path.join(self.directory, f'{os.getpid()}.sock')
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._receiver = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._receiver.bind(self.path)
+        self._sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sender.setblocking(False)
+        receiver = self._receiver
+
+        def _receive():
+            while True:
+                try:
+                    payload = receiver.recv(MAX_DATAGRAM)
+                except OSError:
+                    return
+                try:
+                    deliver(json.loads(payload))
+                except Exception:  # pylint:disable=broad-except
+                    logger.exception('invalid change event')
+
+        threading.Thread(
+            target=_receive, name='change-feed', daemon=True).start()
+
+    def _get_peers(self) -> List[str]:
+        now = time.monotonic()
+        if now - self._peers_at > self.peers_ttl:
+            self._peers = [
+                os.path.join(self.directory, name)
+                for name in os.listdir(self.directory)
+                if name.endswith('.sock')
+                and os.path.join(self.directory, name) != self.path
+            ]
+            self._peers_at = now
+        return self._peers
+
+    @staticmethod
+    def encode(message: dict) -> bytes:
+        return json.dumps(message, default=str).encode()
+
+    def send(self, message: dict):
+        """send message to other workers, never raises"""
+        payload = self.encode(message)
+        if len(payload) > self.max_payload:
+            self.dropped += 1
+            logger.warning(f'change event of {len(payload)} bytes is dropped')
+            return
+        for peer in self._get_peers():
+            try:
+                self._sender.sendto(payload, peer)
+            except BlockingIOError:
+                self.dropped += 1
+            except (ConnectionRefusedError, FileNotFoundError):
+                # worker is gone
+                self._peers_at = 0.0
+                try:
+                    os.unlink(peer)
+                except OSError:
+                    pass
+            except OSError as e:
+                # e.g. EMSGSIZE / ENOBUFS, the write is committed already
+                self.dropped += 1
+                logger.warning(f'change event to {peer} is dropped: {e}')
+
+    def close(self):
+        for sock in (self._receiver, self._sender):
+            if sock is not None:
+                sock.close()
+        if self.path and os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+class ChangeHub:
+    """
+    in-process broadcast of change events
+
+    The last `buffer` events are kept, so a subscriber can resume from
+    the id of the last event it got. Ids are `<hub id>-<seq>`, a hub is
+    one process, so resuming on another worker or after the buffer
+    has moved on returns `reset`, the subscriber should reload instead.
+    A forked process gets a new hub id and an empty buffer.
+    """
+
+    def __init__(
+            self,
+            buffer: int = 1000,
+            queue_size: int = 100,
+            transport: Optional[UnixDatagramTransport] = None,
+    ):
+        self.buffer = buffer
+        self.queue_size = queue_size
+        self.transport = transport
+        self._pid = None
+        # offer in order of seq, a closed loop unsubscribes while offering
+        self._lock = threading.RLock()
+        self._reset_state()
+
+    def _reset_state(self):
+        self.hub_id = uuid.uuid4().hex[:8]
+        self._seq = itertools.count(1)
+        self._last_seq = 0
+        self._history: Deque[ChangeEvent] = deque(maxlen=self.buffer)
+        self._subscribers: Set[Subscription] = set()
+
+    def _check_process(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            if self._pid is not None:
+                self._reset_state()
+            self._pid = os.getpid()
+            if self.transport is not None:
+                self.transport.start(self._receive)
+
+    def publish(
+            self,
+            model: str,
+            action: str,
+            ids: Iterable[Any],
+            data: Optional[List[Dict[str, Any]]] = None,
+    ):
+        """events of written ids, data of each id is optional"""
+        self._check_process()
+        ids = list(ids)
+        if not ids:
+            return
+        self._deliver(model, action, ids, data)
+        if self.transport is not None:
+            for message in self._messages(model, action, ids, data):
+                self.transport.send(message)
+
+    def _messages(
+            self,
+            model: str,
+            action: str,
+            ids: List[Any],
+            data: Optional[List[Dict[str, Any]]],
+    ) -> Iterator[dict]:
+        """
+        messages of transport, each fits in max_payload when encoded,
+        data of an event too large alone is left out (None)
+        """
+        encode = self.transport.encode
+        max_payload = self.transport.max_payload
+
+        def new_message() -> dict:
+            return {
+                'model': model,
+                'action': action,
+                'ids': [],
+                'data': None if data is None else [],
+            }
+
+        empty_size = len(encode(new_message()))
+        message, size = new_message(), empty_size
+        for i, _id in enumerate(ids):
+            # with its ", " in the list
+            item_size = len(encode(_id)) + 2
+            if data is not None:
+                item = data[i]
+                data_size = len(encode(item)) + 2
+                if empty_size + item_size + data_size > max_payload:
+                    item, data_size = None, len(encode(None)) + 2
+                item_size += data_size
+            if message['ids'] and size + item_size > max_payload:
+                yield message
+                message, size = new_message(), empty_size
+            message['ids'].append(_id)
+            if data is not None:
+                message['data'].append(item)
+            size += item_size
+        if message['ids']:
+            yield message
+
+    def _receive(self, message: dict):
+        self._deliver(
+            message['model'], message['action'],
+            message['ids'], message.get('data'))
+
+    def _deliver(
+            self,
+            model: str,
+            action: str,
+            ids: List[Any],
+            data: Optional[List[Dict[str, Any]]],
+    ):
+        with self._lock:
+            events = [
+                ChangeEvent(
+                    next(self._seq), model, action, _id,
+                    data[i] if data is not None else None
+                )
+                for i, _id in enumerate(ids)
+            ]
+            self._history.extend(events)
+            self._last_seq = events[-1].seq
+            for subscriber in list(self._subscribers):
+                for event in events:
+                    subscriber.offer(event)
+
+    def event_id(self, event: ChangeEvent) -> str:
+        return f'{self.hub_id}-{event.seq}'
+
+    def subscribe(
+            self,
+            last_event_id: Optional[str] = None,
+            predicate: Optional[Predicate] = None,
+    ) -> Tuple[Subscription, List[ChangeEvent], bool]:
+        """
+        subscribe in the running event loop
+
+        Returns:
+            subscription, events after last_event_id,
+            reset: last_event_id can not be resumed
+        """
+        self._check_process()
+        subscription = Subscription(self, self.queue_size, predicate)
+        with self._lock:
+            self._subscribers.add(subscription)
+            if not last_event_id:
+                return subscription, [], False
+            hub_id, _, seq = last_event_id.rpartition('-')
+            oldest = self._history[0].seq if self._history else self._last_seq + 1
+            if (hub_id != self.hub_id or not seq.isdigit()
+                    or int(seq) > self._last_seq or int(seq) < oldest - 1):
+                return subscription, [], True
+            backlog = [event for event in self._history if event.seq > int(seq)]
+        if predicate is not None:
+            backlog = [event for event in backlog if predicate(event)]
+        return subscription, backlog, False
+
+    def unsubscribe(self, subscription: Subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    @property
+    def subscribers(self) -> int:
+        return len(self._subscribers)
+
+    def close(self):
+        if self.transport is not None and self._pid == os.getpid():
+            self.transport.close()
+
+
+def make_predicate(
+        model: str,
+        actions: Optional[Iterable[str]] = None,
+        ids: Optional[Iterable[str]] = None,
+        data: Optional[Dict[str, str]] = None,
+) -> Predicate:
+    """events of model, filtered by action, id and values of data"""
+    actions = frozenset(actions or ACTIONS)
+    ids = frozenset(ids or ())
+    data = dict(data or {})
+
+    def predicate(event: ChangeEvent) -> bool:
+        if event.model != model or event.action not in actions:
+            return False
+        if ids and str(event.id) not in ids:
+            return False
+        if data:
+            # delete events have no data, they match by id only
+            if event.data is None:
+                return event.action == 'delete'
+            return all(
+                str(event.data.get(name)) == value
+                for name, value in data.items()
+            )
+        return True
+
+    return predicate
+
+
+@lru_cache()
+def get_change_hub() -> Optional[ChangeHub]:
+    """hub of config, None if CHANGE_FEED is false"""
+    if not config.CHANGE_FEED:
+        return None
+    transport = None
+    if config.CHANGE_FEED_SOCKET_DIR:
+        transport = UnixDatagramTransport(config.CHANGE_FEED_SOCKET_DIR)
+    return ChangeHub(
+        buffer=config.CHANGE_FEED_BUFFER,
+        queue_size=config.CHANGE_FEED_QUEUE_SIZE,
+        transport=transport,
+    )
@@ -0,0 +1,138 @@
+"""query count cache and estimation"""
+import typing
+from typing import Optional, Tuple
+
+from pony.orm.core import EntityMeta, Query
+from utils.cache import TTLCache
+
+
+def query_entity(query: Query) -> EntityMeta:
+    """entity which query selects"""
+    return query._translator.expr_type  # pylint:disable=protected-access
+
+
+def query_key(query: Query) -> Tuple[str, str]:
+    """cache key of query, sql with its parameters"""
+    params = [
+        value
+        for value in query._vars.values()  # pylint:disable=protected-access
+        if not isinstance(value, EntityMeta)
+    ]
+    return query.get_sql(), repr(params)
+
+
+def is_unfiltered(query: Query) -> bool:
+    """check query is `select all` of entity"""
+    return query.get_sql() == query_entity(query).select().get_sql()
+
+
+def estimate_count(entity: EntityMeta) -> Optional[int]:
+    """
+    row count from table statistics, which will not scan the table.
+    Return None if the database is not supported.
+
+    * SQLite: sqlite_stat1 (after ANALYZE), else max(rowid)
+    * PostgreSQL: pg_class.reltuples
+    * MySQL: information_schema.tables.table_rows
+    """
+    database = entity._database_  # pylint:disable=protected-access
+    table = entity._table_
+    if not isinstance(table, str):
+        return None
+    dialect = database.provider.dialect
+    params = {'table': table}
+    if dialect == 'SQLite':
+        has_stat = database.select(
+            "SELECT count(*) FROM sqlite_master "
+            "WHERE type = 'table' AND name = 'sqlite_stat1'"
+        )[0]
+        if has_stat:
+            stats = database.select(
+                'SELECT stat FROM sqlite_stat1 WHERE tbl = $table LIMIT 1',
+                params
+            )
+            if stats:
+                return int(stats[0].split()[0])
+        # rowid is the b-tree key, deleted rows make it an over estimation
+        return database.select(
+            f'SELECT coalesce(max(rowid), 0) FROM "{table}"')[0]
+    if dialect == 'PostgreSQL':
+        rows = database.select(
+            'SELECT reltuples::bigint FROM pg_class '
+            'WHERE oid = to_regclass($table)',
+            params
+        )
+        return max(int(rows[0]), 0) if rows else None
+    if dialect == 'MySQL':
+        rows = database.select(
+            'SELECT table_rows FROM information_schema.tables '
+            'WHERE table_schema = DATABASE() AND table_name = $table',
+            params
+        )
+        return int(rows[0]) if rows else None
+    return None
+
+
+class CountCache:
+    """
+    query count cache keyed by entity and filter
+
+    Every entity has its own TTLCache, so writes of entity
+    only invalidate counts of that entity.
+    """
+
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self._caches: typing.Dict[str, TTLCache] = {}
+
+    def _cache(self, entity: EntityMeta) -> TTLCache:
+        name = entity.__name__
+        cache = self._caches.get(name)
+        if cache is None:
+            cache = self._caches.setdefault(name, TTLCache(self.maxsize))
+        return cache
+
+    def count(
+            self,
+            query: Query,
+            ttl: Optional[float] = None,
+            estimate: bool = False,
+    ) -> Tuple[int, bool]:
+        """
+        count query
+
+        Args:
+            query: pony query
+            ttl: seconds to cache the count, None will not cache
+            estimate: use table statistics if query is not filtered
+
+        Returns:
+            (count, is count estimated)
+        """
+        entity = query_entity(query)
+        key = (query_key(query), estimate)
+        if ttl is not None:
+            cached = self._cache(entity).get(key)
+            if cached is not None:
+                return cached
+
+        result = None
+        if estimate and is_unfiltered(query):
+            estimated = estimate_count(entity)
+            if estimated is not None:
+                result = (estimated, True)
+        if result is None:
+            result = (query.count(), False)
+
+        if ttl is not None:
+            self._cache(entity).set(key, result, ttl=ttl)
+        return result
+
+    def invalidate(self, entity: EntityMeta):
+        """drop all cached counts of entity"""
+        cache = self._caches.get(entity.__name__)
+        if cache is not None:
+            cache.clear()
+
+
+count_cache = CountCache()
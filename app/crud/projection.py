@@ -0,0 +1,26 @@
+"""select only some columns of entity"""
+import typing
+
+from pony.orm import select
+from pony.orm.core import Query
+
+
+def project(query: Query, fields: typing.Sequence[str]) -> Query:
+    """
+    select only columns of fields, rows are tuples in order of fields
+    (or the value itself if there is only one field),
+    fields must be checked attribute names, they are put into the query.
+    query must not be filtered by keyword arguments, pony can not select from it
+    """
+    columns = ', '.join(f'o.{name}' for name in fields)
+    return select(f'({columns},) for o in query', {}, {'query': query})
+
+
+def to_dicts(
+        rows: typing.Iterable[typing.Any],
+        keys: typing.Sequence[str],
+) -> typing.List[dict]:
+    """rows of `project` to dicts"""
+    if len(keys) == 1:
+        return [{keys[0]: row} for row in rows]
+    return [dict(zip(keys, row)) for row in rows]
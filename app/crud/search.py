@@ -0,0 +1,237 @@
+"""
+full text search of text attributes by SQLite FTS5
+
+Attributes are declared on the entity like `_filterable_`:
+
+    class Todo(db.Entity):
+        _searchable_ = ('name',)
+
+CRUDBase keeps the index in sync on writes. Indexes of CRUDBase are
+created at startup (`ensure_search_indexes`). Rebuild it for existing data:
+
+    python -m crud.search            # every searchable entity
+    python -m crud.search Todo
+"""
+import argparse
+import threading
+import typing
+from typing import Any, Iterable, List, Optional, Tuple
+
+from pony.orm import OperationalError, db_session
+from pony.orm.core import EntityMeta, local
+
+
+class SearchIndex:
+    """
+    FTS5 table `<table>_fts` with rowid = id of entity,
+    created and filled from the table if missing
+
+    Other databases have no FTS5, `available` is False and
+    sync does nothing.
+    """
+
+    def __init__(self, model: EntityMeta, fields: typing.Sequence[str]):
+        self.model = model
+        self.fields = tuple(fields)
+        self.table = f'{model._table_}_fts'
+        self._ready = False
+        self._lock = threading.Lock()
+
+    @property
+    def database(self):
+        return self.model._database_  # pylint:disable=protected-access
+
+    @property
+    def available(self) -> bool:
+        return self.database.provider.dialect == 'SQLite'
+
+    def _columns(self) -> List[str]:
+        # pylint:disable=protected-access
+        return [self.model._adict_[name].column for name in self.fields]
+
+    def ensure(self):
+        """
+        create and fill the table if missing
+
+        Outside a db_session it is committed in its own one and never
+        checked again. In a db_session it is created in that transaction,
+        which may be rolled back, so it is checked on every call until
+        `ensure` runs outside of one.
+        """
+        if self._ready:
+            return
+        if local.db_session is not None:
+            self._create()
+            return
+        with self._lock:
+            if self._ready:
+                return
+            with db_session:
+                self._create()
+            self._ready = True
+
+    def _exists(self) -> bool:
+        return bool(self.database.select(
+            "SELECT count(*) FROM sqlite_master "
+            "WHERE type = 'table' AND name = $table",
+            {'table': self.table}
+        )[0])
+
+    def _create(self):
+        if self._exists():
+            return
+        columns = ', '.join(f'"{x}"' for x in self._columns())
+        try:
+            self.database.execute(
+                f'CREATE VIRTUAL TABLE "{self.table}" USING fts5('
+                f"{columns}, tokenize='unicode61')"
+            )
+        except OperationalError:
+            # created and filled by another worker starting at the same time
+            if self._exists():
+                return
+            raise
+        self._fill()
+
+    def _fill(self):
+        columns = ', '.join(f'"{x}"' for x in self._columns())
+        self.database.execute(
+            f'INSERT INTO "{self.table}"(rowid, {columns}) '
+            f'SELECT "id", {columns} FROM "{self.model._table_}"'
+        )
+
+    def rebuild(self):
+        """drop indexed rows and index the whole table again"""
+        self.ensure()
+        self.database.execute(f'DELETE FROM "{self.table}"')
+        self._fill()
+
+    def sync(self, ids: Optional[Iterable[Any]] = None):
+        """
+        index rows of ids again after writing, in the same transaction
+
+        Args:
+            ids: written ids, None if unknown, then deleted rows are dropped
+        """
+        if not self.available:
+            return
+        self.ensure()
+        table = self.model._table_
+        if ids is None:
+            # only remove_by_query does not know ids, it never inserts
+            self.database.execute(
+                f'DELETE FROM "{self.table}" '
+                f'WHERE rowid NOT IN (SELECT "id" FROM "{table}")'
+            )
+            return
+        columns = ', '.join(f'"{x}"' for x in self._columns())
+        ids = list(ids)
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            params = {f'id{i}': _id for i, _id in enumerate(chunk)}
+            placeholders = ', '.join(f'${name}' for name in params)
+            self.database.execute(
+                f'DELETE FROM "{self.table}" WHERE rowid IN ({placeholders})',
+                params
+            )
+            self.database.execute(
+                f'INSERT INTO "{self.table}"(rowid, {columns}) '
+                f'SELECT "id", {columns} FROM "{table}" '
+                f'WHERE "id" IN ({placeholders})',
+                params
+            )
+
+    @staticmethod
+    def to_match(text: str) -> str:
+        """
+        FTS5 query of user text, every word is a quoted prefix,
+        so operators in text are searched as words
+        """
+        words = text.split()
+        return ' '.join('"' + word.replace('"', '""') + '"*' for word in words)
+
+    def search(
+            self,
+            text: str,
+            offset: int = 0,
+            limit: int = 10,
+            database=None,
+    ) -> Tuple[List[Any], int]:
+        """
+        ids ranked by bm25 and total count of matched rows
+
+        Args:
+            database: database to read, e.g. a reader of DBRouter
+        """
+        self.ensure()
+        database = database or self.database
+        match = self.to_match(text)
+        if not match:
+            return [], 0
+        params = {'match': match, 'limit': limit, 'offset': offset}
+        count = database.select(
+            f'SELECT count(*) FROM "{self.table}" '
+            f'WHERE "{self.table}" MATCH $match',
+            params
+        )[0]
+        if not count or offset >= count:
+            return [], count
+        ids = database.select(
+            f'SELECT rowid FROM "{self.table}" '
+            f'WHERE "{self.table}" MATCH $match '
+            'ORDER BY rank LIMIT $limit OFFSET $offset',
+            params
+        )
+        return ids, count
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_search_index(model: EntityMeta) -> Optional[SearchIndex]:
+    """index of `_searchable_` of model, shared by every CRUDBase of it"""
+    fields = getattr(model, '_searchable_', None)
+    if not fields:
+        return None
+    with _indexes_lock:
+        index = _indexes.get(model)
+        if index is None:
+            index = _indexes[model] = SearchIndex(model, fields)
+    return index
+
+
+def ensure_search_indexes():
+    """create missing indexes of every CRUDBase, each committed on its own"""
+    with _indexes_lock:
+        indexes = list(_indexes.values())
+    for index in indexes:
+        if index.available:
+            index.ensure()
+
+
+def main():
+    """rebuild indexes of searchable entities"""
+    # pylint:disable=import-outside-toplevel
+    from db import models
+
+    parser = argparse.ArgumentParser(description='rebuild full text indexes')
+    parser.add_argument('entities', nargs='*', help='entity names, default all')
+    args = parser.parse_args()
+    models.init_db()
+    entities = [
+        entity for entity in models.db.entities.values()
+        if getattr(entity, '_searchable_', None)
+        and (not args.entities or entity.__name__ in args.entities)
+    ]
+    for entity in entities:
+        index = get_search_index(entity)
+        with db_session:
+            index.rebuild()
+            count = index.database.select(
+                f'SELECT count(*) FROM "{index.table}"')[0]
+        print(f'{entity.__name__}: {count} rows indexed in {index.table}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""version stamps of tables and entities"""
+import typing
+import uuid
+from typing import Any, Iterable, Optional
+
+import config
+from pony.orm.core import EntityMeta
+from utils.cache import CacheBackend, SQLiteBackend, TTLCache
+from utils.pony_filter import parse_pk
+
+
+class VersionStamps:
+    """
+    version stamp of each table and each entity, bumped by CRUDBase writes
+
+    A stamp is a random token, a missing stamp (never read or evicted)
+    gets a new token, so a stamp is never reused after a write.
+    Use a shared backend when running more than one worker.
+    """
+
+    def __init__(self, backend: Optional[CacheBackend] = None):
+        self.backend = backend or TTLCache(maxsize=100000)
+
+    @staticmethod
+    def _new_token() -> str:
+        return uuid.uuid4().hex[:16]
+
+    def _get(self, key: str) -> str:
+        token = self.backend.get(key)
+        if token is None:
+            token = self._new_token()
+            self.backend.set(key, token)
+        return token
+
+    @property
+    def shared(self) -> bool:
+        """stamps are shared by workers, not only written by this process"""
+        return not isinstance(self.backend, TTLCache)
+
+    def table(self, model: EntityMeta) -> str:
+        """stamp of table, changed by every write of model"""
+        return self._get(model.__name__)
+
+    def _entity_key(self, model: EntityMeta, _id: Any) -> str:
+        # entities of model are in its generation, a new one changes all
+        generation = self._get(f'{model.__name__}:generation')
+        # path ids are str, `01` and 1 are one entity
+        return f'{model.__name__}:{generation}:{parse_pk(model, _id)}'
+
+    def entity(self, model: EntityMeta, _id: Any) -> str:
+        """stamp of one entity"""
+        return self._get(self._entity_key(model, _id))
+
+    def bump(self, model: EntityMeta, ids: Optional[Iterable[Any]] = None):
+        """
+        change stamps after writing
+
+        Args:
+            model: written model
+            ids: written ids, None if unknown, then every entity of model
+                is changed
+        """
+        self.backend.set(model.__name__, self._new_token())
+        if ids is None:
+            self.backend.set(f'{model.__name__}:generation', self._new_token())
+            return
+        for _id in ids:
+            self.backend.set(self._entity_key(model, _id), self._new_token())
+
+
+def _default_backend() -> typing.Optional[CacheBackend]:
+    if config.VERSION_STAMP_PATH:
+        return SQLiteBackend(config.VERSION_STAMP_PATH, maxsize=1000000)
+    return None
+
+
+version_stamps = VersionStamps(_default_backend())
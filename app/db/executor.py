@@ -0,0 +1,72 @@
+"""run blocking pony work off the asyncio loop"""
+import asyncio
+import contextvars
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+import config
+from db.session import commit_session
+from fastapi import HTTPException
+
+
+class DBExecutor:
+    """
+    Bounded thread pool for pony db work.
+
+    Each call runs in its own `commit_session` of the worker thread,
+    so a slow query only takes one thread instead of the event loop.
+    At most `max_workers + max_queue` calls are accepted,
+    others get 503 at once.
+
+    ```
+        executor = DBExecutor(max_workers=8, max_queue=64)
+        todo = await executor.run(crud.get, 1, schema=schemas.Todo)
+    ```
+    """
+
+    def __init__(self, max_workers: int, max_queue: int):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self._pool = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix='pony-db')
+        self._slots = threading.BoundedSemaphore(max_workers + max_queue)
+
+    @staticmethod
+    def _call(func: Callable, *args, **kwargs) -> Any:
+        with commit_session():
+            return func(*args, **kwargs)
+
+    async def run(self, func: Callable, *args, **kwargs) -> Any:
+        """run func in db_session of pool thread"""
+        if not self._slots.acquire(blocking=False):
+            raise HTTPException(
+                status_code=503,
+                detail='Too many database requests',
+                headers={'Retry-After': '1'},
+            )
+        try:
+            # context of request (e.g. metrics timings) goes with the call
+            future = self._pool.submit(
+                contextvars.copy_context().run,
+                self._call, func, *args, **kwargs
+            )
+        except BaseException:
+            self._slots.release()
+            raise
+        # release when the thread is done, even if the request is cancelled
+        future.add_done_callback(lambda _: self._slots.release())
+        return await asyncio.wrap_future(future)
+
+    def shutdown(self, wait: bool = True):
+        """wait running calls and stop threads"""
+        self._pool.shutdown(wait=wait)
+
+
+@functools.lru_cache()
+def get_db_executor() -> Optional[DBExecutor]:
+    """DBExecutor of config, None if DB_EXECUTION_MODE is inline"""
+    if config.DB_EXECUTION_MODE != 'threadpool':
+        return None
+    return DBExecutor(config.DB_THREAD_POOL_SIZE, config.DB_THREAD_QUEUE_SIZE)
@@ -0,0 +1,227 @@
+"""group commit of concurrent writes"""
+import asyncio
+import contextvars
+import functools
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, List, NamedTuple, Optional, Tuple
+
+import config
+from fastapi import HTTPException
+from db.session import collect_callbacks, run_callbacks
+from log import logger
+from pony.orm import db_session
+from pony.orm.core import local
+
+
+def _shutting_down() -> HTTPException:
+    return HTTPException(
+        status_code=503,
+        detail='Server is shutting down',
+        headers={'Retry-After': '1'},
+    )
+
+
+def _changes() -> int:
+    """unsaved objects and executed write statements of current db_session"""
+    changes = 0
+    for database, cache in local.db2cache.items():
+        changes += len(cache.objects_to_save) + len(cache.modified_collections)
+        changes += sum(
+            stat.db_count for sql, stat in database.local_stats.items()
+            if sql is not None and sql.lstrip()[:6].upper() != 'SELECT'
+        )
+    return changes
+
+
+class _Write(NamedTuple):
+    func: Callable
+    args: tuple
+    kwargs: dict
+    context: contextvars.Context
+    future: Future
+
+
+class WriteCoordinator:
+    """
+    Apply concurrent writes in one transaction.
+
+    A writer thread takes the first queued write, waits at most `window_ms`
+    (or until `max_batch` writes) for more, then runs them all in one
+    `db_session`, so they share one commit (one fsync on SQLite).
+    A write raising HTTPException (e.g. 404) before changing anything is
+    only its own error. If any write raises otherwise or the commit fails,
+    the transaction is rolled back and every write of the batch is run
+    again in its own `db_session`, so each request still gets its own
+    result or error. `after_commit` callbacks run once their write is
+    committed, the ones of rolled back writes are dropped.
+
+    Writes must return plain data (e.g. serialized), entities are not usable
+    after the session.
+
+    ```
+        coordinator = WriteCoordinator(window_ms=2, max_batch=64)
+        todo = await coordinator.submit(
+            lambda: serialize(crud.create(data), schemas.Todo))
+    ```
+    """
+
+    def __init__(
+            self,
+            window_ms: float = 2,
+            max_batch: int = 64,
+            max_queue: int = 1024,
+    ):
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self.max_queue = max_queue
+        self.batches = 0
+        self.replays = 0
+        self._start()
+
+    def _start(self):
+        """queue and writer thread of this process, threads are not forked"""
+        self._pid = os.getpid()
+        self._stopping = False
+        self._closed = False
+        self._queue = queue.Queue(maxsize=self.max_queue)
+        self._thread = threading.Thread(
+            target=self._run, name='group-commit', daemon=True)
+        self._thread.start()
+
+    async def submit(self, func: Callable, *args, **kwargs) -> Any:
+        """queue a write and wait for its own result"""
+        if self._pid != os.getpid():
+            # forked worker of a preloaded app, called in its event loop
+            self._start()
+        if self._closed:
+            raise _shutting_down()
+        future = Future()
+        try:
+            self._queue.put_nowait(_Write(
+                func, args, kwargs, contextvars.copy_context(), future))
+        except queue.Full as e:
+            raise HTTPException(
+                status_code=503,
+                detail='Too many write requests',
+                headers={'Retry-After': '1'},
+            ) from e
+        return await asyncio.wrap_future(future)
+
+    def _collect(self, first: _Write) -> List[_Write]:
+        """first write and the ones arriving in window"""
+        batch = [first]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                write = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if write is None:
+                # run collected writes, then stop
+                self._stopping = True
+                break
+            batch.append(write)
+        return batch
+
+    @staticmethod
+    def _call(write: _Write) -> Tuple[Any, List[Callable]]:
+        """result and `after_commit` callbacks of write"""
+        return write.context.run(
+            collect_callbacks, write.func, *write.args, **write.kwargs)
+
+    def _call_in_batch(
+            self, write: _Write
+    ) -> Tuple[Any, List[Callable], Optional[HTTPException]]:
+        """
+        result, callbacks and HTTPException of write in a shared session,
+        other errors or an HTTPException after changes fail the batch
+        """
+        changes = _changes()
+        try:
+            result, callbacks = self._call(write)
+        except HTTPException as e:
+            if _changes() != changes:
+                raise
+            return None, [], e
+        return result, callbacks, None
+
+    def _run_batch(self, batch: List[_Write]):
+        results = []
+        try:
+            with db_session:
+                for write in batch:
+                    results.append(self._call_in_batch(write))
+        except Exception as e:  # pylint:disable=broad-except
+            # callbacks of the rolled back writes are dropped
+            if len(batch) == 1:
+                batch[0].future.set_exception(e)
+                return
+            self.replays += 1
+            logger.debug(f'group commit of {len(batch)} writes failed, replay')
+            self._replay(batch)
+            return
+        self.batches += 1
+        for write, (result, callbacks, error) in zip(batch, results):
+            if error is not None:
+                write.future.set_exception(error)
+                continue
+            run_callbacks(callbacks)
+            write.future.set_result(result)
+
+    def _replay(self, batch: List[_Write]):
+        for write in batch:
+            try:
+                with db_session:
+                    result, callbacks = self._call(write)
+            except BaseException as e:  # pylint:disable=broad-except
+                write.future.set_exception(e)
+            else:
+                run_callbacks(callbacks)
+                write.future.set_result(result)
+
+    def _run(self):
+        while not self._stopping:
+            first = self._queue.get()
+            if first is None:
+                return
+            batch = self._collect(first)
+            batch = [
+                write for write in batch
+                if write.future.set_running_or_notify_cancel()
+            ]
+            if batch:
+                self._run_batch(batch)
+
+    def shutdown(self, timeout: float = 10):
+        """run queued writes and stop the thread, later writes get 503"""
+        if self._pid != os.getpid():
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            return
+        # writes queued after the stop marker
+        while True:
+            try:
+                write = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if write is not None and write.future.set_running_or_notify_cancel():
+                write.future.set_exception(_shutting_down())
+
+
+@functools.lru_cache()
+def get_write_coordinator() -> Optional[WriteCoordinator]:
+    """WriteCoordinator of config, None if DB_GROUP_COMMIT is off"""
+    if not config.DB_GROUP_COMMIT:
+        return None
+    return WriteCoordinator(
+        config.DB_GROUP_COMMIT_WINDOW_MS, config.DB_GROUP_COMMIT_MAX_BATCH)
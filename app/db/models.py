@@ -1,24 +1,99 @@
-"""models module"""
+"""
+models module
 
+Importing it does not touch the database, call `init_db()` once
+(main does it) before using entities:
+
+    bind_db()        # db.bind by config
+    init_db()        # bind_db() and generate_mapping, tables by config
+"""
+import os
+import threading
+
+import config
 from pony.orm import Database, Optional, Required, Set
+from utils.pony_filter import index_filterable
+from utils.startup import startup_profiler
+
+DB_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'demo.db')
+
+
+def define_entities(database: Database):
+    """
+    define entities on database,
+    so read replicas can have the same entities as `db`
+    """
+
+    class User(database.Entity):
+        """User table"""
+        _table_ = 'User'
+        _filterable_ = ('name',)
+        _searchable_ = ('name',)
+        name = Required(str)
+        todos = Set('Todo')
+
+    class Todo(database.Entity):
+        """To do table"""
+        _table_ = 'Todo'
+        _filterable_ = ('name', 'user')
+        _searchable_ = ('name',)
+        name = Required(str)
+
+        user = Optional(User)
+
+    index_filterable(database)
+
 
 db = Database()
+define_entities(db)
+User = db.User
+Todo = db.Todo
+
+
+@db.on_connect(provider='sqlite')
+def sqlite_wal(_, connection):
+    """WAL lets readers run while a writer is writing"""
+    if not config.DB_SQLITE_WAL:
+        return
+    cursor = connection.cursor()
+    cursor.execute('PRAGMA journal_mode = WAL')
+    cursor.execute('PRAGMA synchronous = NORMAL')
 
 
-class User(db.Entity):
-    """User table"""
-    _table_ = 'User'
-    name = Required(str)
-    todos = Set('Todo')
+_init_lock = threading.Lock()
 
 
-class Todo(db.Entity):
-    """To do table"""
-    _table_ = 'Todo'
-    name = Required(str)
+def bind_db(**bind_kwargs):
+    """
+    bind db once, by config if no bind_kwargs,
+    e.g. bind_db(provider='postgres', host=..., database=...)
+    """
+    with _init_lock:
+        if db.provider is not None:
+            return
+        if not bind_kwargs:
+            bind_kwargs = {
+                'provider': 'sqlite',
+                'filename': config.DB_FILENAME or DB_PATH,
+                'create_db': True,
+            }
+        with startup_profiler.phase('db.bind'):
+            db.bind(**bind_kwargs)
 
-    user = Optional(User)
 
+def init_db(create_tables: bool = None, **bind_kwargs):
+    """
+    bind and generate mapping once
 
-db.bind(provider='sqlite', filename='demo.db', create_db=True)
-db.generate_mapping(create_tables=True)
+    Args:
+        create_tables: create missing tables, default config.DB_CREATE_TABLES
+        bind_kwargs: see bind_db
+    """
+    bind_db(**bind_kwargs)
+    with _init_lock:
+        if db.schema is not None:
+            return
+        if create_tables is None:
+            create_tables = config.DB_CREATE_TABLES
+        with startup_profiler.phase('db.generate_mapping'):
+            db.generate_mapping(create_tables=create_tables)
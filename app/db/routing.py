@@ -0,0 +1,101 @@
+"""route reads to reader / replica databases, writes to primary"""
+import functools
+import itertools
+import threading
+import time
+from typing import Dict, List, Optional
+
+import config
+from db import models
+from pony.orm import Database
+from pony.orm.core import EntityMeta
+
+
+def make_replica(**bind_kwargs) -> Database:
+    """
+    database with the same entities as `models.db`, bound to a replica,
+    tables are not created
+
+    ```
+        replica = make_replica(provider='postgres', host='replica-1', ...)
+    ```
+    """
+    database = Database()
+    models.define_entities(database)
+    database.bind(**bind_kwargs)
+    database.generate_mapping(create_tables=False)
+    return database
+
+
+def make_sqlite_reader(filename: Optional[str] = None) -> Database:
+    """
+    another database of the same sqlite file, whose connections are read only,
+    with WAL its reads do not wait for writers of `models.db`
+    """
+    database = Database()
+    models.define_entities(database)
+
+    @database.on_connect(provider='sqlite')
+    def query_only(_, connection):  # pylint:disable=unused-variable
+        connection.cursor().execute('PRAGMA query_only = ON')
+
+    database.bind(
+        provider='sqlite',
+        filename=filename or config.DB_FILENAME or models.DB_PATH,
+    )
+    database.generate_mapping(create_tables=False)
+    return database
+
+
+class DBRouter:
+    """
+    choose database of entities for reads
+
+    Reads go to `readers` in turn, writes always use entities of `models.db`.
+    With `read_your_writes` seconds, reads of a table written in this process
+    in the last n seconds go to primary, so a client reading after its
+    write will not see the old data of a lagging replica.
+
+    ```
+        router = DBRouter([make_sqlite_reader()], read_your_writes=1)
+        crud = CRUDBase(models.Todo, db_router=router)
+    ```
+    """
+
+    def __init__(
+            self,
+            readers: List[Database],
+            read_your_writes: float = 0,
+    ):
+        self.readers = readers
+        self.read_your_writes = read_your_writes
+        self._next_reader = itertools.cycle(range(len(readers)))
+        self._lock = threading.Lock()
+        self._written_at: Dict[str, float] = {}
+
+    def read_model(self, model: EntityMeta) -> EntityMeta:
+        """entity of model on a reader, or model itself"""
+        if not self.readers:
+            return model
+        if self.read_your_writes:
+            written_at = self._written_at.get(model.__name__)
+            if (written_at is not None
+                    and time.monotonic() - written_at < self.read_your_writes):
+                return model
+        with self._lock:
+            index = next(self._next_reader)
+        return self.readers[index].entities[model.__name__]
+
+    def written(self, model: EntityMeta):
+        """mark model is written just now"""
+        if self.read_your_writes:
+            self._written_at[model.__name__] = time.monotonic()
+
+
+@functools.lru_cache()
+def get_db_router() -> Optional[DBRouter]:
+    """DBRouter of config, None if DB_READER is empty"""
+    if config.DB_READER != 'sqlite':
+        return None
+    return DBRouter(
+        [make_sqlite_reader()], read_your_writes=config.DB_READ_YOUR_WRITES)
@@ -1,25 +1,55 @@
+"""
+pydantic schemas of models
+
+Schemas are built when they are first used, e.g. `schemas.Todo`,
+so importing this module is cheap.
+"""
+import threading
+import typing
+
 from db import models
 from utils.pony_pydantic import pony_orm_to_pydantic
-import typing
+from utils.startup import startup_profiler
 
-UserCreate = pony_orm_to_pydantic(models.User, exclude=['id'], is_orm=False)
-TodoCreate = pony_orm_to_pydantic(
-    models.Todo, exclude=['id'], is_orm=False,
-    field_parameter={
-        'name': {
-            'description': 'This is name',
-            'example': '123213213'
+_SCHEMAS: typing.Dict[str, typing.Callable[[], typing.Any]] = {
+    'UserCreate': lambda: pony_orm_to_pydantic(
+        models.User, exclude=['id'], is_orm=False),
+    'TodoCreate': lambda: pony_orm_to_pydantic(
+        models.Todo, exclude=['id'], is_orm=False,
+        field_parameter={
+            'name': {
+                'description': 'This is name',
+                'example': '123213213'
+            }
         }
-    }
-)
-TodoUpdate = TodoCreate
-User = pony_orm_to_pydantic(models.User)
-Todo = pony_orm_to_pydantic(models.Todo)
-TodoWithUser = pony_orm_to_pydantic(
-    models.Todo,
-    include={'user': User}
-)
-UserWithTodos = pony_orm_to_pydantic(
-    models.User,
-    include={'todos': typing.List[Todo]}
-)
+    ),
+    'TodoUpdate': lambda: __getattr__('TodoCreate'),
+    'User': lambda: pony_orm_to_pydantic(models.User),
+    'Todo': lambda: pony_orm_to_pydantic(models.Todo),
+    'TodoWithUser': lambda: pony_orm_to_pydantic(
+        models.Todo,
+        include={'user': __getattr__('User')}
+    ),
+    'UserWithTodos': lambda: pony_orm_to_pydantic(
+        models.User,
+        include={'todos': typing.List[__getattr__('Todo')]}
+    ),
+}
+
+__all__ = list(_SCHEMAS)
+# schemas including others build them in the same thread
+_lock = threading.RLock()
+
+
+def __getattr__(name: str):
+    """build schema on first use and keep it in module"""
+    factory = _SCHEMAS.get(name)
+    if factory is None:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    with _lock:
+        if name in globals():
+            return globals()[name]
+        with startup_profiler.phase('schemas'):
+            schema = factory()
+        globals()[name] = schema
+    return schema
@@ -0,0 +1,81 @@
+"""
+db_session whose side effects run after it commits
+
+CRUDBase writes change caches, version stamps and the change feed, which
+other requests read without the transaction. They are queued by
+`after_commit` and run once the outermost `commit_session` has committed,
+a rolled back session drops them:
+
+```
+    with commit_session():
+        crud.create(data)
+    # caches are invalidated and events published here
+```
+"""
+import contextlib
+import contextvars
+from typing import Any, Callable, Iterable, List, Optional, Tuple
+
+from log import logger
+from pony.orm import db_session
+from pony.orm.core import local
+
+Callback = Callable[[], Any]
+
+_pending: contextvars.ContextVar[Optional[List[Callback]]] = (
+    contextvars.ContextVar('after_commit', default=None))
+
+
+def after_commit(callback: Callback):
+    """
+    run callback after the current `commit_session` commits,
+    at once if there is none (e.g. a plain db_session of a script)
+    """
+    pending = _pending.get()
+    if pending is None:
+        callback()
+    else:
+        pending.append(callback)
+
+
+def run_callbacks(callbacks: Iterable[Callback]):
+    """run callbacks of a committed session, the commit is kept if one fails"""
+    for callback in callbacks:
+        try:
+            callback()
+        except Exception:  # pylint:disable=broad-except
+            logger.exception('after commit callback failed')
+
+
+def collect_callbacks(
+        func: Callable, *args, **kwargs
+) -> Tuple[Any, List[Callback]]:
+    """
+    run func in the current db_session,
+    return its result and callbacks instead of queueing them,
+    for a caller which commits several funcs at once
+    """
+    pending: List[Callback] = []
+    token = _pending.set(pending)
+    try:
+        return func(*args, **kwargs), pending
+    finally:
+        _pending.reset(token)
+
+
+@contextlib.contextmanager
+def commit_session():
+    """db_session, callbacks of `after_commit` run after it commits"""
+    if local.db_session is not None and _pending.get() is not None:
+        # nested, callbacks run after the outer one
+        with db_session:
+            yield
+        return
+    pending: List[Callback] = []
+    token = _pending.set(pending)
+    try:
+        with db_session:
+            yield
+    finally:
+        _pending.reset(token)
+    run_callbacks(pending)
@@ -1,13 +1,35 @@
 """Log module"""
+import contextvars
 import datetime
+import json
 import logging
+import os
+import queue
+import random
+import sys
+import threading
+import traceback
+import uuid
+from typing import Optional
 
+import config
 from loguru import logger
 
+# set by request id middleware, copied into DBExecutor threads
+request_id_var = contextvars.ContextVar('request_id', default='-')
+
+TEXT_FORMAT = (
+    '{time:YYYY-MM-DD HH:mm:ss.SSS} | {level: <8} | {extra[request_id]} | '
+    '{name}:{function}:{line} - {message}'
+)
+
 
 class InterceptHandler(logging.Handler):
     """Customer Handler"""
 
+    # walk frames to find the caller, else use location of the stdlib record
+    find_caller = True
+
     def emit(self, record):
         """override emit method"""
         # Get corresponding Loguru level if it exists
@@ -16,6 +38,16 @@ class InterceptHandler(logging.Handler):
         except ValueError:
             level = record.levelno
 
+        if not self.find_caller:
+            logger.patch(
+                lambda r: r.update(
+                    name=record.name,
+                    function=record.funcName,
+                    line=record.lineno,
+                )
+            ).opt(exception=record.exc_info).log(level, record.getMessage())
+            return
+
         # Find caller from where originated the logged message
         frame, depth = logging.currentframe(), 2
         while frame.f_code.co_filename == logging.__file__:
@@ -26,14 +58,228 @@ class InterceptHandler(logging.Handler):
                                                                record.getMessage())
 
 
+class AccessLogSampler(logging.Filter):
+    """keep `rate` of access logs, errors are always kept"""
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING or self.rate >= 1:
+            return True
+        return random.random() < self.rate
+
+
+class DailyFileWriter:
+    """append to `<directory>/<YYYYMMDD>.log`, delete files older than retention"""
+
+    def __init__(self, directory: str, retention_days: int = 28):
+        self.directory = directory
+        self.retention_days = retention_days
+        self._date = None
+        self._file = None
+        os.makedirs(directory, exist_ok=True)
+
+    def write(self, text: str):
+        today = datetime.date.today()
+        if today != self._date:
+            self._open(today)
+        self._file.write(text)
+
+    def _open(self, today: datetime.date):
+        self.close()
+        self._date = today
+        self._file = open(  # pylint:disable=consider-using-with
+            os.path.join(self.directory, f'{today:%Y%m%d}.log'),
+            'a', encoding='utf-8'
+        )
+        oldest = today - datetime.timedelta(days=self.retention_days)
+        for name in os.listdir(self.directory):
+            try:
+                day = datetime.datetime.strptime(name, '%Y%m%d.log').date()
+            except ValueError:
+                continue
+            if day < oldest:
+                os.remove(os.path.join(self.directory, name))
+
+    def flush(self):
+        if self._file is not None:
+            self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def to_json_line(message) -> str:
+    """one json object of loguru message"""
+    record = message.record
+    data = {
+        'time': record['time'].isoformat(),
+        'level': record['level'].name,
+        'message': record['message'],
+        'name': record['name'],
+        'function': record['function'],
+        'line': record['line'],
+    }
+    data.update(record['extra'])
+    if record['exception'] is not None:
+        exc_type, exc_value, exc_traceback = record['exception']
+        data['exception'] = ''.join(
+            traceback.format_exception(exc_type, exc_value, exc_traceback))
+    return json.dumps(data, ensure_ascii=False, default=str) + '\n'
+
+
+class QueueSink:
+    """
+    loguru sink which only puts messages into a bounded queue,
+    a background thread formats and writes them,
+    so a request never waits for disk
+
+    policy `drop` drops messages when the queue is full (counted in `dropped`),
+    `block` waits for the writer, or drops if the writer thread is dead.
+    Errors of writing (e.g. disk full) are counted in `failed` and
+    reported to stderr, the writer thread keeps running.
+    """
+
+    def __init__(
+            self,
+            writer: DailyFileWriter,
+            maxsize: int = 10000,
+            policy: str = 'drop',
+            json_format: bool = False,
+            stream=None,
+    ):
+        self.writer = writer
+        self.policy = policy
+        self.json_format = json_format
+        self.stream = stream
+        self.dropped = 0
+        self.failed = 0
+        self._error: Optional[Exception] = None
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._thread = threading.Thread(
+            target=self._run, name='log-writer', daemon=True)
+        self._thread.start()
+
+    def __call__(self, message):
+        if self.policy == 'block':
+            # a dead writer would block every request forever
+            while self._thread.is_alive():
+                try:
+                    self._queue.put(message, timeout=1)
+                    return
+                except queue.Full:
+                    continue
+            self.dropped += 1
+            return
+        try:
+            self._queue.put_nowait(message)
+        except queue.Full:
+            self.dropped += 1
+
+    def _write(self, message):
+        text = to_json_line(message) if self.json_format else str(message)
+        self.writer.write(text)
+        if self.stream is not None:
+            self.stream.write(text)
+
+    def _safe(self, func, *args):
+        """call func, count and keep the error instead of raising it"""
+        try:
+            func(*args)
+        except Exception as e:  # pylint:disable=broad-except
+            self.failed += 1
+            self._error = e
+
+    def _run(self):
+        while True:
+            message = self._queue.get()
+            if message is None:
+                break
+            self._safe(self._write, message)
+            # write what is queued, then flush once
+            while True:
+                try:
+                    message = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if message is None:
+                    self._flush()
+                    return
+                self._safe(self._write, message)
+            if self.dropped:
+                dropped, self.dropped = self.dropped, 0
+                self._safe(
+                    self.writer.write, f'{dropped} log messages dropped\n')
+            self._flush()
+
+    def _flush(self):
+        self._safe(self.writer.flush)
+        if self.stream is not None:
+            self._safe(self.stream.flush)
+        if self.failed:
+            # once per batch, not for each message of a full disk
+            failed, self.failed = self.failed, 0
+            try:
+                sys.__stderr__.write(
+                    f'log writer: {failed} writes failed: {self._error!r}\n')
+            except Exception:  # pylint:disable=broad-except
+                pass
+
+    def stop(self, timeout: float = 5):
+        """write queued messages and stop the thread"""
+        self._queue.put(None)
+        self._thread.join(timeout)
+        self.writer.close()
+
+
+_queue_sink: Optional[QueueSink] = None
+
+
+def _add_request_id(record):
+    record['extra'].setdefault('request_id', request_id_var.get())
+
+
 def setup_logging():
-    """init logger"""
-    logger.add(
-        f'./logs/{datetime.date.today():%Y%m%d}.log',
-        rotation='7 day',
-        retention='28 days',
-        level='INFO',
-    )
+    """
+    init logger, see LOG_* of config
+
+    LOG_MODE=async writes by QueueSink in a background thread,
+    LOG_CALLER=false skips the caller frame lookup of stdlib records
+    """
+    global _queue_sink  # pylint:disable=global-statement
+    logger.configure(patcher=_add_request_id)
+    json_format = config.LOG_FORMAT == 'json'
+    if config.LOG_MODE == 'async':
+        # stderr is written by the writer thread too
+        logger.remove()
+        _queue_sink = QueueSink(
+            DailyFileWriter(config.LOG_DIR),
+            maxsize=config.LOG_QUEUE_SIZE,
+            policy=config.LOG_QUEUE_POLICY,
+            json_format=json_format,
+            stream=sys.stderr,
+        )
+        logger.add(
+            _queue_sink, level='INFO', format=TEXT_FORMAT, colorize=False,
+            catch=False,
+        )
+    else:
+        logger.add(
+            os.path.join(config.LOG_DIR, f'{datetime.date.today():%Y%m%d}.log'),
+            rotation='7 day',
+            retention='28 days',
+            level='INFO',
+            format=TEXT_FORMAT,
+            serialize=json_format,
+        )
+    if not config.LOG_CALLER:
+        InterceptHandler.find_caller = False
+        # stdlib looks for the caller of every record too
+        logging._srcfile = None  # pylint:disable=protected-access
     # intercept everything at the root logger
     logging.root.handlers = [InterceptHandler()]
     logging.root.setLevel('INFO')
@@ -43,3 +289,19 @@ def setup_logging():
     for name in logging.root.manager.loggerDict.keys():
         logging.getLogger(name).handlers = []
         logging.getLogger(name).propagate = True
+    if config.LOG_ACCESS_SAMPLE_RATE < 1:
+        logging.getLogger('uvicorn.access').addFilter(
+            AccessLogSampler(config.LOG_ACCESS_SAMPLE_RATE))
+
+
+def shutdown_logging():
+    """write queued messages of async mode"""
+    global _queue_sink  # pylint:disable=global-statement
+    if _queue_sink is not None:
+        _queue_sink.stop()
+        _queue_sink = None
+
+
+def new_request_id() -> str:
+    """unique id of a request"""
+    return uuid.uuid4().hex
@@ -2,12 +2,24 @@
 import os
 import sys
 
+import config
 import uvicorn
-from api.v1.router import api_router
+from api import metrics
+from api.admission import get_admission_control
+from api.auth import auth_error, get_auth_backend
+from api.v1.router import get_api_router
+from crud.changes import get_change_hub
+from crud.search import ensure_search_indexes
+from db.executor import get_db_executor
+from db.group_commit import get_write_coordinator
+from db.models import init_db
+from db.session import commit_session
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
-from log import logger, setup_logging
-from pony.orm import db_session
+from log import (logger, new_request_id, request_id_var, setup_logging,
+                 shutdown_logging)
+from starlette.middleware.authentication import AuthenticationMiddleware
+from utils.startup import startup_profiler
 
 app_path = os.path.dirname(os.path.realpath(__file__))
 sys.path.insert(0, app_path)
@@ -21,10 +33,87 @@ app = FastAPI(
 
 )
 
+# bind and map before routes, they are built from mapped entities
+init_db()
+with startup_profiler.phase('routes'):
+    app.include_router(get_api_router(), prefix='/api/v1')
+if config.METRICS_ENABLED:
+    app.include_router(metrics.router)
+
+
+@app.on_event('startup')
+async def startup_event():
+    """setup logging, create missing search indexes"""
+    with startup_profiler.phase('setup_logging'):
+        setup_logging()
+    with startup_profiler.phase('search_indexes'):
+        ensure_search_indexes()
+    startup_profiler.mark_ready()
+    logger.info(startup_profiler.report())
+
+
+@app.on_event('shutdown')
+async def shutdown_event():
+    """wait db threads, queued writes and logs, close change feed"""
+    db_executor = get_db_executor()
+    if db_executor is not None:
+        db_executor.shutdown()
+    write_coordinator = get_write_coordinator()
+    if write_coordinator is not None:
+        write_coordinator.shutdown()
+    change_hub = get_change_hub()
+    if change_hub is not None:
+        change_hub.close()
+    shutdown_logging()
+
+
+@app.middleware('http')
+async def add_pony(request: Request, call_next):
+    """
+    add pony for each api
+    in threadpool mode, crud calls of the factory have their own db_session
+    in DBExecutor threads (db_session is per thread), this one is for
+    hand-written routes and costs nothing when unused
+    """
+    with commit_session():
+        response = await call_next(request)
+    return response
+
+
+admission_control = get_admission_control()
+if admission_control is not None:
+    # inside authentication, so rate limit is per user
+    app.middleware('http')(admission_control)
+
+if get_auth_backend() is not None:
+    # outside add_pony, users are loaded in their own db_session
+    app.add_middleware(
+        AuthenticationMiddleware,
+        backend=get_auth_backend(),
+        on_error=auth_error,
+    )
+
+if config.METRICS_ENABLED:
+    # added after add_pony and admission control so it wraps them
+    app.middleware('http')(metrics.metrics_middleware)
+
+
+@app.middleware('http')
+async def add_request_id(request: Request, call_next):
+    """request id of logs, from `X-Request-ID` header or a new one"""
+    request_id = request.headers.get('X-Request-ID') or new_request_id()
+    request_id_var.set(request_id)
+    response = await call_next(request)
+    response.headers['X-Request-ID'] = request_id
+    return response
+
+
 origins = [
     '*'
 ]
 
+# added last so it is the outermost one, 401 / 429 / 503 responses get
+# CORS headers and preflights are answered before admission control
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
@@ -33,28 +122,8 @@ app.add_middleware(
     allow_headers=['*'],
 )
 
-app.include_router(api_router, prefix='/api/v1')
-
-
-@app.on_event('startup')
-async def startup_event():
-    """setup logging"""
-    setup_logging()
-    # todo
-    # app.add_middleware(
-    #     AuthenticationMiddleware,
-    #     backend=AuthenticationBackend()
-    # )
-
-
-@app.middleware('http')
-async def add_pony(request: Request, call_next):
-    """add pony for each api"""
-    with db_session:
-        response = await call_next(request)
-        return response
-
 
 if __name__ == '__main__':
+    # development server, `python server.py` to run workers in production
     uvicorn.run('main:app', host='0.0.0.0', port=5000, log_level='info',
                 reload=True, workers=1)
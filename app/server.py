@@ -0,0 +1,388 @@
+"""
+pre-fork server for production
+
+The arbiter imports the app and maps pony entities once, then forks
+workers sharing one listening socket, see SERVER_* of config:
+
+    python server.py --workers 4 --max-requests 10000 --max-rss-mb 512
+
+Signals of the arbiter:
+
+* TERM / INT: workers finish running requests and exit
+* HUP: zero downtime restart, the new code is checked by
+  `python server.py --check`, then the arbiter execs itself with the same
+  pid and socket, and stops old workers once new workers are serving
+
+A worker over max requests or max RSS exits like TERM and is forked again,
+other workers keep accepting meanwhile.
+State of a process (version stamps, response cache, revoked tokens,
+change feed) is shared by workers only with its `*_PATH` /
+CHANGE_FEED_SOCKET_DIR config. Without VERSION_STAMP_PATH more than one
+worker share version stamps in a new sqlite file of the temp directory,
+else ETags and aggregate caches of a worker miss writes of the others.
+"""
+import argparse
+import os
+import random
+import resource
+import select
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional, Set
+
+import config
+import uvicorn
+from log import logger
+
+SCRIPT = os.path.abspath(__file__)
+# passed to the arbiter exec'd by HUP
+FD_ENV = 'SERVER_FD'
+OLD_WORKERS_ENV = 'SERVER_OLD_WORKERS'
+
+
+def rss_mb() -> float:
+    """resident memory of this process, peak RSS without /proc"""
+    try:
+        with open('/proc/self/statm', encoding='ascii') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') / 1024 / 1024
+    except (OSError, ValueError, IndexError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # bytes on macOS, KiB on linux
+        return peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+
+
+def cpu_count() -> int:
+    """CPUs this process may run on, e.g. limited by taskset"""
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def share_version_stamps(workers: int):
+    """VERSION_STAMP_PATH of a new sqlite file if workers > 1 and it is empty"""
+    if workers <= 1 or config.VERSION_STAMP_PATH:
+        return
+    path = os.path.join(tempfile.mkdtemp(prefix='version-stamps-'), 'stamps.db')
+    # before the app is imported, inherited by the arbiter exec'd by HUP
+    os.environ['VERSION_STAMP_PATH'] = config.VERSION_STAMP_PATH = path
+    logger.info(f'{workers} workers share version stamps in {path}')
+
+
+def preload():
+    """import the app once, close db connections opened by mapping before fork"""
+    import main  # pylint:disable=import-outside-toplevel
+    from db import models  # pylint:disable=import-outside-toplevel
+    from db.routing import get_db_router  # pylint:disable=import-outside-toplevel
+
+    models.db.disconnect()
+    router = get_db_router()
+    if router is not None:
+        for database in router.readers:
+            database.disconnect()
+    return main.app
+
+
+class WorkerServer(uvicorn.Server):
+    """uvicorn server of a worker, tells the arbiter when it is serving"""
+
+    def __init__(
+            self,
+            server_config: uvicorn.Config,
+            ready_fd: int,
+            max_rss_mb: float = 0,
+    ):
+        super().__init__(server_config)
+        self.ready_fd = ready_fd
+        self.max_rss_mb = max_rss_mb
+
+    async def startup(self, sockets: Optional[List[socket.socket]] = None):
+        await super().startup(sockets=sockets)
+        if self.started:
+            os.write(self.ready_fd, f'{os.getpid()}\n'.encode())
+
+    async def on_tick(self, counter: int) -> bool:
+        # ticks are 0.1 second
+        if self.max_rss_mb and counter % 10 == 0 and not self.should_exit:
+            rss = rss_mb()
+            if rss > self.max_rss_mb:
+                logger.warning(
+                    f'worker {os.getpid()} RSS {rss:.0f} MB is over '
+                    f'{self.max_rss_mb:.0f} MB, restart')
+                self.should_exit = True
+        return await super().on_tick(counter)
+
+
+class Arbiter:
+    """
+    fork workers of app and keep `workers` of them running
+
+    ```
+        Arbiter(preload(), '0.0.0.0', 5000, workers=4).run()
+    ```
+    """
+
+    # seconds to wait before forking again, after a worker failed to start
+    backoff = 1.0
+
+    def __init__(
+            self,
+            app,
+            host: str,
+            port: int,
+            workers: int,
+            max_requests: int = 0,
+            max_requests_jitter: int = 0,
+            max_rss_mb: float = 0,
+            graceful_timeout: int = 30,
+            log_level: str = 'info',
+    ):
+        self.app = app
+        self.host = host
+        self.port = port
+        self.num_workers = workers
+        self.max_requests = max_requests
+        self.max_requests_jitter = max_requests_jitter
+        self.max_rss_mb = max_rss_mb
+        self.graceful_timeout = graceful_timeout
+        self.log_level = log_level
+        self.sock: Optional[socket.socket] = None
+        # pid: forked at, of this arbiter
+        self.workers: Dict[int, float] = {}
+        self.ready: Set[int] = set()
+        # workers of the arbiter before exec, stopped once workers are ready
+        self.old_workers: Set[int] = set()
+        self._old_stopped = False
+        self.stopping = False
+        self._stop_deadline = 0.0
+        self._backoff_until = 0.0
+        self._signals: List[int] = []
+        self._wake_r = self._wake_w = self._ready_r = self._ready_w = -1
+
+    def listen(self) -> socket.socket:
+        """socket of the arbiter before exec, or a new one"""
+        fd = os.environ.pop(FD_ENV, None)
+        if fd is not None:
+            sock = socket.socket(fileno=int(fd))
+        else:
+            family = socket.AF_INET6 if ':' in self.host else socket.AF_INET
+            sock = socket.socket(family, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind((self.host, self.port))
+            sock.listen(2048)
+        sock.set_inheritable(True)
+        return sock
+
+    def run(self):
+        self.sock = self.listen()
+        self._wake_r, self._wake_w = os.pipe()
+        self._ready_r, self._ready_w = os.pipe()
+        for fd in (self._wake_r, self._wake_w, self._ready_r):
+            os.set_blocking(fd, False)
+        signal.set_wakeup_fd(self._wake_w)
+        for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGCHLD):
+            signal.signal(sig, self._on_signal)
+        self.old_workers = {
+            int(pid) for pid in os.environ.pop(OLD_WORKERS_ENV, '').split(',')
+            if pid
+        }
+        logger.info(
+            f'arbiter {os.getpid()} listening on {self.host}:{self.port}, '
+            f'{self.num_workers} workers')
+        if self.max_rss_mb and rss_mb() >= self.max_rss_mb:
+            logger.warning(
+                f'RSS of the preloaded app {rss_mb():.0f} MB is over max RSS, '
+                f'workers will restart at once')
+        while True:
+            if not self.stopping:
+                self._spawn_missing()
+            select.select([self._wake_r, self._ready_r], [], [], 1.0)
+            self._drain(self._wake_r)
+            self._read_ready()
+            while self._signals:
+                self._handle(self._signals.pop(0))
+            self._reap()
+            if self.stopping:
+                if not self.workers and not self.old_workers:
+                    break
+                if time.monotonic() > self._stop_deadline:
+                    self._kill(self.workers.keys() | self.old_workers, signal.SIGKILL)
+        logger.info(f'arbiter {os.getpid()} stopped')
+
+    def _on_signal(self, sig: int, _frame):
+        self._signals.append(sig)
+
+    @staticmethod
+    def _drain(fd: int) -> bytes:
+        data = b''
+        while True:
+            try:
+                chunk = os.read(fd, 4096)
+            except BlockingIOError:
+                return data
+            if not chunk:
+                return data
+            data += chunk
+
+    @staticmethod
+    def _kill(pids, sig: int):
+        for pid in list(pids):
+            try:
+                os.kill(pid, sig)
+            except ProcessLookupError:
+                pass
+
+    def _handle(self, sig: int):
+        if sig in (signal.SIGTERM, signal.SIGINT):
+            self.stop(force=sig == signal.SIGINT and self.stopping)
+        elif sig == signal.SIGHUP:
+            self.restart()
+
+    def _read_ready(self):
+        for pid in self._drain(self._ready_r).split():
+            if int(pid) in self.workers:
+                self.ready.add(int(pid))
+        if (self.old_workers and not self._old_stopped
+                and len(self.ready) >= self.num_workers):
+            logger.info(
+                f'new workers are serving, stop {len(self.old_workers)} old workers')
+            self._kill(self.old_workers, signal.SIGTERM)
+            self._old_stopped = True
+
+    def _reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            self.old_workers.discard(pid)
+            if self.workers.pop(pid, None) is None or self.stopping:
+                self.ready.discard(pid)
+                continue
+            code = os.waitstatus_to_exitcode(status)
+            if pid in self.ready:
+                self.ready.discard(pid)
+                logger.info(f'worker {pid} exited ({code}), fork a new one')
+            else:
+                logger.error(f'worker {pid} exited ({code}) before serving')
+                self._backoff_until = time.monotonic() + self.backoff
+
+    def _spawn_missing(self):
+        while (len(self.workers) < self.num_workers
+               and time.monotonic() >= self._backoff_until):
+            self.spawn()
+
+    def spawn(self):
+        pid = os.fork()
+        if pid:
+            self.workers[pid] = time.monotonic()
+            return
+        code = 1
+        try:
+            self._serve()
+            code = 0
+        except SystemExit as e:
+            code = e.code if isinstance(e.code, int) else 1
+        except BaseException:  # pylint:disable=broad-except
+            logger.exception('worker failed')
+        finally:
+            os._exit(code)  # pylint:disable=protected-access
+
+    def _serve(self):
+        """run uvicorn in the forked worker"""
+        signal.set_wakeup_fd(-1)
+        for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGCHLD):
+            signal.signal(sig, signal.SIG_DFL)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        for fd in (self._wake_r, self._wake_w, self._ready_r):
+            os.close(fd)
+        max_requests = None
+        if self.max_requests:
+            # workers started together do not restart together
+            max_requests = self.max_requests + random.randint(
+                0, self.max_requests_jitter)
+        server = WorkerServer(
+            uvicorn.Config(
+                self.app,
+                log_level=self.log_level,
+                limit_max_requests=max_requests,
+                timeout_graceful_shutdown=self.graceful_timeout,
+            ),
+            self._ready_w,
+            self.max_rss_mb,
+        )
+        server.run(sockets=[self.sock])
+
+    def stop(self, force: bool = False):
+        """stop workers, kill them after graceful_timeout or if force"""
+        if not self.stopping:
+            logger.info(f'arbiter {os.getpid()} stopping')
+            self.stopping = True
+            self._stop_deadline = time.monotonic() + self.graceful_timeout + 5
+            self._kill(self.workers.keys() | self.old_workers, signal.SIGTERM)
+        if force:
+            self._stop_deadline = 0.0
+
+    def restart(self):
+        """exec the new code with this pid and socket, if it can be imported"""
+        if self.stopping or self.old_workers:
+            logger.warning('restart is already running')
+            return
+        logger.info('check new code before restart')
+        check = subprocess.run(
+            [sys.executable, SCRIPT, '--check'], check=False)
+        if check.returncode != 0:
+            logger.error(f'new code failed to import ({check.returncode}), keep running')
+            return
+        os.environ[FD_ENV] = str(self.sock.fileno())
+        os.environ[OLD_WORKERS_ENV] = ','.join(str(pid) for pid in self.workers)
+        signal.set_wakeup_fd(-1)
+        logger.info(f'arbiter {os.getpid()} exec new code')
+        os.execv(sys.executable, [sys.executable, SCRIPT] + sys.argv[1:])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n', 1)[0])
+    parser.add_argument('--host', default=config.SERVER_HOST)
+    parser.add_argument('--port', type=int, default=config.SERVER_PORT)
+    parser.add_argument('--workers', type=int, default=config.SERVER_WORKERS,
+                        help='0 is the CPU count')
+    parser.add_argument('--max-requests', type=int,
+                        default=config.SERVER_MAX_REQUESTS)
+    parser.add_argument('--max-requests-jitter', type=int,
+                        default=config.SERVER_MAX_REQUESTS_JITTER)
+    parser.add_argument('--max-rss-mb', type=float,
+                        default=config.SERVER_MAX_RSS_MB)
+    parser.add_argument('--graceful-timeout', type=int,
+                        default=config.SERVER_GRACEFUL_TIMEOUT)
+    parser.add_argument('--log-level', default='info')
+    parser.add_argument('--check', action='store_true',
+                        help='import the app and exit')
+    args = parser.parse_args()
+    workers = args.workers or cpu_count()
+    if not args.check:
+        share_version_stamps(workers)
+    app = preload()
+    if args.check:
+        return
+    Arbiter(
+        app,
+        args.host,
+        args.port,
+        workers=workers,
+        max_requests=args.max_requests,
+        max_requests_jitter=args.max_requests_jitter,
+        max_rss_mb=args.max_rss_mb,
+        graceful_timeout=args.graceful_timeout,
+        log_level=args.log_level,
+    ).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,252 @@
+"""in-process and local cache backends"""
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional
+
+_MISSING = object()
+
+
+class CacheBackend:
+    """
+    cache backend interface
+
+    Subclass it to store cache in somewhere else,
+    only `get`, `set`, `delete` and `clear` are needed.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """get value, return default if missing or expired"""
+        raise NotImplementedError
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        """set value, ttl in seconds"""
+        raise NotImplementedError
+
+    def delete(self, key: Hashable):
+        """delete value"""
+        raise NotImplementedError
+
+    def clear(self):
+        """delete all values"""
+        raise NotImplementedError
+
+    def stats(self) -> Dict[str, int]:
+        """hit / miss / eviction counters"""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+class TTLCache(CacheBackend):
+    """
+    thread safe LRU cache with ttl,
+    maxsize None never evicts, values are only dropped when expired
+
+    ```
+        cache = TTLCache(maxsize=1024, ttl=30)
+        cache.set('key', 1)
+        cache.get('key')
+    ```
+    """
+
+    # drop expired values after every n set when maxsize is None
+    purge_interval = 1024
+
+    def __init__(self, maxsize: Optional[int] = 1024, ttl: Optional[float] = None):
+        super().__init__()
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._sets = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """get value, expired value is treated as missing"""
+        with self._lock:
+            item = self._data.get(key, _MISSING)
+            if item is _MISSING:
+                self.misses += 1
+                return default
+            expire_at, value = item
+            if expire_at is not None and expire_at <= time.monotonic():
+                del self._data[key]
+                self.evictions += 1
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        """set value, evict the least recently used one if full"""
+        ttl = self.ttl if ttl is None else ttl
+        expire_at = time.monotonic() + ttl if ttl is not None else None
+        with self._lock:
+            self._data[key] = (expire_at, value)
+            self._data.move_to_end(key)
+            if self.maxsize is None:
+                self._sets += 1
+                if self._sets % self.purge_interval == 0:
+                    self._purge()
+                return
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def _purge(self):
+        now = time.monotonic()
+        expired = [
+            key for key, (expire_at, _) in self._data.items()
+            if expire_at is not None and expire_at <= now
+        ]
+        for key in expired:
+            del self._data[key]
+        self.evictions += len(expired)
+
+    def delete(self, key: Hashable):
+        """delete value"""
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        """delete all values"""
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+MemoryBackend = TTLCache
+
+
+class SQLiteBackend(CacheBackend):
+    """
+    on-disk LRU cache with ttl, shared by workers on the same machine,
+    maxsize None never evicts, values are only dropped when expired
+
+    Keys should be str, values are pickled.
+    Counters are counted by each process.
+
+    ```
+        cache = SQLiteBackend('/tmp/app-cache.db', maxsize=10000, ttl=60)
+    ```
+    """
+
+    # check size after every n set, so set will not count table every time
+    evict_check_interval = 64
+
+    def __init__(
+            self,
+            path: str,
+            maxsize: Optional[int] = 10000,
+            ttl: Optional[float] = None
+    ):
+        super().__init__()
+        self.path = path
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._local = threading.local()
+        self._forked_connections = []
+        self._sets = 0
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        with self._connection() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS cache ('
+                'key TEXT PRIMARY KEY, value BLOB, '
+                'expire_at REAL, accessed_at REAL)'
+            )
+            conn.execute(
+                'CREATE INDEX IF NOT EXISTS cache_accessed_at '
+                'ON cache (accessed_at)'
+            )
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid != os.getpid():
+            # opened before fork, keep it unused like pony does,
+            # closing it in the child may release locks of the parent
+            self._forked_connections.append(conn)
+            conn = None
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """get value, expired value is treated as missing"""
+        conn = self._connection()
+        now = time.time()
+        row = conn.execute(
+            'SELECT value, expire_at FROM cache WHERE key = ?', (str(key),)
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return default
+        value, expire_at = row
+        if expire_at is not None and expire_at <= now:
+            conn.execute('DELETE FROM cache WHERE key = ?', (str(key),))
+            self.evictions += 1
+            self.misses += 1
+            return default
+        conn.execute(
+            'UPDATE cache SET accessed_at = ? WHERE key = ?', (now, str(key))
+        )
+        self.hits += 1
+        return pickle.loads(value)
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        """set value, evict the least recently used ones if full"""
+        ttl = self.ttl if ttl is None else ttl
+        now = time.time()
+        expire_at = now + ttl if ttl is not None else None
+        conn = self._connection()
+        conn.execute(
+            'INSERT OR REPLACE INTO cache (key, value, expire_at, accessed_at) '
+            'VALUES (?, ?, ?, ?)',
+            (str(key), pickle.dumps(value), expire_at, now)
+        )
+        self._sets += 1
+        if self._sets % self.evict_check_interval == 0:
+            self._evict(conn)
+
+    def _evict(self, conn: sqlite3.Connection):
+        if self.maxsize is None:
+            expired = conn.execute(
+                'DELETE FROM cache WHERE expire_at <= ?', (time.time(),)
+            ).rowcount
+            self.evictions += max(expired, 0)
+            return
+        size = conn.execute('SELECT count(*) FROM cache').fetchone()[0]
+        overflow = size - self.maxsize
+        if overflow > 0:
+            conn.execute(
+                'DELETE FROM cache WHERE key IN ('
+                'SELECT key FROM cache ORDER BY accessed_at LIMIT ?)',
+                (overflow,)
+            )
+            self.evictions += overflow
+
+    def delete(self, key: Hashable):
+        """delete value"""
+        self._connection().execute(
+            'DELETE FROM cache WHERE key = ?', (str(key),))
+
+    def clear(self):
+        """delete all values"""
+        self._connection().execute('DELETE FROM cache')
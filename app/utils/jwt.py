@@ -0,0 +1,75 @@
+"""HS256 json web token by standard library"""
+import base64
+import hashlib
+import hmac
+import json
+import time
+from typing import Any, Dict, Optional
+
+_HEADER = {'alg': 'HS256', 'typ': 'JWT'}
+
+
+class TokenError(ValueError):
+    """invalid, expired or not yet valid token"""
+
+
+def _b64encode(data: bytes) -> bytes:
+    return base64.urlsafe_b64encode(data).rstrip(b'=')
+
+
+def _b64decode(data: bytes) -> bytes:
+    return base64.urlsafe_b64decode(data + b'=' * (-len(data) % 4))
+
+
+def _sign(signing_input: bytes, secret: str) -> bytes:
+    return hmac.new(secret.encode(), signing_input, hashlib.sha256).digest()
+
+
+def encode(claims: Dict[str, Any], secret: str) -> str:
+    """signed token of claims"""
+    signing_input = b'.'.join((
+        _b64encode(json.dumps(_HEADER, separators=(',', ':')).encode()),
+        _b64encode(json.dumps(claims, separators=(',', ':')).encode()),
+    ))
+    return (
+        signing_input + b'.' + _b64encode(_sign(signing_input, secret))
+    ).decode()
+
+
+def decode(
+        token: str,
+        secret: str,
+        leeway: float = 0,
+        now: Optional[float] = None,
+) -> Dict[str, Any]:
+    """
+    verified claims of token, `exp` and `nbf` are checked if present
+
+    Raises:
+        TokenError
+    """
+    try:
+        raw = token.encode('ascii')
+        signing_input, signature = raw.rsplit(b'.', 1)
+        header_b64, payload_b64 = signing_input.split(b'.')
+        header = json.loads(_b64decode(header_b64))
+        signature = _b64decode(signature)
+    except ValueError as e:
+        raise TokenError('malformed token') from e
+    # only HS256, a token can not choose `none` or another algorithm
+    if not isinstance(header, dict) or header.get('alg') != 'HS256':
+        raise TokenError('unsupported algorithm')
+    if not hmac.compare_digest(signature, _sign(signing_input, secret)):
+        raise TokenError('invalid signature')
+    try:
+        claims = json.loads(_b64decode(payload_b64))
+    except ValueError as e:
+        raise TokenError('malformed token') from e
+    if not isinstance(claims, dict):
+        raise TokenError('malformed token')
+    now = time.time() if now is None else now
+    if 'exp' in claims and now > claims['exp'] + leeway:
+        raise TokenError('token expired')
+    if 'nbf' in claims and now < claims['nbf'] - leeway:
+        raise TokenError('token not yet valid')
+    return claims
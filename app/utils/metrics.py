@@ -0,0 +1,235 @@
+"""in-process metrics in prometheus text format"""
+import bisect
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Sequence, Tuple
+
+from pony.orm import Database
+
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Counter:
+    """monotonic counter"""
+    kind = 'counter'
+
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0):
+        with self._lock:
+            self.value += amount
+
+    def samples(self, name: str, labels: Labels):
+        yield name, labels, self.value
+
+
+class Gauge(Counter):
+    """value goes up and down, e.g. requests in flight"""
+    kind = 'gauge'
+
+    def dec(self, amount: float = 1.0):
+        with self._lock:
+            self.value -= amount
+
+
+class Histogram:
+    """histogram with buckets allocated once, observe is one bisect + add"""
+    kind = 'histogram'
+
+    def __init__(self, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        # last one is +Inf
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def samples(self, name: str, labels: Labels):
+        with self._lock:
+            counts = list(self.counts)
+            total = self.sum
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            yield name + '_bucket', labels + (('le', le),), cumulative
+        yield name + '_sum', labels, total
+        yield name + '_count', labels, cumulative
+
+
+class MetricsRegistry:
+    """
+    metrics by name and labels
+
+    ```
+        metrics.histogram('http_request_duration_seconds', route='/todo').observe(0.01)
+        metrics.render()
+    ```
+    """
+
+    def __init__(self):
+        self._metrics: Dict[Tuple[str, Labels], object] = {}
+        self._help: Dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name: str, labels: Dict[str, str], **kwargs):
+        key = (name, tuple(sorted(labels.items())))
+        metric = self._metrics.get(key)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.get(key)
+                if metric is None:
+                    metric = self._metrics[key] = cls(**kwargs)
+        return metric
+
+    def describe(self, name: str, text: str):
+        """HELP text of metric"""
+        self._help[name] = text
+
+    def counter(self, name: str, **labels: str) -> Counter:
+        return self._get(Counter, name, labels)
+
+    def gauge(self, name: str, **labels: str) -> Gauge:
+        return self._get(Gauge, name, labels)
+
+    def histogram(
+            self,
+            name: str,
+            buckets: Sequence[float] = DEFAULT_BUCKETS,
+            **labels: str
+    ) -> Histogram:
+        return self._get(Histogram, name, labels, buckets=buckets)
+
+    def clear(self):
+        with self._lock:
+            self._metrics.clear()
+
+    def render(self) -> str:
+        """prometheus text exposition format 0.0.4"""
+        lines: List[str] = []
+        seen = set()
+        for (name, labels), metric in sorted(
+                list(self._metrics.items()), key=lambda x: x[0]):
+            if name not in seen:
+                seen.add(name)
+                if name in self._help:
+                    lines.append(f'# HELP {name} {self._help[name]}')
+                lines.append(f'# TYPE {name} {metric.kind}')
+            for sample_name, sample_labels, value in metric.samples(name, labels):
+                lines.append(
+                    f'{sample_name}{_format_labels(sample_labels)} {value}')
+        lines.append('')
+        return '\n'.join(lines)
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ''
+    pairs = ','.join(
+        '{}="{}"'.format(
+            key,
+            str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+        )
+        for key, value in labels
+    )
+    return '{' + pairs + '}'
+
+
+metrics = MetricsRegistry()
+metrics.describe('http_requests_total', 'Requests by route, method and status')
+metrics.describe('http_requests_in_flight', 'Requests being handled')
+metrics.describe('http_request_duration_seconds', 'Request latency')
+metrics.describe('db_session_duration_seconds',
+                 'Time of crud work in db_session, includes sql and serialization in it')
+metrics.describe('db_sql_duration_seconds', 'Time spent in sql')
+metrics.describe('serialize_duration_seconds', 'Time of serializing response')
+
+
+class RequestTimings:
+    """seconds spent in each part of one request"""
+    __slots__ = ('db', 'sql', 'serialize')
+
+    def __init__(self):
+        self.db = 0.0
+        self.sql = 0.0
+        self.serialize = 0.0
+
+
+# copied into DBExecutor threads, so timings of a request are added to one object
+_timings = contextvars.ContextVar('request_timings', default=None)
+
+
+def start_request() -> RequestTimings:
+    """timings of current request, set by metrics middleware"""
+    timings = RequestTimings()
+    _timings.set(timings)
+    return timings
+
+
+def _sql_time(database: Database) -> float:
+    return sum(stat.sum_time or 0.0 for stat in database.local_stats.values())
+
+
+@contextmanager
+def track_db(database: Database):
+    """add time of the block and its sql (from pony local_stats) to the request"""
+    timings = _timings.get()
+    if timings is None:
+        yield
+        return
+    sql_start = _sql_time(database)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.db += time.perf_counter() - start
+        timings.sql += _sql_time(database) - sql_start
+
+
+@contextmanager
+def track_serialize():
+    """add time of the block to serialize time of the request"""
+    timings = _timings.get()
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.serialize += time.perf_counter() - start
+
+
+def observe_request(
+        route: str,
+        method: str,
+        status: int,
+        elapsed: float,
+        timings: RequestTimings,
+):
+    """record one finished request"""
+    metrics.counter(
+        'http_requests_total', route=route, method=method, status=str(status)).inc()
+    metrics.histogram(
+        'http_request_duration_seconds', route=route, method=method
+    ).observe(elapsed)
+    if timings.db:
+        metrics.histogram('db_session_duration_seconds', route=route).observe(timings.db)
+        metrics.histogram('db_sql_duration_seconds', route=route).observe(timings.sql)
+    if timings.serialize:
+        metrics.histogram(
+            'serialize_duration_seconds', route=route).observe(timings.serialize)
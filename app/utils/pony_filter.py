@@ -0,0 +1,247 @@
+"""filter and sort query language of pony entity"""
+import datetime
+import decimal
+import typing
+import uuid
+from typing import Any, Iterable, List, NamedTuple, Optional, Tuple
+
+from pony.orm import Database, desc
+from pony.orm.core import EntityMeta, Query
+
+OPERATORS = ('eq', 'in', 'gt', 'gte', 'lt', 'lte', 'startswith')
+RELATION_OPERATORS = ('eq', 'in')
+# query params used by pagination and routes, never filters
+RESERVED_PARAMS = {
+    'offset', 'limit', 'cursor', 'with_count', 'fields', 'sort', 'format',
+}
+
+
+class FilterError(ValueError):
+    """invalid filter or sort"""
+
+
+class Filter(NamedTuple):
+    """one condition, e.g. name__startswith=abc"""
+    name: str
+    op: str
+    value: Any
+
+
+def index_filterable(database: Database):
+    """
+    create index of every attribute in `_filterable_` of entities,
+    call it before `generate_mapping`
+
+    ```
+        class Todo(db.Entity):
+            _filterable_ = ('name',)
+            name = Required(str)
+    ```
+    """
+    for entity in database.entities.values():
+        for name in getattr(entity, '_filterable_', ()):
+            attr = entity._adict_[name]  # pylint:disable=protected-access
+            # relation is str before mapping, its foreign key has index already
+            if isinstance(attr.py_type, (str, EntityMeta)):
+                continue
+            if not (attr.is_pk or attr.is_unique or attr.index):
+                attr.index = True
+
+
+def is_indexed(entity: EntityMeta, attr) -> bool:
+    """attribute is the first column of an index (or a foreign key)"""
+    if attr.is_pk or attr.is_unique or attr.index:
+        return True
+    if isinstance(attr.py_type, EntityMeta) and attr.columns:
+        # pony creates index of foreign key
+        return True
+    return any(
+        index.attrs and index.attrs[0] is attr
+        for index in entity._indexes_  # pylint:disable=protected-access
+    )
+
+
+def _convert(py_type: type, raw: str) -> Any:
+    if py_type is str:
+        return raw
+    if py_type is bool:
+        if raw.lower() in ('1', 'true', 'yes'):
+            return True
+        if raw.lower() in ('0', 'false', 'no'):
+            return False
+        raise ValueError(raw)
+    if py_type in (datetime.datetime, datetime.date, datetime.time):
+        return py_type.fromisoformat(raw)
+    if py_type in (int, float, decimal.Decimal, uuid.UUID):
+        return py_type(raw)
+    raise ValueError(raw)
+
+
+def parse_pk(entity: EntityMeta, value: Any) -> Any:
+    """
+    primary key value of its type, e.g. `'01'` of a path is 1,
+    left as it is if it can not be converted
+    """
+    pk_attrs = entity._pk_attrs_  # pylint:disable=protected-access
+    if len(pk_attrs) != 1 or not isinstance(value, str):
+        return value
+    try:
+        return _convert(pk_attrs[0].py_type, value)
+    except (TypeError, ValueError):
+        return value
+
+
+def parse_value(py_type: type, value: Any) -> Any:
+    """
+    json value of its attribute type, e.g. datetime of a cursor is str,
+    raise ValueError if it is not of the type
+    """
+    if isinstance(value, str):
+        if issubclass(py_type, str):
+            return value
+        try:
+            return _convert(py_type, value)
+        except TypeError as e:
+            raise ValueError(value) from e
+    if isinstance(value, bool) != (py_type is bool):
+        raise ValueError(value)
+    if py_type is float and isinstance(value, int):
+        return float(value)
+    if not isinstance(value, py_type):
+        raise ValueError(value)
+    return value
+
+
+def _attr_of(entity: EntityMeta, name: str):
+    attr = entity._adict_.get(name)  # pylint:disable=protected-access
+    if attr is None or attr.is_collection:
+        raise FilterError(f'Unknown field: {name}')
+    return attr
+
+
+def parse_filters(
+        entity: EntityMeta,
+        params: Iterable[Tuple[str, str]],
+        strict: bool = True,
+) -> Tuple[List[Filter], List[str]]:
+    """
+    parse query params into typed filters
+
+    `name=a`, `name__in=a,b`, `id__gte=10`, `name__startswith=ab`,
+    relation is filtered by primary key: `user=1`, `user__in=1,2`.
+    Params which are not attributes of entity are ignored.
+
+    Args:
+        entity: pony entity
+        params: query params, e.g. request.query_params.multi_items()
+        strict: raise FilterError for field without index, else warn
+
+    Returns:
+        (filters, warnings)
+    """
+    filters = []
+    warnings = []
+    for key, raw in params:
+        if key in RESERVED_PARAMS:
+            continue
+        name, _, op = key.partition('__')
+        if name not in entity._adict_:  # pylint:disable=protected-access
+            continue
+        op = op or 'eq'
+        attr = _attr_of(entity, name)
+        is_relation = isinstance(attr.py_type, EntityMeta)
+        allowed = RELATION_OPERATORS if is_relation else OPERATORS
+        if op not in allowed:
+            raise FilterError(f'Unknown operator of {name}: {op}')
+        if not is_indexed(entity, attr):
+            message = f'{entity.__name__}.{name} has no index, filter will scan the table'
+            if strict:
+                raise FilterError(message)
+            warnings.append(message)
+        py_type = (
+            attr.py_type._pk_attrs_[0].py_type  # pylint:disable=protected-access
+            if is_relation else attr.py_type
+        )
+        try:
+            if op == 'in':
+                value = [_convert(py_type, x) for x in raw.split(',') if x]
+                if not value:
+                    raise ValueError(raw)
+            else:
+                value = _convert(py_type, raw)
+        except (TypeError, ValueError) as e:
+            raise FilterError(f'Invalid value of {key}: {raw}') from e
+        filters.append(Filter(name, op, value))
+    return filters, warnings
+
+
+def parse_sort(
+        entity: EntityMeta,
+        raw: Optional[str],
+        strict: bool = True,
+) -> Tuple[List[Tuple[str, bool]], List[str]]:
+    """
+    parse `sort=-name,id` into [(name, is_desc)]
+
+    Returns:
+        (sort, warnings)
+    """
+    sort = []
+    warnings = []
+    for item in (raw or '').split(','):
+        item = item.strip()
+        if not item:
+            continue
+        is_desc = item.startswith('-')
+        name = item.lstrip('-+')
+        attr = _attr_of(entity, name)
+        if not is_indexed(entity, attr):
+            message = f'{entity.__name__}.{name} has no index, sort will scan the table'
+            if strict:
+                raise FilterError(message)
+            warnings.append(message)
+        sort.append((name, is_desc))
+    return sort, warnings
+
+
+def apply_filters(query: Query, filters: Iterable[Filter]) -> Query:
+    """compile filters into pony query"""
+    for name, op, value in filters:
+        entity = query._translator.expr_type  # pylint:disable=protected-access
+        if isinstance(entity._adict_[name].py_type, EntityMeta):  # pylint:disable=protected-access
+            if op == 'in':
+                query = query.filter(lambda o: getattr(o, name).id in value)
+            else:
+                query = query.filter(lambda o: getattr(o, name).id == value)
+        elif op == 'eq':
+            query = query.filter(lambda o: getattr(o, name) == value)
+        elif op == 'in':
+            query = query.filter(lambda o: getattr(o, name) in value)
+        elif op == 'gt':
+            query = query.filter(lambda o: getattr(o, name) > value)
+        elif op == 'gte':
+            query = query.filter(lambda o: getattr(o, name) >= value)
+        elif op == 'lt':
+            query = query.filter(lambda o: getattr(o, name) < value)
+        elif op == 'lte':
+            query = query.filter(lambda o: getattr(o, name) <= value)
+        elif op == 'startswith':
+            query = query.filter(lambda o: getattr(o, name).startswith(value))
+    return query
+
+
+def apply_sort(
+        query: Query,
+        entity: EntityMeta,
+        sort: typing.Sequence[Tuple[str, bool]],
+) -> Query:
+    """order query by sort, id is the last key so pages are stable"""
+    if not sort:
+        return query
+    keys = [
+        desc(getattr(entity, name)) if is_desc else getattr(entity, name)
+        for name, is_desc in sort
+    ]
+    if 'id' not in [name for name, _ in sort]:
+        keys.append(entity.id)
+    return query.order_by(*keys)
@@ -1,9 +1,18 @@
 """pony to BaseModel"""
-from typing import List, Type, TypeVar
+import datetime
+import decimal
+import functools
+import json
+from typing import Any, Callable, Dict, List, Optional, Tuple, Type, TypeVar
 
 from pony.orm.core import EntityMeta
 from pydantic import BaseModel, Field, create_model
 
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
 ModelType = TypeVar('ModelType')
 
 
@@ -11,6 +20,21 @@ class OrmConfig:
     orm_mode = True
 
 
+def _is_relation(column) -> bool:
+    """py_type of relation is str (entity name) before generate_mapping"""
+    return isinstance(column.py_type, (EntityMeta, str))
+
+
+def _is_nullable(column) -> bool:
+    """
+    nullable of column, which is set by generate_mapping,
+    before that optional columns without empty value (e.g. '') are nullable
+    """
+    if column.nullable is not None or column.is_collection:
+        return bool(column.nullable)
+    return not column.is_required and not column.type_has_empty_value
+
+
 def pony_orm_to_pydantic(
         db_model: ModelType,
         class_name: str = None,
@@ -30,26 +54,193 @@ def pony_orm_to_pydantic(
         config = None
     fields = {}
     for column in db_model._attrs_:  # pylint:disable=protected-access
-        python_type = (
-            include[column.name]
-            if column.name in include else
-            column.py_type
-        )
-
-        if isinstance(python_type, EntityMeta) or column.name in exclude:
+        if column.name in exclude:
             continue
+        if column.name in include:
+            python_type = include[column.name]
+        elif _is_relation(column):
+            continue
+        else:
+            python_type = column.py_type
         assert python_type, f'Could not infer python_type for {column}'
 
         default = None
-        if column.default is None and not column.nullable:
+        if column.default is None and not _is_nullable(column):
             default = ...
         parameters = field_parameter.get(column.name, {})
         fields[column.name] = (python_type, Field(default, **parameters))
 
     exclude_str = '_exclude_' + '_'.join(exclude) if exclude else ''
-    _class_name = f'{db_model.__name__}{"ORM" if is_orm else ""}{exclude_str}'
+    include_str = '_include_' + '_'.join(include) if include else ''
+    _class_name = (
+        f'{db_model.__name__}{"ORM" if is_orm else ""}'
+        f'{exclude_str}{include_str}'
+    )
     class_name = class_name or _class_name
     pydantic_model = create_model(
         class_name, __config__=config, **fields
     )
+    pydantic_model.__pony_entity__ = db_model
+    pydantic_model.__pony_include__ = include
     return pydantic_model
+
+
+@functools.lru_cache(maxsize=None)
+def get_prefetch(
+        db_model: EntityMeta,
+        schema: Type[BaseModel],
+) -> Tuple[Any, ...]:
+    """
+    pony attributes to prefetch for nested schemas of `include=`,
+    e.g. (User.todos,) for UserWithTodos
+
+    ```
+        query = models.User.select().prefetch(
+            *get_prefetch(models.User, schemas.UserWithTodos))
+    ```
+    """
+    include = getattr(schema, '__pony_include__', None) or {}
+    attrs = {
+        attr.name: attr
+        for attr in db_model._attrs_  # pylint:disable=protected-access
+    }
+    prefetch = []
+    for name in include:
+        attr = attrs.get(name)
+        field = schema.__fields__.get(name)
+        if attr is None or field is None:
+            continue
+        if not isinstance(attr.py_type, EntityMeta):
+            continue
+        prefetch.append(attr)
+        nested = field.type_
+        if isinstance(nested, type) and issubclass(nested, BaseModel):
+            for nested_attr in get_prefetch(attr.py_type, nested):
+                if nested_attr not in prefetch:
+                    prefetch.append(nested_attr)
+    return tuple(prefetch)
+
+
+@functools.lru_cache(maxsize=None)
+def get_serializer(
+        db_model: EntityMeta,
+        schema: Type[BaseModel],
+) -> Optional[Callable[[Any], Dict[str, Any]]]:
+    """
+    compile a serializer of (entity, schema) which reads attributes
+    of pony object into dict without pydantic validation,
+    the data is read from our own database so it is already valid.
+
+    Return None if schema has a field which is not an attribute of entity.
+
+    ```
+        serialize = get_serializer(models.Todo, schemas.TodoWithUser)
+        # def serialize(o):
+        #     return {'id': o.id, 'name': o.name,
+        #             'user': (_s2(o.user) if o.user is not None else None)}
+    ```
+    """
+    attrs = {
+        attr.name: attr
+        for attr in db_model._attrs_  # pylint:disable=protected-access
+    }
+    env = {}
+    items = []
+    for index, (name, field) in enumerate(schema.__fields__.items()):
+        attr = attrs.get(name)
+        if attr is None:
+            return None
+        nested = field.type_
+        if isinstance(nested, type) and issubclass(nested, BaseModel):
+            if not isinstance(attr.py_type, EntityMeta):
+                return None
+            sub_serializer = get_serializer(attr.py_type, nested)
+            if sub_serializer is None:
+                return None
+            env[f'_s{index}'] = sub_serializer
+            if attr.is_collection:
+                expr = f'[_s{index}(x) for x in o.{name}]'
+            else:
+                expr = f'(_s{index}(o.{name}) if o.{name} is not None else None)'
+        elif isinstance(attr.py_type, EntityMeta):
+            return None
+        else:
+            expr = f'o.{name}'
+        items.append(f'{field.alias!r}: {expr}')
+    source = 'def serialize(o):\n    return {' + ', '.join(items) + '}\n'
+    exec(compile(source, f'<serializer {schema.__name__}>', 'exec'), env)  # pylint:disable=exec-used
+    return env['serialize']
+
+
+def serialize(db_obj: Any, schema: Type[BaseModel]) -> Dict[str, Any]:
+    """pony object to dict of schema, use compiled serializer if possible"""
+    serializer = get_serializer(type(db_obj), schema)
+    if serializer is None:
+        return schema.from_orm(db_obj).dict(by_alias=True)
+    return serializer(db_obj)
+
+
+@functools.lru_cache(maxsize=None)
+def get_projectable_fields(
+        db_model: EntityMeta,
+        schema: Type[BaseModel],
+) -> Tuple[str, ...]:
+    """fields of schema which are columns of entity, not relations"""
+    attrs = {
+        attr.name: attr
+        for attr in db_model._attrs_  # pylint:disable=protected-access
+    }
+    return tuple(
+        name for name in schema.__fields__
+        if name in attrs and not isinstance(attrs[name].py_type, EntityMeta)
+    )
+
+
+def get_projected_schema(
+        schema: Type[BaseModel],
+        fields: Tuple[str, ...],
+) -> Type[BaseModel]:
+    """
+    sub schema of schema with only fields, all fields are optional,
+    keys of projected rows are aliases of it.
+    Fields are sorted, any order of the same fields is one schema,
+    get fields by name instead of by position.
+    """
+    return _projected_schema(schema, tuple(sorted(set(fields))))
+
+
+# fields come from clients, keep a bounded number of created schemas
+@functools.lru_cache(maxsize=256)
+def _projected_schema(
+        schema: Type[BaseModel],
+        fields: Tuple[str, ...],
+) -> Type[BaseModel]:
+    sub_fields = {
+        name: (Optional[schema.__fields__[name].outer_type_],
+               Field(None, alias=schema.__fields__[name].alias))
+        for name in fields
+    }
+    return create_model(
+        f'{schema.__name__}_fields_{"_".join(fields)}',
+        __config__=schema.__config__,
+        **sub_fields
+    )
+
+
+def _json_default(value: Any) -> Any:
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, BaseModel):
+        return value.dict(by_alias=True)
+    return str(value)
+
+
+def to_json(data: Any) -> bytes:
+    """dump serialized data to json bytes, by orjson if installed"""
+    if orjson is not None:
+        return orjson.dumps(data, default=_json_default)
+    return json.dumps(
+        data, default=_json_default, ensure_ascii=False, separators=(',', ':')
+    ).encode()
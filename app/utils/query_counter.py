@@ -0,0 +1,66 @@
+"""count sql executed by pony, for tests"""
+import typing
+
+from pony.orm import Database
+
+
+class QueryCounter:
+    """
+    count sql statements executed by `database` in current thread,
+    read from pony `Database.local_stats`
+
+    ```
+        with QueryCounter(models.db) as counter:
+            crud.get_query_list()
+        print(counter.count, counter.statements)
+    ```
+    """
+
+    def __init__(self, database: Database):
+        self.database = database
+        self.count = 0
+        self.statements: typing.List[str] = []
+        self._start: typing.Dict[str, int] = {}
+
+    def _snapshot(self) -> typing.Dict[str, int]:
+        return {
+            sql: stat.db_count
+            for sql, stat in self.database.local_stats.items()
+            if sql is not None  # BEGIN / COMMIT of pony
+        }
+
+    def __enter__(self) -> 'QueryCounter':
+        self._start = self._snapshot()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        for sql, db_count in self._snapshot().items():
+            executed = db_count - self._start.get(sql, 0)
+            if executed > 0:
+                self.count += executed
+                self.statements.extend([sql] * executed)
+
+
+class assert_num_queries(QueryCounter):  # pylint:disable=invalid-name
+    """
+    assert sql count of the block, e.g. a page with nested relations
+    must not run one query for each row
+
+    ```
+        with db_session, assert_num_queries(models.db, 3):
+            pagination.page(crud.query(), schemas.UserWithTodos)
+    ```
+    """
+
+    def __init__(self, database: Database, expected: int):
+        super().__init__(database)
+        self.expected = expected
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        super().__exit__(exc_type, exc_val, exc_tb)
+        if exc_type is None and self.count != self.expected:
+            statements = '\n\n'.join(self.statements)
+            raise AssertionError(
+                f'{self.count} queries executed, expected {self.expected}:'
+                f'\n{statements}'
+            )
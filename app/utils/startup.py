@@ -0,0 +1,61 @@
+"""time of each startup step"""
+import time
+from contextlib import contextmanager
+from typing import Dict
+
+
+class StartupProfiler:
+    """
+    seconds of startup steps, a step run many times is summed
+
+    ```
+        with startup_profiler.phase('db.generate_mapping'):
+            db.generate_mapping()
+        logger.info(startup_profiler.report())
+    ```
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases: Dict[str, float] = {}
+        self.counts: Dict[str, int] = {}
+        self.ready = None
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = (
+                self.phases.get(name, 0.0) + time.perf_counter() - start)
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    def mark_ready(self):
+        """startup is done"""
+        self.ready = time.perf_counter() - self.started
+
+    def as_dict(self) -> dict:
+        return {
+            'total_ms': round(
+                (self.ready if self.ready is not None
+                 else time.perf_counter() - self.started) * 1000, 2),
+            'phases_ms': {
+                name: round(seconds * 1000, 2)
+                for name, seconds in self.phases.items()
+            },
+            'counts': dict(self.counts),
+        }
+
+    def report(self) -> str:
+        data = self.as_dict()
+        lines = [f'startup {data["total_ms"]} ms']
+        for name, ms in sorted(
+                data['phases_ms'].items(), key=lambda x: -x[1]):
+            count = data['counts'][name]
+            lines.append(
+                f'  {name:<28}{ms:>10.2f} ms' + (f' x{count}' if count > 1 else ''))
+        return '\n'.join(lines)
+
+
+startup_profiler = StartupProfiler()
@@ -0,0 +1,14 @@
+"""
+benchmarks, run from the repository root:
+
+    python -m benchmarks.bench_executor
+
+app/ is added to sys.path like app/main.py does.
+"""
+import os
+import sys
+
+APP_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'app')
+if APP_PATH not in sys.path:
+    sys.path.insert(0, APP_PATH)
@@ -0,0 +1,113 @@
+"""
+inline vs threadpool execution under mixed slow and fast requests
+
+Every 10th request is slow (a blocking call of `--slow-ms`),
+the others are a Get One of Todo.
+
+    python -m benchmarks.bench_executor --requests 400 --concurrency 32
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+import httpx
+from api.api_crud import add_crud_route_factory
+from crud.base import CRUDBase
+from db import models, schemas
+from db.executor import DBExecutor
+from fastapi import APIRouter, FastAPI
+from main import add_pony
+from pony.orm import db_session
+
+
+class SlowTodoCRUD(CRUDBase):
+    """id 0 simulates a slow blocking query"""
+
+    slow_seconds = 0.05
+
+    def get(self, _id, extra_query=None, schema=None):
+        if str(_id) == '0':
+            time.sleep(self.slow_seconds)
+            _id = self.query().first().id
+        return super().get(_id, extra_query, schema)
+
+
+def build_app(db_executor):
+    """app with the same pony middleware as main"""
+    app = FastAPI()
+    router = APIRouter(prefix='/todo')
+    add_crud_route_factory(
+        router=router,
+        crud=SlowTodoCRUD(models.Todo),
+        create_schema=schemas.TodoCreate,
+        update_schema=schemas.TodoUpdate,
+        response_model=schemas.Todo,
+        path_suffix='',
+        db_executor=db_executor,
+    )
+    app.include_router(router)
+    if db_executor is None:
+        app.middleware('http')(add_pony)
+    return app
+
+
+async def run(app, total: int, concurrency: int, item_id: int) -> dict:
+    """send requests, every 10th is slow"""
+    semaphore = asyncio.Semaphore(concurrency)
+    fast_latency = []
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(
+            transport=transport, base_url='http://bench') as client:
+        async def one(i):
+            async with semaphore:
+                slow = i % 10 == 0
+                start = time.perf_counter()
+                response = await client.get(f'/todo/{0 if slow else item_id}')
+                response.raise_for_status()
+                if not slow:
+                    fast_latency.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(total)))
+        elapsed = time.perf_counter() - start
+    fast_latency.sort()
+    return {
+        'rps': total / elapsed,
+        'fast_p50_ms': statistics.median(fast_latency) * 1000,
+        'fast_p95_ms': fast_latency[int(len(fast_latency) * 0.95)] * 1000,
+    }
+
+
+def main():
+    """run every mode and print a table"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--requests', type=int, default=400)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--slow-ms', type=float, default=50)
+    parser.add_argument('--pool-sizes', type=int, nargs='+', default=[4, 8, 16])
+    args = parser.parse_args()
+    SlowTodoCRUD.slow_seconds = args.slow_ms / 1000
+
+    with db_session:
+        todo = models.Todo.select().first() or models.Todo(name='bench')
+    item_id = todo.id
+
+    modes = [('inline', None)] + [
+        (f'threadpool-{size}', DBExecutor(size, args.concurrency))
+        for size in args.pool_sizes
+    ]
+    print(f'{"mode":<16}{"req/s":>10}{"fast p50 ms":>14}{"fast p95 ms":>14}')
+    for name, db_executor in modes:
+        result = asyncio.run(
+            run(build_app(db_executor), args.requests, args.concurrency, item_id))
+        print(
+            f'{name:<16}{result["rps"]:>10.1f}'
+            f'{result["fast_p50_ms"]:>14.2f}{result["fast_p95_ms"]:>14.2f}'
+        )
+        if db_executor is not None:
+            db_executor.shutdown()
+
+
+if __name__ == '__main__':
+    main()
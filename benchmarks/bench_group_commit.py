@@ -0,0 +1,102 @@
+"""
+POST throughput with and without group commit
+
+Each mode sends `--requests` concurrent Post One of Todo,
+group commit runs with every `--windows` (ms).
+Fsync cost is higher without WAL, try `DB_SQLITE_WAL=false`.
+
+    python -m benchmarks.bench_group_commit --requests 1000 --concurrency 64
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+import httpx
+from api.api_crud import add_crud_route_factory
+from crud.base import CRUDBase
+from db import models, schemas
+from db.executor import DBExecutor
+from db.group_commit import WriteCoordinator
+from fastapi import APIRouter, FastAPI
+from main import add_pony
+
+
+def build_app(db_executor, write_coordinator):
+    """app with the same pony middleware as main"""
+    app = FastAPI()
+    router = APIRouter(prefix='/todo')
+    add_crud_route_factory(
+        router=router,
+        crud=CRUDBase(models.Todo),
+        create_schema=schemas.TodoCreate,
+        update_schema=schemas.TodoUpdate,
+        response_model=schemas.Todo,
+        path_suffix='',
+        db_executor=db_executor,
+        write_coordinator=write_coordinator,
+    )
+    app.include_router(router)
+    if db_executor is None:
+        app.middleware('http')(add_pony)
+    return app
+
+
+async def run(app, total: int, concurrency: int) -> dict:
+    """send concurrent posts"""
+    semaphore = asyncio.Semaphore(concurrency)
+    latency = []
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(
+            transport=transport, base_url='http://bench') as client:
+        async def one(i):
+            async with semaphore:
+                start = time.perf_counter()
+                response = await client.post('/todo', json={'name': f'gc-{i}'})
+                response.raise_for_status()
+                latency.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(total)))
+        elapsed = time.perf_counter() - start
+    latency.sort()
+    return {
+        'rps': total / elapsed,
+        'p50_ms': statistics.median(latency) * 1000,
+        'p95_ms': latency[int(len(latency) * 0.95)] * 1000,
+    }
+
+
+def main():
+    """run every mode and print a table"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--windows', type=float, nargs='+', default=[1, 2, 5])
+    parser.add_argument('--max-batch', type=int, default=64)
+    args = parser.parse_args()
+
+    modes = [
+        ('inline', None, None),
+        ('threadpool-8', DBExecutor(8, args.concurrency), None),
+    ] + [
+        (f'group-{window:g}ms', None, WriteCoordinator(window, args.max_batch))
+        for window in args.windows
+    ]
+    print(f'{"mode":<16}{"req/s":>10}{"p50 ms":>10}{"p95 ms":>10}{"batches":>10}')
+    for name, db_executor, coordinator in modes:
+        result = asyncio.run(
+            run(build_app(db_executor, coordinator), args.requests, args.concurrency))
+        batches = coordinator.batches if coordinator is not None else '-'
+        print(
+            f'{name:<16}{result["rps"]:>10.1f}'
+            f'{result["p50_ms"]:>10.2f}{result["p95_ms"]:>10.2f}{batches:>10}'
+        )
+        if db_executor is not None:
+            db_executor.shutdown()
+        if coordinator is not None:
+            coordinator.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+"""
+throughput and memory of `/import` by row count, format and batch size
+
+Rows are generated while they are uploaded, into a new sqlite file,
+so the body is never in memory. Peak RSS should not grow with `--rows`.
+
+    python -m benchmarks.bench_import --rows 1000000
+    python -m benchmarks.bench_import --rows 100000 1000000 --batch-sizes 500 2000
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import tempfile
+import time
+
+import httpx
+from api.api_crud import add_crud_route_factory
+from crud.base import CRUDBase
+from db import models, schemas
+from fastapi import APIRouter, FastAPI
+
+# bytes of each uploaded chunk
+CHUNK_SIZE = 64 * 1024
+
+
+def build_app():
+    """app with only the import route, it opens its own db_session"""
+    app = FastAPI()
+    router = APIRouter(prefix='/todo')
+    add_crud_route_factory(
+        router=router,
+        crud=CRUDBase(models.Todo),
+        create_schema=schemas.TodoCreate,
+        update_schema=schemas.TodoUpdate,
+        response_model=schemas.Todo,
+        path_suffix='',
+        import_route=True,
+    )
+    app.include_router(router)
+    return app
+
+
+async def body(rows: int, file_format: str):
+    """rows as NDJSON or CSV, in chunks of CHUNK_SIZE"""
+    lines = ['name\n'] if file_format == 'csv' else []
+    size = sum(len(x) for x in lines)
+    for i in range(rows):
+        line = (
+            f'todo {i}\n' if file_format == 'csv'
+            else json.dumps({'name': f'todo {i}'}) + '\n'
+        )
+        lines.append(line)
+        size += len(line)
+        if size >= CHUNK_SIZE:
+            yield ''.join(lines).encode()
+            lines, size = [], 0
+    if lines:
+        yield ''.join(lines).encode()
+
+
+def peak_rss_mb() -> float:
+    """peak RSS of this process, ru_maxrss is KiB on linux"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+async def run(app, rows: int, file_format: str, batch_size: int) -> dict:
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(
+            transport=transport, base_url='http://bench', timeout=None) as client:
+        start = time.perf_counter()
+        response = await client.post(
+            f'/todo/import?format={file_format}&batch_size={batch_size}',
+            content=body(rows, file_format),
+        )
+        elapsed = time.perf_counter() - start
+    response.raise_for_status()
+    report = response.json()
+    assert report['created'] == rows, {k: v for k, v in report.items() if k != 'batches'}
+    return {'seconds': elapsed, 'rows_per_s': rows / elapsed}
+
+
+def main():
+    """run every combination and print a table"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, nargs='+', default=[1000000])
+    parser.add_argument('--formats', nargs='+', default=['ndjson', 'csv'])
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1000])
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='bench-import-')
+    models.init_db(
+        provider='sqlite', create_db=True,
+        filename=os.path.join(directory, 'import.db'),
+    )
+    app = build_app()
+    print(f'{"rows":>10}{"format":>8}{"batch":>8}{"seconds":>10}'
+          f'{"rows/s":>12}{"peak RSS MB":>14}')
+    for rows in sorted(args.rows):
+        for file_format in args.formats:
+            for batch_size in args.batch_sizes:
+                result = asyncio.run(run(app, rows, file_format, batch_size))
+                print(
+                    f'{rows:>10}{file_format:>8}{batch_size:>8}'
+                    f'{result["seconds"]:>10.2f}{result["rows_per_s"]:>12.0f}'
+                    f'{peak_rss_mb():>14.1f}'
+                )
+    print(f'database: {directory}/import.db')
+
+
+if __name__ == '__main__':
+    main()
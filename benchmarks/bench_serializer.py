@@ -0,0 +1,91 @@
+"""
+response_model validation vs compiled serializer on a 100 item page
+
+The current path is what FastAPI does for a route with response_model:
+validate the page (from_orm of every row), jsonable_encoder, json.dumps.
+
+    python -m benchmarks.bench_serializer --rows 100 --repeat 200
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from api.deps import get_pagination_schema
+from db import models, schemas
+from fastapi.encoders import jsonable_encoder
+from fastapi.routing import serialize_response
+from fastapi.utils import create_response_field
+from pony.orm import db_session
+from utils.pony_pydantic import serialize, to_json
+
+
+def seed(rows: int):
+    """make sure there are enough users and todos"""
+    models.init_db()
+    with db_session:
+        missing = rows - models.Todo.select().count()
+        if missing > 0:
+            user = models.User(name='bench')
+            for i in range(missing):
+                models.Todo(name=f'bench {i}', user=user)
+
+
+def page_of(rows: list) -> dict:
+    """same shape as Pagination.page"""
+    return {
+        'count': len(rows), 'count_estimated': False,
+        'next': None, 'previous': None, 'data': rows,
+    }
+
+
+def bench(name: str, func, repeat: int):
+    """print mean time of func"""
+    func()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    mean = (time.perf_counter() - start) / repeat
+    print(f'{name:<40}{mean * 1000:>10.3f} ms')
+    return mean
+
+
+def main():
+    """compare both paths for Todo and TodoWithUser"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+    seed(args.rows)
+    loop = asyncio.new_event_loop()
+
+    for label, schema in (
+            ('Todo', schemas.Todo),
+            ('TodoWithUser', schemas.TodoWithUser),
+    ):
+        field = create_response_field(
+            name='bench', type_=get_pagination_schema(schema))
+        with db_session:
+            rows = models.Todo.select().limit(args.rows)[:]
+            for row in rows:
+                _ = row.user and row.user.name  # load relations for both paths
+
+            def current():
+                content = loop.run_until_complete(serialize_response(
+                    field=field, response_content=page_of(rows)))
+                return json.dumps(
+                    jsonable_encoder(content), ensure_ascii=False,
+                    separators=(',', ':')).encode()
+
+            def compiled():
+                return to_json(page_of([serialize(x, schema) for x in rows]))
+
+            assert json.loads(current()) == json.loads(compiled())
+            baseline = bench(f'{label} response_model', current, args.repeat)
+            fast = bench(f'{label} compiled serializer', compiled, args.repeat)
+            print(f'{"speedup":<40}{baseline / fast:>10.1f} x')
+    loop.close()
+
+
+if __name__ == '__main__':
+    main()
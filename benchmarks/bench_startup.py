@@ -0,0 +1,77 @@
+"""
+cold start time of the app
+
+Each run imports main in a new interpreter and prints the startup report,
+also checks importing models / schemas does not touch the database.
+
+    python -m benchmarks.bench_startup --runs 5 --output startup.json
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+from benchmarks import APP_PATH
+
+IMPORT_MAIN = '''
+import json, main
+from utils.startup import startup_profiler
+print(json.dumps(startup_profiler.as_dict()))
+'''
+
+IMPORT_MODELS = '''
+import json
+from db import models, schemas
+print(json.dumps({'bound': models.db.provider is not None,
+                  'schemas_built': [n for n in schemas.__all__ if n in vars(schemas)]}))
+'''
+
+
+def run_python(code: str) -> dict:
+    """run code in a new interpreter of app/, return its json output and wall ms"""
+    start = time.perf_counter()
+    output = subprocess.run(
+        [sys.executable, '-c', code],
+        cwd=APP_PATH, capture_output=True, text=True, check=True,
+    ).stdout
+    wall_ms = (time.perf_counter() - start) * 1000
+    data = json.loads(output.strip().splitlines()[-1])
+    data['wall_ms'] = round(wall_ms, 2)
+    return data
+
+
+def main():
+    """run and print median of each phase"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--output', help='write results to this json file')
+    args = parser.parse_args()
+
+    models_only = run_python(IMPORT_MODELS)
+    print(f'import models/schemas: {models_only["wall_ms"]} ms, '
+          f'bound={models_only["bound"]}, built={models_only["schemas_built"]}')
+
+    runs = [run_python(IMPORT_MAIN) for _ in range(args.runs)]
+    phases = sorted({name for run in runs for name in run['phases_ms']})
+    result = {
+        'wall_ms': statistics.median(run['wall_ms'] for run in runs),
+        'total_ms': statistics.median(run['total_ms'] for run in runs),
+        'phases_ms': {
+            name: statistics.median(run['phases_ms'].get(name, 0) for run in runs)
+            for name in phases
+        },
+        'import_models_ms': models_only['wall_ms'],
+    }
+    print(f'import main (median of {args.runs}): wall {result["wall_ms"]:.2f} ms, '
+          f'after profiler start {result["total_ms"]:.2f} ms')
+    for name, ms in sorted(result['phases_ms'].items(), key=lambda x: -x[1]):
+        print(f'  {name:<28}{ms:>10.2f} ms')
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,324 @@
+"""
+load test of the generated `/api/v1/todo` routes
+
+Seeds its own sqlite file (a new temporary one, or `--database` to reuse
+a seeded one) with `--users` / `--todos` rows, then runs each scenario
+in-process (httpx ASGI transport) and against a real uvicorn server:
+
+    get_one      GET /todo/{random id}
+    deep_page    GET /todo?offset=<near the end>&limit=--page-size
+    create       POST /todo
+    update       PUT /todo/{random id}
+    delete       DELETE /todo/{id created by create}
+
+Reports p50 / p95 / p99 latency, requests per second and peak RSS,
+results are written as JSON and compared with `--baseline`:
+
+    python -m benchmarks.suite --output bench.json
+    python -m benchmarks.suite --baseline bench.json --fail-over 20
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+import config
+import httpx
+from benchmarks import APP_PATH
+from db import models
+from pony.orm import db_session
+
+SCENARIOS = ('get_one', 'deep_page', 'create', 'update', 'delete')
+MODES = ('asgi', 'uvicorn')
+PREFIX = '/api/v1/todo'
+
+
+def seed(users: int, todos: int, chunk_size: int = 10000):
+    """make the bench database have exactly `users` / `todos` rows, ids from 1"""
+    models.init_db()
+    with db_session:
+        if (models.User.select().count() == users
+                and models.Todo.select().count() == todos):
+            return
+        connection = models.db.get_connection()
+        connection.execute('DELETE FROM "Todo"')
+        connection.execute('DELETE FROM "User"')
+        connection.executemany(
+            'INSERT INTO "User" (id, name) VALUES (?, ?)',
+            ((i, f'user-{i}') for i in range(1, users + 1))
+        )
+        for start in range(1, todos + 1, chunk_size):
+            end = min(start + chunk_size, todos + 1)
+            connection.executemany(
+                'INSERT INTO "Todo" (id, name, user) VALUES (?, ?, ?)',
+                (
+                    (i, f'todo-{i}', (i % users) + 1 if users else None)
+                    for i in range(start, end)
+                )
+            )
+        # pony does not know about writes of the raw connection
+        connection.commit()
+
+
+def percentile(values: List[float], q: float) -> float:
+    """nearest rank percentile of sorted values"""
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, max(0, int(round(q * len(values))) - 1))
+    return values[index]
+
+
+def peak_rss_mb(pid: Optional[int] = None) -> Optional[float]:
+    """peak resident memory of pid (linux), or of this process"""
+    if pid is None:
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kB on linux, bytes on macOS
+        return rss / 1024 / (1024 if sys.platform == 'darwin' else 1)
+    try:
+        with open(f'/proc/{pid}/status', encoding='utf-8') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+class Runner:
+    """send requests of scenarios with a fixed concurrency"""
+
+    def __init__(
+            self,
+            client: httpx.AsyncClient,
+            requests: int,
+            concurrency: int,
+            todos: int,
+            page_size: int,
+    ):
+        self.client = client
+        self.requests = requests
+        self.concurrency = concurrency
+        self.todos = todos
+        self.page_size = page_size
+        self.created: List[int] = []
+        self.random = random.Random(42)
+
+    def _request(self, scenario: str, i: int):
+        if scenario == 'get_one':
+            return 'GET', f'{PREFIX}/{self.random.randint(1, self.todos)}', None
+        if scenario == 'deep_page':
+            offset = max(0, self.todos - self.page_size * (1 + i % 10))
+            return (
+                'GET',
+                f'{PREFIX}?offset={offset}&limit={self.page_size}',
+                None
+            )
+        if scenario == 'create':
+            return 'POST', PREFIX, {'name': f'bench-{i}'}
+        if scenario == 'update':
+            return (
+                'PUT',
+                f'{PREFIX}/{self.random.randint(1, self.todos)}',
+                {'name': f'updated-{i}'}
+            )
+        return 'DELETE', f'{PREFIX}/{self.created[i]}', None
+
+    async def run(self, scenario: str) -> dict:
+        """run one scenario, delete uses ids of create"""
+        total = (
+            min(self.requests, len(self.created))
+            if scenario == 'delete' else self.requests
+        )
+        semaphore = asyncio.Semaphore(self.concurrency)
+        latency = []
+        errors = 0
+
+        async def one(i):
+            nonlocal errors
+            method, url, body = self._request(scenario, i)
+            async with semaphore:
+                start = time.perf_counter()
+                response = await self.client.request(method, url, json=body)
+                latency.append(time.perf_counter() - start)
+            if response.status_code >= 400:
+                errors += 1
+            elif scenario == 'create':
+                self.created.append(response.json()['id'])
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(total)))
+        elapsed = time.perf_counter() - start
+        latency.sort()
+        return {
+            'requests': total,
+            'errors': errors,
+            'rps': total / elapsed if elapsed else 0.0,
+            'p50_ms': percentile(latency, 0.50) * 1000,
+            'p95_ms': percentile(latency, 0.95) * 1000,
+            'p99_ms': percentile(latency, 0.99) * 1000,
+        }
+
+
+async def run_asgi(args) -> Dict[str, dict]:
+    """every scenario in this process"""
+    # pylint:disable=import-outside-toplevel
+    from main import app
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(
+            transport=transport, base_url='http://bench') as client:
+        runner = Runner(
+            client, args.requests, args.concurrency, args.todos, args.page_size)
+        results = {}
+        for scenario in args.scenarios:
+            results[scenario] = await runner.run(scenario)
+            results[scenario]['peak_rss_mb'] = peak_rss_mb()
+    return results
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+async def run_uvicorn(args) -> Dict[str, dict]:
+    """every scenario against `uvicorn main:app` in a child process"""
+    port = _free_port()
+    server = subprocess.Popen(  # pylint:disable=consider-using-with
+        [
+            sys.executable, '-m', 'uvicorn', 'main:app',
+            '--host', '127.0.0.1', '--port', str(port),
+            '--log-level', 'warning', '--no-access-log',
+        ],
+        cwd=APP_PATH,
+    )
+    base_url = f'http://127.0.0.1:{port}'
+    try:
+        limits = httpx.Limits(max_connections=args.concurrency)
+        async with httpx.AsyncClient(
+                base_url=base_url, limits=limits, timeout=30) as client:
+            deadline = time.monotonic() + 30
+            while True:
+                try:
+                    await client.get('/docs')
+                    break
+                except httpx.TransportError:
+                    if time.monotonic() > deadline or server.poll() is not None:
+                        raise RuntimeError('uvicorn did not start') from None
+                    await asyncio.sleep(0.1)
+            runner = Runner(
+                client, args.requests, args.concurrency, args.todos, args.page_size)
+            results = {}
+            for scenario in args.scenarios:
+                results[scenario] = await runner.run(scenario)
+                results[scenario]['peak_rss_mb'] = peak_rss_mb(server.pid)
+    finally:
+        server.terminate()
+        server.wait(timeout=10)
+    return results
+
+
+def compare(results: dict, baseline: dict, fail_over: Optional[float]) -> bool:
+    """print change from baseline, False if a metric is worse than fail_over %"""
+    ok = True
+    print(f'\n{"mode/scenario":<22}{"metric":<10}{"baseline":>12}{"now":>12}{"change":>10}')
+    for mode, scenarios in results['results'].items():
+        for scenario, now in scenarios.items():
+            before = baseline.get('results', {}).get(mode, {}).get(scenario)
+            if not before:
+                continue
+            for metric in ('rps', 'p50_ms', 'p95_ms', 'p99_ms'):
+                if not before.get(metric):
+                    continue
+                change = (now[metric] - before[metric]) / before[metric] * 100
+                # higher rps is better, lower latency is better
+                worse = -change if metric == 'rps' else change
+                flag = ''
+                if fail_over is not None and worse > fail_over:
+                    ok = False
+                    flag = ' !'
+                print(
+                    f'{mode + "/" + scenario:<22}{metric:<10}'
+                    f'{before[metric]:>12.2f}{now[metric]:>12.2f}'
+                    f'{change:>+9.1f}%{flag}'
+                )
+    return ok
+
+
+def main():
+    """seed, run, save and compare"""
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--todos', type=int, default=100000)
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--page-size', type=int, default=100)
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=list(MODES))
+    parser.add_argument(
+        '--scenarios', nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument(
+        '--database',
+        help='sqlite file to seed and use, default a new temporary one')
+    parser.add_argument('--output', help='write results to this json file')
+    parser.add_argument('--baseline', help='json file of a previous run')
+    parser.add_argument(
+        '--fail-over', type=float,
+        help='exit 1 if a metric is worse than baseline by this percent')
+    args = parser.parse_args()
+
+    database = args.database or os.path.join(
+        tempfile.mkdtemp(prefix='bench-suite-'), 'bench.db')
+    # never seed the database of the app, uvicorn gets it by env
+    config.DB_FILENAME = os.environ['DB_FILENAME'] = os.path.abspath(database)
+    seed(args.users, args.todos)
+    results = {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'db_execution_mode': os.environ.get('DB_EXECUTION_MODE', 'inline'),
+            'database': config.DB_FILENAME,
+            'users': args.users,
+            'todos': args.todos,
+            'requests': args.requests,
+            'concurrency': args.concurrency,
+            'page_size': args.page_size,
+        },
+        'results': {},
+    }
+    runs = {'asgi': run_asgi, 'uvicorn': run_uvicorn}
+    print(f'{"mode/scenario":<22}{"req/s":>10}{"p50 ms":>10}{"p95 ms":>10}'
+          f'{"p99 ms":>10}{"errors":>8}{"rss MB":>10}')
+    for mode in args.modes:
+        results['results'][mode] = asyncio.run(runs[mode](args))
+        for scenario, result in results['results'][mode].items():
+            rss = result['peak_rss_mb']
+            print(
+                f'{mode + "/" + scenario:<22}{result["rps"]:>10.1f}'
+                f'{result["p50_ms"]:>10.2f}{result["p95_ms"]:>10.2f}'
+                f'{result["p99_ms"]:>10.2f}{result["errors"]:>8}'
+                f'{rss if rss is None else round(rss, 1):>10}'
+            )
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        if not compare(results, baseline, args.fail_over):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,30 @@
+"""
+tests run from the repository root:
+
+    python -m pytest tests
+
+app/ is added to sys.path like app/main.py does,
+the database is a new sqlite file instead of app/db/demo.db.
+"""
+import os
+import sys
+import tempfile
+
+import pytest
+
+APP_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'app')
+if APP_PATH not in sys.path:
+    sys.path.insert(0, APP_PATH)
+# before config is imported
+os.environ['DB_FILENAME'] = os.path.join(
+    tempfile.mkdtemp(prefix='tests-'), 'test.db')
+
+
+@pytest.fixture(scope='session')
+def db():
+    """models.db bound to the test database"""
+    # pylint:disable=import-outside-toplevel
+    from db import models
+    models.init_db()
+    return models.db
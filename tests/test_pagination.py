@@ -0,0 +1,73 @@
+"""sql statements of a page with nested relations"""
+import pytest
+from api.deps import Pagination
+from crud.base import CRUDBase
+from pony.orm import db_session
+from starlette.requests import Request
+from utils.pony_pydantic import serialize
+from utils.query_counter import QueryCounter, assert_num_queries
+
+USERS = 100
+TODOS = 300
+
+
+@pytest.fixture(scope='module')
+def models(db):  # pylint:disable=unused-argument
+    # pylint:disable=import-outside-toplevel,redefined-outer-name
+    from db import models
+    with db_session:
+        users = [models.User(name=f'user-{i}') for i in range(USERS)]
+        for i in range(TODOS):
+            models.Todo(name=f'todo-{i}', user=users[i % USERS])
+    return models
+
+
+def _pagination(limit: int) -> Pagination:
+    request = Request({
+        'type': 'http',
+        'method': 'GET',
+        'scheme': 'http',
+        'server': ('test', 80),
+        'path': '/todo',
+        'query_string': b'',
+        'headers': [],
+    })
+    return Pagination(request, offset=0, limit=limit)
+
+
+def _page(model, schema, limit: int) -> list:
+    page = _pagination(limit).page(CRUDBase(model).read_query(), schema)
+    return [serialize(row, schema) for row in page['data']]
+
+
+def test_page_of_todos_with_users(db, models):
+    from db import schemas  # pylint:disable=import-outside-toplevel
+    # count, page, users of the page
+    with db_session, assert_num_queries(db, 3):
+        data = _page(models.Todo, schemas.TodoWithUser, 100)
+    assert len(data) == 100
+    assert all(row['user']['name'].startswith('user-') for row in data)
+
+
+def test_page_of_users_with_todos(db, models):
+    from db import schemas  # pylint:disable=import-outside-toplevel
+    # count, page, todos of the page
+    with db_session, assert_num_queries(db, 3):
+        data = _page(models.User, schemas.UserWithTodos, 100)
+    assert len(data) == 100
+    assert all(len(row['todos']) == TODOS // USERS for row in data)
+
+
+@pytest.mark.parametrize('schema_name', ['TodoWithUser', 'UserWithTodos'])
+def test_page_size_does_not_change_queries(db, models, schema_name):
+    from db import schemas  # pylint:disable=import-outside-toplevel
+    schema = getattr(schemas, schema_name)
+    model = models.Todo if schema_name == 'TodoWithUser' else models.User
+    counts = []
+    for limit in (10, 100):
+        with db_session, QueryCounter(db) as counter:
+            _page(model, schema, limit)
+        counts.append(counter.count)
+    assert counts[0] == counts[1]
+    # each statement once, relations are not prefetched twice
+    assert len(set(counter.statements)) == counter.count